@@ -86,11 +86,42 @@ class Account(DatabaseObject):
             connection.user.account = account
         return account
 
+    @staticmethod
+    def restore(connection, email, hostname=None):
+        # Picks a logged in account back up after a copyover.  There's no password to check, and the
+        # wallets and hostname carry over rather than being looked up again.
+        account = Account()
+        account.load_from_db(email=email)
+        if not account.email:
+            return None
+
+        if not account.players:
+            account.players = []
+
+        account.wallets = {}
+        for type_ in [WalletType.Carried, WalletType.Stored]:
+            wallet = Wallet.restore(account, type_) or Wallet.load(account, type_)
+            if not wallet:
+                wallet = Wallet.create(account, type_)
+            account.wallets[str(type_)] = wallet
+
+        account.connection = connection
+        account.ip_address = connection.client_address[0]
+        account.hostname = hostname
+        connection.ansi_mode = account.ansi_mode
+        connection.user.account = account
+        return account
+
     @staticmethod
     def get_all_accounts():
         dummy = Account()
         return dummy.get_all()
 
+    @staticmethod
+    def iter_all_accounts(projection=None):
+        dummy = Account()
+        return dummy.iter_all(projection)
+
     def send_confirmation_email(self):
         if not self.confcode:
             self.confcode = str(uuid.uuid4())
@@ -118,11 +149,21 @@ class Account(DatabaseObject):
         self.server.email_handler.send_email(from_, self.email, "Confirm your email for %s" % self.server.name,
                                              body_text=body)
 
+    def get_players(self):
+        # (name, Player or None) for each of the account's players
+        from HavokMud.player import Player
+        names = self.players or []
+        return list(zip(names, Player.lookup_many(self, names)))
+
     def is_sitelocked(self):
         # TODO
         # look up the connection's IP and hostname for possible bans
         return False
 
+    def is_admin(self):
+        admins = self.server.config.get("mud", {}).get("admins", [])
+        return bool(self.admin) or self.email in admins
+
     def get_hostname(self):
         with self.hostname_lock:
             return self.hostname
@@ -1,12 +1,9 @@
 import re
-
-from colors import color
+from functools import lru_cache
 
 
 class AnsiColors(object):
     default = "0007"  # light grey on black
-    colorCodeRe = re.compile(r'(?P<preamble>.*?)\$C(?P<code>\d\d\d\S)(?P<text>.*?)(?=(?P<eol>[\r\n]+)|$|\$C\d\d\d\S)',
-                             re.I)
     styles = ["none", "bold", "faint", "italic", "underline", "blink", "negative"]
     colors = ['black', 'red', "green", "yellow", "blue", "magenta", "cyan", "white"]
     fg_map = {
@@ -44,56 +41,87 @@ class AnsiColors(object):
         "0W": {"style": "bold", "fg": "white"},
     }
 
+    # Style names as numbered in SGR
+    sgr_styles = ["none", "bold", "faint", "italic", "underline", "blink", "blink2", "negative", "concealed",
+                  "crossed"]
+    reset = "\x1b[0m"
+    # Splits into text, code, text, code, ..., text in one pass
+    codeSplitRe = re.compile(r'\$C([0-9][0-9][0-9]\S)', re.I)
+
     def __init__(self):
         pass
 
+    @classmethod
+    def compile_codes(cls):
+        # Every known $Cxxxx code to its escape sequence.  Each one starts with a reset, so a change of
+        # colour is a single sequence, with no reset needed between segments.
+        table = {}
+        for style in range(10):
+            for bg in range(10):
+                for fg in cls.fg_map.keys():
+                    code = "%d%d%s" % (style, bg, fg)
+                    table[code] = cls.compile_code(code)
+        return table
+
+    @classmethod
+    def compile_code(cls, code):
+        params = cls.convert_code(code)
+        codes = ["0", str(30 + cls.colors.index(params["fg"])), str(40 + cls.colors.index(params["bg"]))]
+        for style in params.get("style", "none").split("+"):
+            style_code = str(cls.sgr_styles.index(style))
+            if style != "none" and style_code not in codes[3:]:
+                codes.append(style_code)
+        return "\x1b[%sm" % ";".join(codes)
+
     def convert_string(self, input, ansi=True):
-        parts = [item.groupdict() for item in self.colorCodeRe.finditer(input)]
-        if not parts:
-            parts = [{"text": input, "code": self.default}]
-
-        count = 0
-        parts_in = list(parts)
-        for (index, part) in enumerate(parts_in):
-            preamble = parts[index + count].pop("preamble", None)
-            if preamble:
-                parts.insert(index + count, {"text": preamble, "code": self.default})
-                count += 1
-
-        output = ""
-        color_params = {}
-        old_color_params = {}
-
-        for part in parts:
-            if ansi:
-                color_params = self.convert_code(part.get("code", self.default))
-            text = part.get("text", "")
-            eol = part.get("eol", "")
-            if not eol:
-                eol = ""
-            if not ansi or color_params == old_color_params:
-                output += text
-            else:
-                output += color(text, **color_params)
-            output += eol
-
-        return output
-
-    def convert_code(self, code):
+        # Output is very repetitive (prompts, menus, help), so the results are cached
+        return render_string(input, bool(ansi))
+
+    @classmethod
+    def render(cls, input, ansi=True):
+        parts = cls.codeSplitRe.split(input)
+        if not ansi:
+            return "".join(parts[::2])
+
+        table = sgr_table
+        output = []
+        current = None
+        sgr = table[cls.default]
+        for (index, part) in enumerate(parts):
+            if index & 1:
+                sgr = table.get(part, None)
+                if sgr is None:
+                    # Unknown foreground, which is white
+                    sgr = table[part[:2] + "07"]
+                continue
+
+            if not part:
+                continue
+            if sgr != current:
+                output.append(sgr)
+                current = sgr
+            output.append(part)
+
+        if current is not None:
+            output.append(cls.reset)
+        return "".join(output)
+
+    @classmethod
+    def convert_code(cls, code):
         params = {}
 
         bg_index = int(code[1])
-        if bg_index >= len(self.colors):
+        if bg_index >= len(cls.colors):
             bg_index = 0
-        params["bg"] = self.colors[bg_index]
+        params["bg"] = cls.colors[bg_index]
 
         style_index = int(code[0])
-        if style_index >= len(self.styles):
+        if style_index >= len(cls.styles):
             style_index = 0
-        style = self.styles[style_index]
+        style = cls.styles[style_index]
 
         fg_code = code[2:]
-        fg_params = self.fg_map.get(fg_code, {"style": "none", "fg": "white"})
+        fg_params = cls.fg_map.get(fg_code, {"style": "none", "fg": "white"})
         new_style = fg_params.get("style", None)
         if new_style == "none" and style == "bold":
             style = "none"
@@ -106,3 +134,11 @@ class AnsiColors(object):
             params["style"] = style
         params['fg'] = fg_params.get("fg", "white")
         return params
+
+
+sgr_table = AnsiColors.compile_codes()
+
+
+@lru_cache(maxsize=4096)
+def render_string(input, ansi):
+    return AnsiColors.render(input, ansi)
@@ -1,49 +1,25 @@
 import logging
-import stackless
 
 import requests
 
-from HavokMud.utils import log_call
+from HavokMud.metrics import timed
+from HavokMud.offload import offload_executor
 
 logger = logging.getLogger(__name__)
 
 
-class APIRequest(object):
-    def __init__(self, request, timeout):
-        self.request = request
-        self.timeout = timeout
-        self.channel = stackless.channel()
-
-
 class APIHandler(object):
     def __init__(self):
         self.session = requests.Session()
-        self.in_channel = stackless.channel()
-
-        stackless.tasklet(self.handler_loop)()
-
-    def handler_loop(self):
-        while True:
-            request = self.in_channel.receive()
-            stackless.tasklet(self.api_request)(request)
 
-    def api_request(self, request):
-        prepped = self.session.prepare_request(request.request)
-        try:
-            response = self.session.send(prepped, timeout=request.timeout)
-        except Exception as e:
-            response = {"exception": e}
-        request.channel.send(response)
+    def api_request(self, request, timeout):
+        # On an offload thread
+        prepped = self.session.prepare_request(request)
+        return self.session.send(prepped, timeout=timeout)
 
+    @timed("http.request")
     def send(self, request, timeout):
-        item = APIRequest(request, timeout)
-        self.in_channel.send(item)
-        item = item.channel.receive()
-        if isinstance(item, dict):
-            exception = item.get("exception", None)
-            if exception:
-                raise exception
-        return item
+        return offload_executor.run("api", self.api_request, request, timeout)
 
 
 api_handler = APIHandler()
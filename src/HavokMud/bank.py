@@ -1,12 +1,11 @@
 import logging
-import stackless
 import time
-from time import sleep
 
 from HavokMud.currency import Currency
 from HavokMud.database_object import DatabaseObject
 from HavokMud.eosio.action import EOSAction
 from HavokMud.eosio.permission import EOSPermission
+from HavokMud.scheduler import scheduler
 from HavokMud.system import System
 from HavokMud.wallet import Wallet, WalletType
 
@@ -14,7 +13,7 @@ logger = logging.getLogger(__name__)
 
 
 class Bank(DatabaseObject):
-    __fixed_fields__ = ["server", "tasklet", "wallets"]
+    __fixed_fields__ = ["server", "job", "wallets"]
     __database__ = None
     name = None
 
@@ -30,7 +29,7 @@ class Bank(DatabaseObject):
             self.server = server
             self.__database__ = self.server.dbs.bank_db
             self.name = name
-            self.tasklet = None
+            self.job = None
             self.wallets = {}
             self.wallet_password = {}
             self.wallet_owner_key = {}
@@ -60,7 +59,7 @@ class Bank(DatabaseObject):
             bank.set_interest_rate(10.0)
             return bank
         finally:
-            bank.tasklet = stackless.tasklet(bank.calculate_interest_tasklet)()
+            bank.schedule_interest()
 
     def deposit(self, player, currency: Currency):
         source: Wallet = player.wallets.get(WalletType.Carried, None)
@@ -126,11 +125,12 @@ class Bank(DatabaseObject):
             action = EOSAction("banker", "calcinterest", auth)
             transaction.add(action)
 
-    def calculate_interest_tasklet(self):
-        next_payment_time = time.time()
-        while True:
-            if time.time() >= next_payment_time:
-                if self.interest_rate != 0:
-                    self.calculate_interest_amounts()
-                next_payment_time = time.time() + 3600.0
-            stackless.schedule()
+    def schedule_interest(self):
+        # Hourly, starting now
+        name = "bank-interest-%s" % self.name
+        scheduler.remove_job(name)
+        self.job = scheduler.add_interval(name, 3600.0, self.calculate_interest, start=time.time())
+
+    def calculate_interest(self):
+        if self.interest_rate != 0:
+            self.calculate_interest_amounts()
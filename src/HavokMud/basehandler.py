@@ -2,6 +2,8 @@ import logging
 import sys
 from threading import Lock
 
+from HavokMud.output_priority import OutputPriority
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,18 +27,22 @@ class BaseHandler(object):
         tokens = [word.strip() for word in line.strip().split(" ")]
         return tokens
 
+    def command_cost(self, tokens):
+        # How much of the connection's command allowance this input uses up
+        return 1
+
     def handle_input(self, tokens):
         raise RuntimeError("Function %s not implemented in class %s" %
                            (sys._getframe().f_code.co_name, self.__class__.__name__))
 
-    def append_line(self, output):
+    def append_line(self, output, priority=OutputPriority.Normal):
         if output is None:
             self.append_output(None)
         else:
-            self.append_output(output + "\r\n")
+            self.append_output(output + "\r\n", priority)
 
-    def append_output(self, output):
-        self.connection.output_channel.send(output)
+    def append_output(self, output, priority=OutputPriority.Normal):
+        self.connection.append_output(output, priority)
 
     def set_echo(self, value):
         old_echo = self.echo
@@ -0,0 +1,42 @@
+import logging
+
+from HavokMud.ansicolors import render_string
+from HavokMud.output_priority import OutputPriority
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcast(object):
+    """
+    Output going to many connections, rendered (ANSI converted and encoded) once per ANSI mode rather than
+    once per recipient, and every recipient is queued the very same bytes objects.  Prefixes that differ
+    between recipients ("You say: " / "Someone says: ") are rendered separately, once each, and go out
+    ahead of the shared part.
+
+    Compression is per connection (each has its own MCCP or permessage-deflate stream), so the ANSI mode is
+    the only variant.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.rendered = {}
+
+    def render(self, text, ansi_mode):
+        key = (text, bool(ansi_mode))
+        data = self.rendered.get(key, None)
+        if data is None:
+            data = render_string(text, key[1]).encode("ascii", "replace")
+            self.rendered[key] = data
+        return data
+
+    def send(self, connection, prefix=None, priority=OutputPriority.Normal):
+        if connection is None or connection.disconnected:
+            return
+        parts = (self.render(self.text, connection.ansi_mode),)
+        if prefix:
+            parts = (self.render(prefix, connection.ansi_mode),) + parts
+        connection.append_output(parts, priority)
+
+    def send_to_users(self, users, prefix=None, priority=OutputPriority.Normal):
+        for user in users:
+            self.send(user.connection, prefix, priority)
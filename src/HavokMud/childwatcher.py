@@ -0,0 +1,131 @@
+import logging
+import signal
+import socket
+import stackless
+import subprocess
+
+from HavokMud.timingwheel import timing_wheel
+
+logger = logging.getLogger(__name__)
+
+
+class ChildWatcherError(Exception):
+    pass
+
+
+class WatchedChild(object):
+    def __init__(self, proc):
+        self.proc = proc
+        self.pid = proc.pid
+        self.returncode = None
+        self.timed_out = False
+        self.timers = []
+        self.channel = stackless.channel()
+        self.channel.preference = 0
+
+
+class ChildWatcher(object):
+    """
+    Waits for child processes without blocking the process.  SIGCHLD wakes the reactor through
+    signal.set_wakeup_fd() on a socketpair, the watcher tasklet reaps whichever watched children have
+    exited (with a non-blocking poll) and only the tasklets waiting on those children are resumed.
+
+    There is a cap on how many children may run at once, and each can be given a time limit, after
+    which it is sent SIGTERM (and SIGKILL if it doesn't take the hint).
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.started = False
+        self.max_children = 4
+        self.kill_grace = 5
+        self.read_socket = None
+        self.write_socket = None
+
+    def configure(self, config):
+        external_config = config.get("external", {})
+        self.max_children = external_config.get("max_sessions", self.max_children)
+        self.kill_grace = external_config.get("kill_grace", self.kill_grace)
+
+    def start(self):
+        # Must be called from the main thread
+        if self.started:
+            return
+
+        # Both ends are non-blocking, which set_wakeup_fd requires
+        (self.read_socket, self.write_socket) = socket.socketpair()
+        self.read_socket.settimeout(None)
+        signal.set_wakeup_fd(self.write_socket.fileno())
+        # The handler does nothing, it just needs to be there for the wakeup fd to get written to
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.started = True
+        stackless.tasklet(self.watch_loop)()
+
+    def launch(self, command, time_limit=None, **kwargs):
+        # Returns a WatchedChild (the Popen object is child.proc)
+        self.start()
+        if len(self.children) >= self.max_children:
+            raise ChildWatcherError("Too many child processes running (%s)" % len(self.children))
+
+        proc = subprocess.Popen(command, **kwargs)
+        child = WatchedChild(proc)
+        self.children[proc.pid] = child
+        logger.info("Started child %s: %s" % (proc.pid, command))
+
+        if time_limit:
+            child.timers.append(timing_wheel.call_later(time_limit, self.on_time_limit, child))
+
+        # In case it exited before the handler was in place
+        self.reap()
+        return child
+
+    def wait(self, child):
+        # Blocks only the calling tasklet until the child exits, and returns its exit code
+        if child.returncode is None:
+            child.channel.receive()
+        self.children.pop(child.pid, None)
+        return child.returncode
+
+    def watch_loop(self):
+        while True:
+            try:
+                data = self.read_socket.recv(4096)
+            except OSError as e:
+                logger.error("Child watcher socket failed: %s" % e)
+                break
+            if not data:
+                break
+            self.reap()
+
+    def reap(self):
+        for child in list(self.children.values()):
+            if child.returncode is not None or child.proc.poll() is None:
+                continue
+
+            child.returncode = child.proc.returncode
+            logger.info("Child %s exited with %s" % (child.pid, child.returncode))
+            for timer in child.timers:
+                timer.cancel()
+            child.timers = []
+            if child.channel.balance < 0:
+                child.channel.send(None)
+
+    def on_time_limit(self, child):
+        if child.returncode is not None:
+            return
+        logger.warning("Child %s ran over its time limit, terminating" % child.pid)
+        child.timed_out = True
+        child.proc.terminate()
+        child.timers = [timing_wheel.call_later(self.kill_grace, self.on_kill, child)]
+
+    def on_kill(self, child):
+        if child.returncode is not None:
+            return
+        logger.warning("Child %s didn't terminate, killing" % child.pid)
+        child.proc.kill()
+
+    def running(self):
+        return len([child for child in self.children.values() if child.returncode is None])
+
+
+child_watcher = ChildWatcher()
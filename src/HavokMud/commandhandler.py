@@ -1,155 +1,149 @@
-import re
+import time
 
 from HavokMud.basehandler import BaseHandler
+from HavokMud.broadcast import Broadcast
+from HavokMud.commandregistry import get_registry, CommandEntry
+from HavokMud.metrics import metrics
+from HavokMud.offload import offload_executor
+from HavokMud.output_priority import OutputPriority
+from HavokMud.scheduler import scheduler
+from HavokMud.writebehind import write_behind
 
 
 class CommandHandler(BaseHandler):
     commands = {
-        "look": "CommandHandler.handler_standard",
+        "look": {
+            "handler": "CommandHandler.handler_standard",
+            # So "l" is look rather than too vague
+            "priority": 1,
+            # Lists everyone, on every worker
+            "cost": 3,
+        },
         "say": "CommandHandler.handler_standard",
         "quit": "CommandHandler.handler_standard",
         "help": {
             "handler": "CommandHandler.handler_standard",
             "help": "Use HELP COMMAND_NAME to get help on a specific command\r\nUse HELP to get a list of commands",
+            "cost": 2,
         },
         "north": "CommandHandler.handler_standard",
         "n": {"root": "north"},
         "list": {
             "handler": "CommandHandler.handler_standard",
             "help": "Use LIST USERS to list online users\r\nUse LIST COMMANDS to list commands",
+            "cost": 3,
         },
         "welcome": "CommandHandler.handler_standard",
         "echo": "CommandHandler.handler_standard",
+        "jobs": {
+            "handler": "CommandHandler.handler_standard",
+            "help": "Use JOBS to list the scheduled jobs",
+            "admin": True,
+        },
+        "metrics": {
+            "handler": "CommandHandler.handler_standard",
+            "help": "Use METRICS to show how long things are taking (METRICS db. for just the database)\r\n"
+                    "Use METRICS CONNECTIONS to show the output stats for each connection\r\n"
+                    "Use METRICS RESET to start counting again",
+            "admin": True,
+            "cost": 2,
+        },
+        "copyover": {
+            "handler": "CommandHandler.handler_standard",
+            "help": "Use COPYOVER to restart the server without disconnecting anyone",
+            "admin": True,
+        },
     }
 
     def __init__(self, connection):
         BaseHandler.__init__(self, connection)
-        self.commands.update({key: {"handler": value} for (key, value) in self.commands.items()
-                              if not isinstance(value, dict)})
+        self.registry = get_registry(self.__class__)
+        self.bound_commands = {}
 
     def send_prompt(self, prompt):
         self.append_output(prompt)
 
-    def defangle_verb(self, verb):
-        while True:
-            verb = verb.lower()
-            handler_info = self.commands.get(verb, None)
-            if not isinstance(handler_info, dict):
-                handler_info = {"handler": handler_info}
-
-            root = handler_info.get("root", None)
-            if root:
-                verb = root
-                continue
-
-            handler = handler_info.get("handler", None)
-            if handler:
-                return (verb, handler_info)
-
-            pattern = re.compile(r'^%s.*' % verb, re.I)
-            roots = list(filter(None, map(lambda x: pattern.findall(x), self.commands.keys())))
-            roots = [item for item_list in roots for item in item_list]
-            if not roots:
-                return
+    def is_admin(self):
+        return bool(self.account and self.account.is_admin())
 
-            if len(roots) > 1:
-                self.append_line("Command too vague:  could be any of %s" % roots)
-                return
+    def defangle_verb(self, verb):
+        result = self.registry.lookup(verb, self.is_admin())
+        if isinstance(result, list):
+            self.append_line("Command too vague:  could be any of %s" % result)
+            return
+        return result
 
-            verb = roots[0]
+    def command_cost(self, tokens):
+        entry = self.registry.lookup(tokens[0], self.is_admin())
+        if isinstance(entry, CommandEntry):
+            return entry.cost
+        return 1
 
     def handle_input(self, tokens):
         verb = tokens[0]
         if not verb:
             return
 
-        result = self.defangle_verb(verb)
-        if not result:
+        entry = self.defangle_verb(verb)
+        if not entry:
             self.append_line("Unknown command.  Type 'help' to see a list of available commands.")
             return
 
-        (verb, handler_info) = result
-        handler = handler_info.get("handler", None)
-        if not handler:
-            return
-
-        (klass, funcname) = handler.split(".")
-        if klass == self.__class__.__name__:
-            instance = self
-        else:
-            klass = locals().get(klass, None)
-            if klass is None:
-                instance = None
-            else:
-                instance = klass(self.connection)
-
-        if instance is None:
-            func = None
-        else:
-            if funcname == "handler_standard":
-                funcname = "command_%s" % verb
-
-            if not hasattr(instance, funcname):
-                func = None
-            else:
-                func = getattr(instance, funcname)
-                if not hasattr(func, "__call__"):
-                    func = None
-
+        func = self.bound_commands.get(entry.verb, None)
         if func is None:
-            self.append_line("Handler %s not valid in class %s" % (handler, self.__class__.__name__))
-        else:
+            func = entry.bind(self)
+            self.bound_commands[entry.verb] = func
+        with metrics.timer("command.%s" % entry.verb):
             func(tokens)
 
     def command_look(self, tokens):
-        user_list = self.server.list_users()
+        user_list = self.server.list_all_users()
         self.append_line("There are %d users connected:" % len(user_list))
         self.append_line("%-16s %-15s %s" % ("Name", "Host", "Port"))
         self.append_line("-" * 40)
         for user in user_list:
-            (host, port) = user.connection.client_address
-            self.append_line("%-16s %-15s %s" % ("Unknown", host, port))
+            self.append_line("%-16s %-15s %s" % (user.get("name", None) or "Unknown", user.get("host", None),
+                                                 user.get("port", None)))
 
     def command_say(self, tokens):
         line = " ".join(tokens[1:])
-        second_party_prefix = "Someone says: "
+        # Rendered once for everyone, rather than once per user
+        message = Broadcast("\"%s$c0007\"\r\n" % line)
         for user in self.server.list_users():
             if user is self.connection.user:
-                prefix = "You say: "
+                message.send(user.connection, "You say: ")
             else:
-                prefix = second_party_prefix
-            user.connection.handler.append_line(prefix + "\"%s$c0007\"" % line)
+                # Chat to other people is dropped if they aren't keeping up
+                message.send(user.connection, "Someone says: ", OutputPriority.Low)
+        # And to everyone connected to the other workers
+        self.server.publish("say", {"line": line})
 
     def command_quit(self, tokens):
         self.append_output(None)
 
     def command_help(self, tokens):
         if len(tokens) > 1:
-            verb = tokens[1]
-            result = self.defangle_verb(verb)
-            if not result:
+            entry = self.defangle_verb(tokens[1])
+            if not entry:
                 self.append_line("I can't give help on a command I don't understand")
                 return
 
-            (verb, handler_info) = result
-            help_text = handler_info.get("help", None)
+            help_text = entry.info.get("help", None)
             if not help_text:
-                self.append_line("There is no available help for command: %s" % verb)
+                self.append_line("There is no available help for command: %s" % entry.verb)
                 return
 
-            self.append_line("Help for command: %s" % verb)
+            self.append_line("Help for command: %s" % entry.verb)
             self.append_line(help_text)
         else:
             self.append_line("Commands:")
-            for (verb, handler_info) in sorted(self.commands.items()):
-                if "root" not in handler_info:
-                    subs = dict(filter(lambda x: x[1].get("root", None) == verb, list(self.commands.items())))
-                    if subs:
-                        postamble = " (" + ", ".join(sorted(subs.keys())) + ")"
-                    else:
-                        postamble = ""
+            for entry in self.registry.list_commands(self.is_admin()):
+                if entry.aliases:
+                    postamble = " (" + ", ".join(entry.aliases) + ")"
+                else:
+                    postamble = ""
 
-                    self.append_line("  " + verb + postamble)
+                self.append_line("  " + entry.verb + postamble)
 
     def command_north(self, tokens):
         self.append_line("You move north")
@@ -177,3 +171,64 @@ class CommandHandler(BaseHandler):
             token = tokens[1].lower()
             echo = (token == "on")
         self.set_echo(echo)
+
+    def command_jobs(self, tokens):
+        jobs = scheduler.list_jobs()
+        self.append_line("There are %d scheduled jobs:" % len(jobs))
+        self.append_line("%-24s %-20s %-19s %6s %6s %6s %9s" % ("Name", "Schedule", "Next run", "Runs", "Errors",
+                                                              "Missed", "Last (ms)"))
+        self.append_line("-" * 96)
+        for job in jobs:
+            next_run = job.get("next_run", None)
+            if next_run is None:
+                next_run = "never"
+            else:
+                next_run = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(next_run))
+            if job.get("running", False):
+                next_run = "running"
+
+            last_duration = job.get("last_duration", None)
+            if last_duration is None:
+                last_duration = "-"
+            else:
+                last_duration = "%.1f" % (last_duration * 1000.0)
+
+            self.append_line("%-24s %-20s %-19s %6d %6d %6d %9s" % (job.get("name")[:24], job.get("trigger")[:20],
+                                                                  next_run, job.get("runs"), job.get("errors"),
+                                                                  job.get("missed"), last_duration))
+            if job.get("last_error", None):
+                self.append_line("    Last error: %s" % job.get("last_error"))
+
+    def command_copyover(self, tokens):
+        self.append_line("Starting copyover.")
+        # Only comes back if it didn't happen
+        error = self.server.copyover()
+        self.append_line("Copyover failed: %s" % error)
+
+    def command_metrics(self, tokens):
+        if len(tokens) > 1 and tokens[1].lower() == "reset":
+            prefix = tokens[2] if len(tokens) > 2 else ""
+            metrics.reset(prefix)
+            self.append_line("Metrics reset.")
+            return
+
+        if len(tokens) > 1 and tokens[1].lower() == "connections":
+            for line in self.server.format_connection_stats():
+                self.append_line(line)
+            return
+
+        prefix = tokens[1] if len(tokens) > 1 else ""
+        for line in metrics.format_report(prefix):
+            self.append_line(line)
+        if not prefix:
+            self.append_line("")
+            for line in offload_executor.format_stats():
+                self.append_line(line)
+            for line in write_behind.format_stats():
+                self.append_line(line)
+            self.append_line("")
+            for line in self.server.format_connection_stats(each=False):
+                self.append_line(line)
+            self.append_line("")
+            for line in self.server.dbs.handler.format_cache_stats():
+                self.append_line(line)
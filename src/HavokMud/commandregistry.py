@@ -0,0 +1,146 @@
+import logging
+from operator import attrgetter
+
+logger = logging.getLogger(__name__)
+
+
+class CommandRegistryError(Exception):
+    pass
+
+
+class CommandEntry(object):
+    __slots__ = ["verb", "info", "aliases", "priority", "admin", "cost", "bind"]
+
+    def __init__(self, verb, info, funcname):
+        self.verb = verb
+        self.info = info
+        self.aliases = []
+        self.priority = info.get("priority", 0)
+        self.admin = info.get("admin", False)
+        self.cost = info.get("cost", 1)
+        # Gives the bound method, given a handler instance
+        self.bind = attrgetter(funcname)
+
+
+class CommandRegistry(object):
+    """
+    Everything about a handler class's commands that can be worked out ahead of time, done once per class
+    rather than on every line of input.
+
+    The commands are taken from the "commands" dicts of the class and its bases (a subclass can add to
+    or override its parents' commands), in the form:
+
+        "verb": "Class.func" or {"handler": "Class.func", "help": ..., "admin": ..., "priority": ..., "cost": ...}
+        "alias": {"root": "verb"}
+
+    Aliases are resolved to the commands they stand for, and every prefix of every verb and alias is
+    indexed (a prefix trie, flattened into a dict, so a lookup is a single dict access).  An exact verb
+    or alias always wins; a prefix matching several commands goes to the one with the highest priority,
+    and is ambiguous if there's a tie.  Admin commands are indexed separately, so they never match (or
+    show up as possibilities) for anyone else.
+    """
+
+    def __init__(self, klass):
+        self.klass = klass
+        self.entries = {}
+        self.names = {}
+        self.build(self.collect_commands(klass))
+        self.index = {True: self.build_index(admin=True), False: self.build_index(admin=False)}
+
+    @staticmethod
+    def collect_commands(klass):
+        commands = {}
+        for base in reversed(klass.__mro__):
+            commands.update(base.__dict__.get("commands", {}))
+        return commands
+
+    def build(self, commands):
+        class_names = [base.__name__ for base in self.klass.__mro__]
+        for (verb, info) in commands.items():
+            if not isinstance(info, dict):
+                info = {"handler": info}
+            if info.get("root", None):
+                continue
+
+            handler = info.get("handler", None)
+            if not handler:
+                continue
+
+            (klass, funcname) = handler.split(".")
+            if funcname == "handler_standard":
+                funcname = "command_%s" % verb
+            func = getattr(self.klass, funcname, None)
+            if klass not in class_names or not callable(func):
+                logger.error("Handler %s not valid in class %s" % (handler, self.klass.__name__))
+                continue
+
+            verb = verb.lower()
+            self.entries[verb] = CommandEntry(verb, dict(info), funcname)
+            self.names[verb] = self.entries[verb]
+
+        for (alias, info) in commands.items():
+            if not isinstance(info, dict) or not info.get("root", None):
+                continue
+            entry = self.resolve_alias(commands, alias)
+            if entry is None:
+                logger.error("Alias %s in class %s doesn't lead to a command" % (alias, self.klass.__name__))
+                continue
+
+            alias = alias.lower()
+            entry.aliases.append(alias)
+            self.names[alias] = entry
+
+        for entry in self.entries.values():
+            entry.aliases.sort()
+
+    def resolve_alias(self, commands, alias):
+        seen = set()
+        while alias not in seen:
+            seen.add(alias)
+            info = commands.get(alias, None)
+            if not isinstance(info, dict) or not info.get("root", None):
+                return self.entries.get(alias.lower(), None)
+            alias = info.get("root")
+        raise CommandRegistryError("Alias loop in class %s: %s" % (self.klass.__name__, sorted(seen)))
+
+    def build_index(self, admin):
+        candidates = {}
+        for (name, entry) in self.names.items():
+            if entry.admin and not admin:
+                continue
+            for length in range(1, len(name) + 1):
+                candidates.setdefault(name[:length], set()).add(entry)
+
+        # Each prefix gives either a CommandEntry, or (for ambiguous ones) the list of possible verbs
+        index = {}
+        for (prefix, entries) in candidates.items():
+            exact = self.names.get(prefix, None)
+            if exact in entries:
+                index[prefix] = exact
+                continue
+
+            top = max(entry.priority for entry in entries)
+            best = [entry for entry in entries if entry.priority == top]
+            if len(best) == 1:
+                index[prefix] = best[0]
+            else:
+                index[prefix] = sorted(entry.verb for entry in entries)
+        return index
+
+    def lookup(self, verb, admin=False):
+        # Returns a CommandEntry, a list of the verbs an ambiguous prefix could be, or None
+        return self.index[admin].get(verb.lower(), None)
+
+    def list_commands(self, admin=False):
+        return [entry for (verb, entry) in sorted(self.entries.items()) if admin or not entry.admin]
+
+
+registries = {}
+
+
+def get_registry(klass):
+    registry = registries.get(klass, None)
+    if registry is None:
+        registry = CommandRegistry(klass)
+        registries[klass] = registry
+    return registry
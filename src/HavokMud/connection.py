@@ -1,19 +1,40 @@
 import logging
 import stackless
-import time
+import zlib
+from collections import deque
 
+from HavokMud import stacklesssocket
+from HavokMud import telnet
 from HavokMud.ansicolors import AnsiColors
 from HavokMud.jinjaprocessor import jinja_processor
+from HavokMud.linebuffer import LineBuffer
 from HavokMud.loginhandler import LoginHandler
+from HavokMud.output_priority import OutputPriority
+from HavokMud.timingwheel import timing_wheel
+from HavokMud.tokenbucket import TokenBucket
 from HavokMud.user import User
 
 logger = logging.getLogger(__name__)
 
 
+class OutputMarker(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "<%s>" % self.name
+
+
+# These are queued in with the output, so they take effect at the right point in the stream
+START_COMPRESSION = OutputMarker("start_compression")
+STOP_COMPRESSION = OutputMarker("stop_compression")
+
+
 class Connection(object):
-    telnet_cmd_with_options = range(251, 255)  # 251-254.  Remember end param is end + 1
+    # Whether external commands (like the editor) can be given the socket
+    supports_external = True
 
-    def __init__(self, client_socket, client_address):
+    def __init__(self, client_socket, client_address, copyover_state=None):
         from HavokMud.startup import server_instance
         self.server = server_instance
         self.client_socket = client_socket
@@ -22,134 +43,539 @@ class Connection(object):
         self.client_address = client_address
         self.disconnected = False
 
-        self.output_channel = stackless.channel()
+        connection_config = self.server.config.get("connection", {})
+        self.setup_output(connection_config)
+
+        # Timeouts (in seconds, 0 to disable).  The login timeout is handled by the LoginHandler.
+        self.idle_timeout = connection_config.get("idle_timeout", 1800)
+        self.keepalive_interval = connection_config.get("keepalive_interval", 60)
+        self.kick_timeout = connection_config.get("kick_timeout", 5)
+        self.timers = {}
+        self.keepalive_sent_bytes = None
+        # Set while an external command has the socket
+        self.io_suspended = False
+
+        # Lines are queued here by the read tasklet, and the input channel is only used to wake up the
+        # user's tasklet.  Commands are limited by a token bucket (a rate of 0 turns that off), and
+        # lines beyond the queue size are dropped.
+        self.input_queue = deque()
+        self.input_queue_size = connection_config.get("input_queue_size", 32)
         self.input_channel = stackless.channel()
+        self.input_channel.preference = 0
+        self.input_closed = False
+        self.input_overflowing = False
+        self.input_dropped = 0
+        self.command_bucket = TokenBucket(connection_config.get("command_rate", 4),
+                                          connection_config.get("command_burst", 10))
 
         self.handler = None
-        self.read_buffer = ""
+        self.line_buffer = LineBuffer(connection_config.get("max_line_length", 2048))
+        self.pending_lines = deque()
         self.ansi_mode = True
         self.ansi = AnsiColors()
 
+        self.telnet = telnet.TelnetParser(on_negotiation=self.on_telnet_negotiation,
+                                          on_subnegotiation=self.on_telnet_subnegotiation)
+        self.telnet_options = {}
+        self.negotiation_handlers = {
+            telnet.NAWS: self.negotiate_naws,
+            telnet.TTYPE: self.negotiate_ttype,
+            telnet.LINEMODE: self.negotiate_linemode,
+            telnet.COMPRESS2: self.negotiate_compress2,
+        }
+        self.subnegotiation_handlers = {
+            telnet.NAWS: self.subnegotiate_naws,
+            telnet.TTYPE: self.subnegotiate_ttype,
+            telnet.LINEMODE: self.subnegotiate_linemode,
+        }
+        self.window_size = None
+        self.terminal_type = None
+        self.linemode = None
+
         self.user = User(self)
         self.user_id = id(self.user)
 
         logger.info("Connection from %s:%s" % (self.client_address[0], self.client_address[1]))
 
-        self.set_handler(LoginHandler(self))
+        if copyover_state:
+            # Picking up where the old process left off.  The caller sets the handler.
+            self.restore_copyover_state(copyover_state)
+        else:
+            self.start_negotiation()
+            self.set_handler(LoginHandler(self))
+        self.reset_idle_timer()
+        if self.keepalive_interval:
+            self.set_timer("keepalive", self.keepalive_interval, self.on_keepalive)
 
         stackless.tasklet(self.read_tasklet)()
         stackless.tasklet(self.write_tasklet)()
 
+    def setup_output(self, connection_config):
+        # Everything needed to queue up output and flush it to client_socket
+
+        # Nagle-style delay (in seconds) to let more output queue up before flushing it
+        self.flush_delay = connection_config.get("flush_delay", 0.0)
+        self.compression_enabled = connection_config.get("compression", True)
+        self.compression_level = connection_config.get("compression_level", 6)
+        self.compressor = None
+
+        # Big templates marked to be streamed are queued in pieces of about this many characters
+        self.stream_chunk_size = connection_config.get("stream_chunk_size", 4096)
+
+        # Output budget.  Past the soft limits, low priority output is dropped, and past the hard
+        # limits, the client is disconnected.  Bytes already in the socket's send buffer count too.
+        self.output_soft_bytes = connection_config.get("output_soft_bytes", 65536)
+        self.output_hard_bytes = connection_config.get("output_hard_bytes", 1048576)
+        self.output_soft_messages = connection_config.get("output_soft_messages", 256)
+        self.output_hard_messages = connection_config.get("output_hard_messages", 4096)
+        self.output_queued_bytes = 0
+        self.output_dropped = 0
+        self.evicted = False
+
+        # Output is queued up here, and the output channel is only used to wake
+        # up the write tasklet, which then sends everything queued in one go.
+        self.output_queue = deque()
+        self.output_channel = stackless.channel()
+        self.output_channel.preference = 0
+        # Channels of the tasklets waiting for all of that to be written to the socket
+        self.drain_waiters = []
+        self.client_socket.on_send_drained = self.check_output_drained
+        self.output_stats = {
+            "flushes": 0,
+            "items": 0,
+            "bytes": 0,
+            "raw_bytes": 0,
+            "dropped": 0,
+            "high_water_bytes": 0,
+            "high_water_messages": 0,
+        }
+
+    def start_negotiation(self):
+        # Ask for the window size and terminal type
+        self.write_raw(telnet.negotiation(telnet.DO, telnet.NAWS))
+        self.write_raw(telnet.negotiation(telnet.DO, telnet.TTYPE))
+        if self.compression_enabled:
+            self.write_raw(telnet.negotiation(telnet.WILL, telnet.COMPRESS2))
+
     def disconnect(self):
         self.user = None
         if self.disconnected:
             raise RuntimeError("Unexpected call")
         self.disconnected = True
+        self.cancel_all_timers()
         self.client_socket.close()
+        self.client_socket.on_send_drained = None
+
+    def set_timer(self, name, delay, callback, *args):
+        # Replaces any timer already set with this name.  The callback is run from the socket reactor,
+        # so it must not block.
+        self.cancel_timer(name)
+        self.timers[name] = timing_wheel.call_later(delay, callback, *args)
+
+    def cancel_timer(self, name):
+        timer = self.timers.pop(name, None)
+        if timer:
+            timer.cancel()
+
+    def cancel_all_timers(self):
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers = {}
+
+    def reset_idle_timer(self):
+        if self.idle_timeout:
+            self.set_timer("idle", self.idle_timeout, self.on_idle_timeout)
+
+    def on_idle_timeout(self):
+        stackless.tasklet(self.kick)("You have been idle too long.  Goodbye.", "idle timeout")
+
+    def on_keepalive(self):
+        # If there's output waiting and none of it has gone out since the last keepalive, the other end
+        # has stopped reading (or is gone).
+        buffered = self.get_buffered_bytes()
+        sent_bytes = self.output_stats["bytes"] - buffered
+        if buffered and sent_bytes == self.keepalive_sent_bytes:
+            self.evict("link dead")
+            return
+
+        self.keepalive_sent_bytes = sent_bytes
+        self.send_keepalive()
+        self.set_timer("keepalive", self.keepalive_interval, self.on_keepalive)
+
+    def send_keepalive(self):
+        # A NOP makes TCP notice a connection that has gone away without closing
+        self.write_raw(bytes([telnet.IAC, telnet.NOP]))
+
+    def kick(self, message, reason):
+        # Let them see why, but don't wait long for a client that isn't reading
+        if self.evicted or self.disconnected:
+            return
+        self.write_line(message)
+        self.wait_for_output(self.kick_timeout)
+        self.evict(reason)
 
     def set_echo(self, value):
         if not value:
-            # IAC, WILL, TELOPT_ECHO
-            self.write_raw(b'\xff\xfb\x01')
+            self.write_raw(telnet.negotiation(telnet.WILL, telnet.ECHO))
         else:
-            # IAC, WONT, TELOPT_ECHO
-            self.write_raw(b'\xff\xfc\x01')
+            self.write_raw(telnet.negotiation(telnet.WONT, telnet.ECHO))
 
     def write_raw(self, s):
         self.write(s, False)
 
     def write(self, s, string_mode=True):
-        if string_mode:
-            s = self.ansi.convert_string(s, self.ansi_mode)
-            s = s.encode("ascii")
-        self.client_socket.send(s)
+        if not string_mode:
+            s = bytes(s)
+        self.append_output(s)
 
     def write_line(self, s):
         self.write(s + "\r\n")
 
-    def read_line(self, string_mode=True):
-        start_time = time.time()
-        s = self.read_buffer
-        while True:
-            # If there is a CRLF in the text we have, we have a full
-            # line to return to the caller.
-            if s.find('\r\n') > -1:
-                i = s.index('\r\n')
-                # Strip the CR LF.
-                line = s[:i]
-                self.read_buffer = s[i + 2:]
-                while '\x08' in line:
-                    i = line.index('\x08')
-                    if i == 0:
-                        line = line[1:]
-                    else:
-                        line = line[:i - 1] + line[i + 1:]
-                return line
+    def append_output(self, data, priority=OutputPriority.Normal):
+        # data can be a str (to be ANSI converted), a dict (a template to render), bytes (sent as is),
+        # a tuple of already rendered bytes (from a Broadcast) or None (to disconnect once the output is sent)
+        if self.evicted:
+            return
+
+        if isinstance(data, dict) and data.get("stream", False):
+            self.stream_template(data, priority)
+            return
+
+        size = self.get_output_size(data)
+        pending_bytes = self.output_queued_bytes + self.get_buffered_bytes() + size
+        pending_messages = len(self.output_queue) + 1
+
+        if pending_bytes > self.output_hard_bytes or pending_messages > self.output_hard_messages:
+            self.evict("output backlog of %s bytes in %s messages" % (pending_bytes, pending_messages))
+            return
+
+        if priority == OutputPriority.Low:
+            if pending_bytes > self.output_soft_bytes or pending_messages > self.output_soft_messages:
+                self.output_dropped += 1
+                self.output_stats["dropped"] += 1
+                return
+
+            if self.output_dropped:
+                # Let them know what they missed once they have caught up
+                self.queue_output("[%s messages were dropped]\r\n" % self.output_dropped)
+                self.output_dropped = 0
+
+        self.queue_output(data)
+        self.output_stats["high_water_bytes"] = max(self.output_stats["high_water_bytes"], pending_bytes)
+        self.output_stats["high_water_messages"] = max(self.output_stats["high_water_messages"],
+                                                       len(self.output_queue))
+
+        if self.output_channel.balance < 0:
+            self.output_channel.send(None)
+
+    def stream_template(self, data, priority=OutputPriority.Normal):
+        # Renders the template a piece at a time straight into the output queue, so the writer can start
+        # sending before it's finished, and the output budget applies as it goes.  The pieces are split at
+        # line ends so no colour codes get cut in half.
+        pending = []
+        pending_size = 0
+        for chunk in jinja_processor.generate(data):
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size < self.stream_chunk_size:
+                continue
 
-            try:
-                v = self.client_socket.recv(1000)
-            except Exception:
-                v = b""
+            text = "".join(pending)
+            end = text.rfind("\n") + 1
+            if not end:
+                continue
+            self.append_output(text[:end], priority)
+            if self.evicted:
+                return
+            pending = [text[end:]]
+            pending_size = len(pending[0])
+            # Let the writer get going on it
+            stackless.schedule()
+
+        text = "".join(pending)
+        if text:
+            self.append_output(text, priority)
+
+    def queue_output(self, data):
+        self.output_queue.append(data)
+        self.output_queued_bytes += self.get_output_size(data)
+
+    def get_buffered_bytes(self):
+        # Written, but still waiting in the socket's send buffer (None once closed)
+        return len(self.client_socket.send_buffer or b"")
+
+    @staticmethod
+    def get_output_size(data):
+        # Templates aren't rendered until they are flushed, so they only count against the message budget
+        if isinstance(data, (str, bytes, bytearray)):
+            return len(data)
+        if isinstance(data, tuple):
+            return sum(map(len, data))
+        return 0
+
+    def evict(self, reason):
+        if self.evicted:
+            return
+        self.evicted = True
+        self.cancel_all_timers()
+        logger.warning("Disconnecting %s:%s: %s" % (self.client_address[0], self.client_address[1], reason))
+        self.output_queue.clear()
+        self.output_queued_bytes = 0
+        # The read tasklet sees the close as a disconnection, and the write tasklet exits
+        self.client_socket.close()
+        if self.output_channel.balance < 0:
+            self.output_channel.send(None)
+
+    def render_output(self, data):
+        if isinstance(data, dict):
+            data = jinja_processor.process(data)
+        if isinstance(data, str):
+            data = self.ansi.convert_string(data, self.ansi_mode)
+            data = data.encode("ascii", "replace")
+        return data
+
+    def flush_output(self):
+        buffers = []
+        disconnect = False
+        while self.output_queue:
+            data = self.output_queue.popleft()
+            self.output_queued_bytes -= self.get_output_size(data)
+            self.output_stats["items"] += 1
+            if data is None:
+                disconnect = True
+                break
 
-            # An empty string indicates disconnection.
-            if not v:
-                return None
+            if data is START_COMPRESSION:
+                if not self.compressor:
+                    # Everything after the IAC SB COMPRESS2 IAC SE is compressed
+                    buffers.append(telnet.subnegotiation(telnet.COMPRESS2))
+                    self.send_buffers(buffers)
+                    buffers = []
+                    self.compressor = zlib.compressobj(self.compression_level)
+                continue
+
+            if data is STOP_COMPRESSION:
+                if self.compressor:
+                    self.send_buffers(buffers, zlib.Z_FINISH)
+                    buffers = []
+                    self.compressor = None
+                continue
+
+            if isinstance(data, tuple):
+                # Shared with other connections, so they go out as they are
+                buffers.extend(data)
+                continue
 
-            # Deal with any embedded telnet commands before decoding UTF-8
-            v = self.handle_telnet_commands(v)
+            data = self.render_output(data)
+            if data:
+                buffers.append(data)
+
+        self.send_buffers(buffers)
+
+        if disconnect and self.user:
+            self.user.disconnect = True
+
+    def send_buffers(self, buffers, mode=zlib.Z_SYNC_FLUSH):
+        if not buffers and not (self.compressor and mode == zlib.Z_FINISH):
+            return
+
+        raw_bytes = sum(map(len, buffers))
+        if self.compressor:
+            # Sync flush so the client can decompress everything sent so far
+            data = self.compressor.compress(b"".join(buffers)) + self.compressor.flush(mode)
+            buffers = [data]
+
+        self.output_stats["flushes"] += 1
+        self.output_stats["raw_bytes"] += raw_bytes
+        self.output_stats["bytes"] += self.client_socket.sendmsg(buffers)
+
+    def get_output_stats(self):
+        stats = dict(self.output_stats)
+        stats["syscalls"] = self.client_socket.send_syscalls
+        flushes = max(stats["flushes"], 1)
+        stats["bytes_per_flush"] = stats["bytes"] / flushes
+        stats["syscalls_per_flush"] = stats["syscalls"] / flushes
+        stats["compression_ratio"] = stats["raw_bytes"] / max(stats["bytes"], 1)
+        stats["queued_messages"] = len(self.output_queue)
+        stats["queued_bytes"] = self.output_queued_bytes
+        stats["buffered_bytes"] = self.get_buffered_bytes()
+        return stats
+
+    def suspend_compression(self):
+        # For when something else is going to write to the socket directly
+        if self.telnet_options.get(telnet.COMPRESS2, False):
+            self.append_output(STOP_COMPRESSION)
+
+    def resume_compression(self):
+        if self.telnet_options.get(telnet.COMPRESS2, False):
+            self.append_output(START_COMPRESSION)
+
+    def suspend_io(self):
+        # An external command is about to use the socket directly.  Incoming data is left for it to read,
+        # and output is held back until it's finished.
+        self.io_suspended = True
+        self.client_socket.pause_reading()
+
+    def resume_io(self, *prefix):
+        # Anything in prefix goes out ahead of the output held back while suspended
+        for data in reversed(prefix):
+            self.output_queue.appendleft(data)
+            self.output_queued_bytes += self.get_output_size(data)
+        self.io_suspended = False
+        self.client_socket.resume_reading()
+        self.reset_idle_timer()
+        if self.output_channel.balance < 0:
+            self.output_channel.send(None)
+
+    def wait_for_output(self, timeout=None):
+        # Wait until everything queued has been written to the socket (or the timeout runs out).  The write
+        # tasklet and the socket wake us up once it has, so this doesn't need to poll.
+        if self.output_drained():
+            return True
+        channel = stackless.channel()
+        channel.preference = 0
+        self.drain_waiters.append(channel)
+        timer = None
+        if timeout is not None:
+            timer = stacklesssocket.call_later(timeout, self.wake_drain_waiter, channel, False)
+        try:
+            return channel.receive()
+        finally:
+            if timer:
+                timer.cancel()
+            if channel in self.drain_waiters:
+                self.drain_waiters.remove(channel)
+
+    def output_drained(self):
+        return not self.output_queue and not self.client_socket.send_buffer
+
+    def check_output_drained(self):
+        # Called from the socket reactor too, so it must not block
+        if self.drain_waiters and self.output_drained():
+            waiters = self.drain_waiters
+            self.drain_waiters = []
+            for channel in waiters:
+                self.wake_drain_waiter(channel, True)
+
+    @staticmethod
+    def wake_drain_waiter(channel, drained):
+        if channel.balance < 0:
+            channel.send(drained)
+
+    def prepare_copyover(self, message):
+        # The compressed stream has to be finished before the process is replaced, as the zlib state
+        # doesn't survive it.  It gets started again afterwards.
+        self.write_line(message)
+        self.suspend_compression()
+
+    def get_copyover_state(self):
+        # Called once the output has been flushed.  Returns None if this connection can't be carried over.
+        if self.disconnected or self.evicted or self.io_suspended or self.client_socket.send_buffer:
+            return None
+
+        self.suspend_io()
+        return {
+            "fd": self.client_socket.fileno(),
+            "address": list(self.client_address),
+            "ansi_mode": self.ansi_mode,
+            "telnet_options": {str(option): value for (option, value) in self.telnet_options.items()},
+            "window_size": self.window_size,
+            "terminal_type": self.terminal_type,
+            "linemode": self.linemode,
+            "input_lines": list(self.input_queue),
+            "pending_lines": [line.decode("latin-1") for line in self.pending_lines],
+            "partial_line": self.line_buffer.buffer.decode("latin-1"),
+        }
+
+    def restore_copyover_state(self, state):
+        self.ansi_mode = state.get("ansi_mode", True)
+        self.telnet_options = {int(option): value for (option, value) in state.get("telnet_options", {}).items()}
+        window_size = state.get("window_size", None)
+        self.window_size = tuple(window_size) if window_size else None
+        self.terminal_type = state.get("terminal_type", None)
+        self.linemode = state.get("linemode", None)
+        self.input_queue.extend(state.get("input_lines", []))
+        self.pending_lines.extend(line.encode("latin-1") for line in state.get("pending_lines", []))
+        self.line_buffer.buffer += state.get("partial_line", "").encode("latin-1")
+        self.resume_compression()
+
+    def read_line(self, string_mode=True):
+        while not self.pending_lines:
+            v = self.read_input()
+            if v is None:
+                return None
 
             if not v:
                 # This was all telnet commands, just eat it.
                 continue
 
-            if string_mode:
-                v = v.decode("utf-8", "replace")
-
-            s += v
-
-    def handle_telnet_commands(self, input):
-        # Commands defined in RFC854
-        # Options defined in RFC855
-        # 0xFF 0xF0      is "IAC SE" - end of subnegotiation
-        # 0xFF 0xF1      is "IAC NOP"
-        # 0xFF 0xF2      is "IAC DataMark" - should have TCP urgent
-        # 0xFF 0xF3      is "IAC BRK" - break
-        # 0xFF 0xF4      is "IAC IP" - interrupt process
-        # 0xFF 0xF5      is "IAC AO" - abort output
-        # 0xFF 0xF6      is "IAC AYT" - are you there
-        # 0xFF 0xF7      is "IAC EC" - erase character
-        # 0xFF 0xF8      is "IAC EL" - erase line
-        # 0xFF 0xF9      is "IAC GA" - go ahead
-        # 0xFF 0xFA      is "IAC SB" - start subnegotiation
-        # 0xFF 0xFB 0xXX is "IAC WILL option"
-        # 0xFF 0xFC 0xXX is "IAC WONT option"
-        # 0xFF 0xFD 0xXX is "IAC DO option"
-        # 0xFF 0xFE 0xXX is "IAC DONT option"
-        # 0xFF 0xFF      is "IAC IAC" - send 0xFF
-
-        start = 0
-        while b'\xff' in input:
-            index = input.find(b'\xff', start)
-            if index == -1:
-                break
-            length = 2
-            command = input[index + 1]
-            if command == b'\xff':
-                # Leave one 0xFF, and continue searching.
-                end = index + 1
-                start = index + 1
-            else:
-                option = None
-                if command in self.telnet_cmd_with_options:
-                    option = input[index + 2]
-                    length += 1
-                end = index + length
-                # At this time, I don't want to do anything with these commands, just strip them out.
-                # logger.debug("Telnet command: %s %s" % (command, option))
-
-            input = input[:index] + input[end:]
-
-        return input
+            self.pending_lines.extend(self.line_buffer.feed(v))
+
+        line = self.pending_lines.popleft()
+        self.reset_idle_timer()
+        if string_mode:
+            line = line.decode("utf-8", "replace")
+        return line
+
+    def read_input(self):
+        # Returns the next chunk of input data, or None on disconnection
+        try:
+            v = self.client_socket.recv(4096)
+        except Exception:
+            v = b""
+
+        # An empty string indicates disconnection.
+        if not v:
+            return None
+
+        # Deal with any embedded telnet commands before splitting lines
+        return self.telnet.feed(v)
+
+    def on_telnet_negotiation(self, command, option):
+        handler = self.negotiation_handlers.get(option, None)
+        if handler:
+            handler(command)
+
+    def on_telnet_subnegotiation(self, option, data):
+        handler = self.subnegotiation_handlers.get(option, None)
+        if handler:
+            handler(data)
+
+    def negotiate_naws(self, command):
+        self.telnet_options[telnet.NAWS] = (command == telnet.WILL)
+
+    def negotiate_ttype(self, command):
+        self.telnet_options[telnet.TTYPE] = (command == telnet.WILL)
+        if command == telnet.WILL:
+            self.write_raw(telnet.subnegotiation(telnet.TTYPE, bytes([telnet.TTYPE_SEND])))
+
+    def negotiate_linemode(self, command):
+        self.telnet_options[telnet.LINEMODE] = (command == telnet.WILL)
+
+    def negotiate_compress2(self, command):
+        if command == telnet.DO and self.compression_enabled:
+            self.telnet_options[telnet.COMPRESS2] = True
+            self.append_output(START_COMPRESSION)
+        elif command == telnet.DONT:
+            self.telnet_options[telnet.COMPRESS2] = False
+            self.append_output(STOP_COMPRESSION)
+
+    def subnegotiate_naws(self, data):
+        if len(data) != 4:
+            return
+        self.window_size = ((data[0] << 8) | data[1], (data[2] << 8) | data[3])
+        logger.debug("Window size: %s" % (self.window_size,))
+
+    def subnegotiate_ttype(self, data):
+        if data[:1] != bytes([telnet.TTYPE_IS]):
+            return
+        self.terminal_type = data[1:].decode("ascii", "replace")
+        logger.debug("Terminal type: %s" % self.terminal_type)
+
+    def subnegotiate_linemode(self, data):
+        if data[:1] != bytes([telnet.LINEMODE_MODE]) or len(data) < 2:
+            return
+        self.linemode = data[1]
 
     def set_handler(self, handler):
         self.handler = handler
@@ -159,18 +585,104 @@ class Connection(object):
 
     def write_tasklet(self):
         while not self.disconnected and (not self.user or not self.user.disconnect):
-            data = self.output_channel.receive()
-            if data is None:
-                if self.user:
-                    self.user.disconnect = True
-                continue
+            if not self.output_queue or self.io_suspended:
+                self.output_channel.receive()
+                if self.evicted:
+                    break
+                if self.io_suspended:
+                    continue
+                if self.flush_delay:
+                    stacklesssocket.sleep(self.flush_delay)
 
-            if isinstance(data, str):
-                self.write(data)
-            elif isinstance(data, dict):
-                self.write(jinja_processor.process(data))
+            try:
+                self.flush_output()
+            except OSError as e:
+                logger.debug("Output to %s:%s failed: %s" % (self.client_address[0], self.client_address[1], e))
+                self.output_queue.clear()
+                self.output_queued_bytes = 0
+            self.check_output_drained()
 
     def read_tasklet(self):
         while not self.disconnected:
             line = self.read_line()
-            self.input_channel.send(line)
+            if line is None:
+                self.input_closed = True
+                self.wake_input()
+                self.cancel_all_timers()
+                break
+
+            if len(self.input_queue) >= self.input_queue_size:
+                self.drop_input()
+                continue
+            self.input_queue.append(line)
+            self.wake_input()
+
+    def wake_input(self):
+        if self.input_channel.balance < 0:
+            self.input_channel.send(None)
+
+    def drop_input(self):
+        self.input_dropped += 1
+        if not self.input_overflowing:
+            # Once until they've caught up
+            self.input_overflowing = True
+            logger.info("Dropping input from %s:%s" % (self.client_address[0], self.client_address[1]))
+            self.write_line("You are typing too fast, some of your input has been lost.")
+
+    def get_input(self):
+        # Returns the next line of input, or None once the other end has disconnected (and everything
+        # they sent before that has been handled)
+        while not self.input_queue:
+            self.input_overflowing = False
+            if self.input_closed:
+                return None
+            self.input_channel.receive()
+        return self.input_queue.popleft()
+
+
+# Output stats added up across connections, and those where the largest on any one connection is kept
+TOTAL_OUTPUT_STATS = ["flushes", "items", "bytes", "raw_bytes", "dropped", "syscalls", "queued_messages",
+                      "queued_bytes", "buffered_bytes"]
+MAX_OUTPUT_STATS = ["high_water_bytes", "high_water_messages", "queued_messages", "queued_bytes", "buffered_bytes"]
+
+
+def summarize_output_stats(connection_stats):
+    # connection_stats are from Connection.get_output_stats()
+    totals = dict.fromkeys(TOTAL_OUTPUT_STATS, 0)
+    largest = dict.fromkeys(MAX_OUTPUT_STATS, 0)
+    for stats in connection_stats:
+        for name in TOTAL_OUTPUT_STATS:
+            totals[name] += stats[name]
+        for name in MAX_OUTPUT_STATS:
+            largest[name] = max(largest[name], stats[name])
+    flushes = max(totals["flushes"], 1)
+    totals["bytes_per_flush"] = totals["bytes"] / flushes
+    totals["syscalls_per_flush"] = totals["syscalls"] / flushes
+    totals["compression_ratio"] = totals["raw_bytes"] / max(totals["bytes"], 1)
+    return {"count": len(connection_stats), "totals": totals, "max": largest}
+
+
+def format_output_stats(summary, connection_stats=None):
+    # The summary from summarize_output_stats, then a line for each connection if they're given (each
+    # with an "address"), those that have queued up the most first
+    lines = ["Connections: %d" % summary["count"],
+             "Output: %(flushes)d flushes, %(bytes)d bytes sent (%(raw_bytes)d before compression, "
+             "%(compression_ratio).2fx), %(bytes_per_flush).1f bytes and %(syscalls_per_flush).2f syscalls per "
+             "flush, %(dropped)d dropped" % summary["totals"],
+             "Backlog: %(queued_messages)d messages and %(queued_bytes)d bytes queued, %(buffered_bytes)d bytes "
+             "in socket buffers" % summary["totals"],
+             "Most on one connection: %(high_water_bytes)d bytes and %(high_water_messages)d messages at the "
+             "high-water mark, %(queued_bytes)d bytes queued now" % summary["max"]]
+    if connection_stats is None:
+        return lines
+
+    lines.append("")
+    lines.append("%-21s %10s %8s %8s %7s %6s %10s %8s %7s" % ("Address", "Bytes", "Flushes", "B/flush", "Sys/fl",
+                                                             "Ratio", "HW bytes", "HW msgs", "Dropped"))
+    lines.append("-" * 93)
+    for stats in sorted(connection_stats, key=lambda item: item["high_water_bytes"], reverse=True):
+        lines.append("%-21s %10d %8d %8.1f %7.2f %6.2f %10d %8d %7d" % (
+            stats["address"][:21], stats["bytes"], stats["flushes"], stats["bytes_per_flush"],
+            stats["syscalls_per_flush"], stats["compression_ratio"], stats["high_water_bytes"],
+            stats["high_water_messages"], stats["dropped"]))
+    return lines
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import time
+
+from HavokMud.account import Account
+from HavokMud.childwatcher import child_watcher
+from HavokMud.commandhandler import CommandHandler
+from HavokMud.connection import Connection
+from HavokMud.loginhandler import LoginHandler
+from HavokMud.offload import offload_executor
+from HavokMud.player import Player
+from HavokMud.writebehind import write_behind
+
+logger = logging.getLogger(__name__)
+
+# The state is handed to the new process in an (unnamed) file descriptor, given in this variable
+COPYOVER_ENV = "HAVOKMUD_COPYOVER_FD"
+COPYOVER_VERSION = 1
+
+
+class CopyoverError(Exception):
+    pass
+
+
+def perform_copyover(server, message="Copyover in progress, please wait..."):
+    """
+    Replaces the running server with a fresh exec of itself, keeping the listening sockets and the telnet
+    sessions.  Each connection's socket is inherited along with enough state (telnet options, the logged
+    in account and player) for the new process to carry on without anyone logging in again.
+
+    Only returns if the copyover couldn't be done, and raises CopyoverError to say why.
+    """
+    if server.workers > 1:
+        raise CopyoverError("Copyover isn't supported with multiple workers")
+    if child_watcher.running():
+        raise CopyoverError("There are %s external sessions running" % child_watcher.running())
+    write_behind.flush()
+    if offload_executor.busy():
+        # Anything still running on the threads (like a database write) would be lost
+        raise CopyoverError("There are %s backend requests in progress" % offload_executor.busy())
+
+    timeout = server.config.get("connection", {}).get("copyover_timeout", 5)
+    connections = [user.connection for user in server.list_users()
+                   if user.connection and not user.connection.disconnected]
+    logger.warning("Starting copyover with %s connections" % len(connections))
+
+    # Finish off everyone's output (and compressed streams) first, all at once
+    for connection in connections:
+        connection.prepare_copyover(message)
+    deadline = time.monotonic() + timeout
+    for connection in connections:
+        connection.wait_for_output(max(deadline - time.monotonic(), 0.0))
+
+    sessions = []
+    carried = []
+    for connection in connections:
+        state = connection.get_copyover_state()
+        if state is None:
+            continue
+        state.update(get_session_state(connection))
+        sessions.append(state)
+        carried.append(connection)
+
+    state = {
+        "version": COPYOVER_VERSION,
+        "listeners": {str(port): listen_socket.fileno() for (port, listen_socket) in server.listeners.items()},
+        "connections": sessions,
+    }
+
+    try:
+        exec_server(state)
+    except Exception as e:
+        logger.exception("Copyover failed")
+        # Still here, so put everyone back the way they were
+        for connection in carried:
+            connection.resume_io()
+            connection.resume_compression()
+            connection.write_line("Copyover failed, carrying on.")
+        raise CopyoverError("Couldn't restart: %s" % e)
+
+
+def get_session_state(connection):
+    # Keys for whoever is logged in.  Anyone part way through logging in has to start again.
+    account = connection.user.account if connection.user else None
+    if not isinstance(connection.handler, CommandHandler) or not account or not account.current_player:
+        return {"handler": "login"}
+
+    return {
+        "handler": "playing",
+        "email": account.email,
+        "hostname": account.hostname,
+        "player": account.current_player.name,
+    }
+
+
+def exec_server(state):
+    fds = [item.get("fd") for item in state.get("connections", [])] + list(state.get("listeners", {}).values())
+
+    data = json.dumps(state).encode("utf-8")
+    if hasattr(os, "memfd_create"):
+        state_fd = os.memfd_create("havokmud-copyover", 0)
+    else:
+        (state_fd, path) = tempfile.mkstemp(prefix="havokmud-copyover-")
+        os.unlink(path)
+    os.write(state_fd, data)
+    os.lseek(state_fd, 0, os.SEEK_SET)
+
+    for fd in fds + [state_fd]:
+        os.set_inheritable(fd, True)
+    os.environ[COPYOVER_ENV] = str(state_fd)
+
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+    # orig_argv keeps any interpreter options (Python 3.10+)
+    argv = getattr(sys, "orig_argv", [sys.executable] + sys.argv)
+    logger.warning("Copyover: exec %s with %s connections" % (argv, len(state.get("connections", []))))
+    try:
+        os.execv(sys.executable, argv)
+    finally:
+        # Only get here if the exec failed
+        del os.environ[COPYOVER_ENV]
+        os.close(state_fd)
+        for fd in fds:
+            os.set_inheritable(fd, False)
+
+
+def load_state():
+    # In the new process, returns the state left by perform_copyover (or None after a normal start)
+    state_fd = os.environ.pop(COPYOVER_ENV, None)
+    if state_fd is None:
+        return None
+
+    try:
+        with os.fdopen(int(state_fd), "rb") as f:
+            state = json.loads(f.read().decode("utf-8"))
+    except (OSError, ValueError) as e:
+        logger.error("Couldn't read the copyover state: %s" % e)
+        return None
+
+    if state.get("version", None) != COPYOVER_VERSION:
+        logger.error("Copyover state version %s not supported" % state.get("version", None))
+        return None
+
+    return state
+
+
+def recover_sessions(server, state):
+    count = 0
+    for item in state.get("connections", []):
+        try:
+            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=item.get("fd"))
+            os.set_inheritable(client_socket.fileno(), False)
+            client_socket.was_connected = True
+            connection = Connection(client_socket, tuple(item.get("address")), copyover_state=item)
+        except Exception:
+            logger.exception("Couldn't recover connection %s" % item.get("address"))
+            continue
+
+        try:
+            restore_session(connection, item)
+        except Exception:
+            logger.exception("Couldn't restore the session for %s" % item.get("email", None))
+            connection.set_handler(LoginHandler(connection))
+            connection.write_line("Sorry, you will need to log in again.")
+        count += 1
+
+    logger.warning("Copyover recovered %s of %s connections" % (count, len(state.get("connections", []))))
+
+
+def restore_session(connection, item):
+    if item.get("handler", None) == "playing":
+        account = Account.restore(connection, item.get("email"), item.get("hostname", None))
+        player = Player.restore(account, item.get("player")) if account else None
+        if player:
+            account.current_player = player
+            connection.set_handler(CommandHandler(connection))
+            connection.write_line("Copyover complete.")
+            return
+
+    connection.set_handler(LoginHandler(connection))
+    connection.write_line("Copyover complete, please log in again.")
@@ -1,8 +1,12 @@
 import logging
+import time
 from decimal import Decimal
 
 import boto3
 
+from HavokMud.database.item_cache import ItemCache
+from HavokMud.offload import offload_executor
+
 logger = logging.getLogger(__name__)
 
 
@@ -48,15 +52,6 @@ def _dynamodb_to_dict(func):
     return wrapper
 
 
-def _dynamodb_to_array(func):
-    def wrapper(*args, **kwargs):
-        dynamo_data = func(*args, **kwargs)
-        data = [_convert_row_from_dynamodb(row) for row in dynamo_data]
-        return data
-
-    return wrapper
-
-
 def _convert_row_from_dynamodb(row):
     return {key: _convert_field_from_dynamodb(value) for (key, value) in row.items()}
 
@@ -97,6 +92,12 @@ class Database(object):
     db_billing_mode = None
     db_provisioned_throughput = None
     handler = None
+    # BatchWriteItem takes at most 25 items, and hands back any it didn't get to
+    batch_write_size = 25
+    batch_write_attempts = 5
+    # And BatchGetItem 100 keys
+    batch_get_size = 100
+    batch_get_attempts = 5
 
     def __init__(self, config):
         self.config = config
@@ -110,9 +111,15 @@ class Database(object):
         if not self.table:
             raise ValueError("Table not defined in class %s" % self.__class__.__name__)
 
+        self.cache = ItemCache(self.table, dynamodb_config.get("cache_ttl", 60.0),
+                               dynamodb_config.get("cache_size", 10000))
+        # Scans are split into this many segments, read in parallel
+        self.scan_segments = dynamodb_config.get("scan_segments", 4)
+        self.scan_page_size = dynamodb_config.get("scan_page_size", None)
+
         self.session = boto3.session.Session(region_name=self.region)
         self.dynamodb = self.session.client('dynamodb', endpoint_url=self.endpoint, use_ssl=self.use_ssl)
-        self.create_table()
+        offload_executor.run("db", self.create_table)
 
     def create_table(self):
         create = False
@@ -170,15 +177,123 @@ class Database(object):
         except Exception:
             pass
 
-    @_dynamodb_to_array
-    def get_all(self):
-        items = []
-        paginator = self.dynamodb.get_paginator("scan")
+    def get_key_names(self):
+        return [item.get("AttributeName") for item in self.db_key_schema]
+
+    def get_key(self, data):
+        return tuple(str(data.get(name, None)) for name in self.get_key_names())
+
+    def get_key_dict(self, data):
+        return {name: data.get(name, None) for name in self.get_key_names()}
+
+    def batch_get(self, keys):
+        # The items for each of the keys, in the same order (None for any not found, or not read)
+        found = {}
+        # BatchGetItem won't take the same key twice
+        unique = list({self.get_key(key): key for key in keys}.values())
+        for start in range(0, len(unique), self.batch_get_size):
+            request_keys = [{name: _convert_to_dynamodb(value) for (name, value) in key.items()}
+                            for key in unique[start:start + self.batch_get_size]]
+            delay = 0.05
+            for attempt in range(self.batch_get_attempts):
+                try:
+                    response = self.dynamodb.batch_get_item(RequestItems={self.table: {"Keys": request_keys,
+                                                                                       "ConsistentRead": True}})
+                except Exception as e:
+                    logger.error("%s.batch_get failed: %s" % (self.__class__.__name__, e))
+                    break
+                for item in response.get("Responses", {}).get(self.table, []):
+                    row = _convert_row_from_dynamodb(item)
+                    found[self.get_key(row)] = row
+                request_keys = response.get("UnprocessedKeys", {}).get(self.table, {}).get("Keys", [])
+                if not request_keys:
+                    break
+                # Throttled, so back off before asking for the rest (this is on an offload thread)
+                time.sleep(delay)
+                delay *= 2
+            if request_keys:
+                logger.error("%s.batch_get couldn't read %s keys" % (self.__class__.__name__, len(request_keys)))
+        return [found.get(self.get_key(key), None) for key in keys]
+
+    def batch_write(self, items):
+        # Puts the items, returning any that couldn't be written
+        requests = [{"PutRequest": {"Item": {key: _convert_to_dynamodb(value) for (key, value) in item.items()}}}
+                    for item in items]
+        failed = []
+        for start in range(0, len(requests), self.batch_write_size):
+            chunk = requests[start:start + self.batch_write_size]
+            delay = 0.05
+            for attempt in range(self.batch_write_attempts):
+                try:
+                    response = self.dynamodb.batch_write_item(RequestItems={self.table: chunk})
+                except Exception as e:
+                    logger.error("%s.batch_write failed: %s" % (self.__class__.__name__, e))
+                    break
+                chunk = response.get("UnprocessedItems", {}).get(self.table, [])
+                if not chunk:
+                    break
+                # Throttled, so back off before trying the rest again (this is on an offload thread)
+                time.sleep(delay)
+                delay *= 2
+            failed.extend(_convert_row_from_dynamodb(request.get("PutRequest", {}).get("Item", {}))
+                          for request in chunk)
+        return failed
+
+    def update_item(self, keys, changes, removed=None):
+        # Sets just the changed fields (and removes the removed ones), leaving the rest of the item alone
+        names = {}
+        values = {}
+        clauses = []
+        sets = []
+        for (index, (name, value)) in enumerate(changes.items()):
+            names["#s%s" % index] = name
+            values[":s%s" % index] = _convert_to_dynamodb(value)
+            sets.append("#s%s = :s%s" % (index, index))
+        if sets:
+            clauses.append("SET " + ", ".join(sets))
+
+        removes = []
+        for (index, name) in enumerate(removed or []):
+            names["#r%s" % index] = name
+            removes.append("#r%s" % index)
+        if removes:
+            clauses.append("REMOVE " + ", ".join(removes))
+
+        if not clauses:
+            return True
+
+        request = {
+            "TableName": self.table,
+            "Key": {key: _convert_to_dynamodb(value) for (key, value) in keys.items()},
+            "UpdateExpression": " ".join(clauses),
+            "ExpressionAttributeNames": names,
+        }
+        if values:
+            request["ExpressionAttributeValues"] = values
 
         try:
-            for page in paginator.paginate(TableName=self.table):
-                items.extend(page.get("Items", []))
-            return items
+            self.dynamodb.update_item(**request)
+            return True
         except Exception as e:
-            logger.error("%s.get_all failed: %s" % (self.__class__.__name__, e))
-            return []
\ No newline at end of file
+            logger.error("%s.update_item failed: %s" % (self.__class__.__name__, e))
+            return False
+
+    def scan_page(self, segment=0, total_segments=1, projection=None, start_key=None):
+        # One page of one segment of a scan, with just the attributes in projection (if given).  Returns the
+        # rows, and the key to start the next page from (None at the end of the segment).
+        request = {"TableName": self.table}
+        if total_segments > 1:
+            request["Segment"] = segment
+            request["TotalSegments"] = total_segments
+        if projection:
+            names = {"#p%s" % index: name for (index, name) in enumerate(projection)}
+            request["ProjectionExpression"] = ", ".join(sorted(names.keys()))
+            request["ExpressionAttributeNames"] = names
+        if start_key:
+            request["ExclusiveStartKey"] = start_key
+        if self.scan_page_size:
+            request["Limit"] = self.scan_page_size
+
+        response = self.dynamodb.scan(**request)
+        rows = [_convert_row_from_dynamodb(item) for item in response.get("Items", [])]
+        return (rows, response.get("LastEvaluatedKey", None))
\ No newline at end of file
@@ -1,30 +1,18 @@
 import logging
 import stackless
 
+from HavokMud.metrics import metrics
+from HavokMud.offload import offload_executor
 from HavokMud.utils import log_call
 
 logger = logging.getLogger(__name__)
 
-
-class DatabaseRequest(object):
-    def __init__(self, table_name, command, *args, **kwargs):
-        self.table_name = table_name
-        self.command = command
-        self.args = list(args)
-        self.kwargs = dict(kwargs)
-        self.response_channel = stackless.channel()
-
-
 database_handler = None
 
 
 class DatabaseHandler(object):
     table_map = {}
 
-    def __init__(self):
-        self.in_channel = stackless.channel()
-        stackless.tasklet(self.handler_loop)()
-
     @staticmethod
     def get_handler():
         global database_handler
@@ -36,30 +24,77 @@ class DatabaseHandler(object):
         self.table_map[instance.table] = instance
         instance.handler = self
 
-    def handler_loop(self):
-        while True:
-            item = self.in_channel.receive()
-            stackless.tasklet(self.database_tasklet)(item)
-
-    def database_tasklet(self, item):
-        logger.debug("Item: %s" % item.__dict__)
-        response_channel = item.response_channel
-        table_name = item.table_name
-        response = None
-        if table_name:
-            db = self.table_map.get(table_name, None)
-            if db:
-                func = getattr(db, item.command, None)
-                if func and hasattr(func, "__call__"):
-                    # logger.debug("Func: %s, args: %s, kwargs: %s" % (func, item.args, item.kwargs))
-                    response = func(*item.args, **item.kwargs)
-
-        logger.debug("Response: %s" % response)
-        response_channel.send(response)
-
     @log_call(censor=["all_args", "!1", "!2", "all_kwargs"])
     def send_request(self, table_name, command, *args, **kwargs):
-        request = DatabaseRequest(table_name, command, *args, **kwargs)
-        self.in_channel.send(request)
-        response = request.response_channel.receive()
+        with metrics.timer("db.%s.%s" % (table_name, command)):
+            db = self.table_map.get(table_name, None) if table_name else None
+            func = getattr(db, command, None) if db else None
+            if not func or not hasattr(func, "__call__"):
+                return None
+            # boto3 blocks, so it's run on the offload threads
+            response = offload_executor.run("db", func, *args, **kwargs)
+        logger.debug("Response: %s" % (response,))
         return response
+
+    def scan(self, table_name, projection=None, segments=None):
+        # Yields every row in the table, a page at a time.  The segments are read in parallel (each page on
+        # an offload thread), and none of them gets more than a page ahead of whoever is reading.
+        db = self.table_map.get(table_name, None)
+        if not db:
+            return
+        segments = max(segments or db.scan_segments, 1)
+        channel = stackless.channel()
+        stopped = []
+
+        def read_segment(segment):
+            start_key = None
+            try:
+                while not stopped:
+                    (rows, start_key) = self.send_request(table_name, "scan_page", segment, segments, projection,
+                                                          start_key)
+                    if rows:
+                        channel.send((rows, None))
+                    if not start_key:
+                        break
+            except Exception as e:
+                logger.error("Scan of %s (segment %s) failed: %s" % (table_name, segment, e))
+                channel.send((None, e))
+                return
+            channel.send((None, None))
+
+        for segment in range(segments):
+            stackless.tasklet(read_segment)(segment)
+
+        running = segments
+        try:
+            while running:
+                (rows, error) = channel.receive()
+                if rows is None:
+                    running -= 1
+                    if error is not None:
+                        raise error
+                    continue
+                yield rows
+        finally:
+            # Let the other segments finish, if the caller stopped early (or one failed)
+            stopped.append(True)
+            while running:
+                (rows, error) = channel.receive()
+                if rows is None:
+                    running -= 1
+
+    def invalidate(self, table_name, keys):
+        # Another worker has written these items
+        db = self.table_map.get(table_name, None)
+        if not db:
+            return
+        for key in keys:
+            db.cache.invalidate(tuple(key))
+
+    def format_cache_stats(self):
+        lines = ["%-24s %7s %9s %8s %9s %8s %8s" % ("Table", "Cached", "Hits", "Misses", "Coalesced", "Expired",
+                                                   "Evicted"),
+                 "-" * 79]
+        for (table_name, db) in sorted(self.table_map.items()):
+            lines.append(db.cache.format_stats())
+        return lines
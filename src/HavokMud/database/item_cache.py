@@ -0,0 +1,168 @@
+import logging
+import stackless
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+logger = logging.getLogger(__name__)
+
+
+def copy_item(item):
+    # Most fields are strings and numbers, so only the nested ones need copying in full
+    if not item:
+        return item
+    return {name: deepcopy(value) if isinstance(value, (dict, list, set)) else value
+            for (name, value) in item.items()}
+
+
+class ItemCache(object):
+    """
+    A read-through cache of the items read from (or saved to) a table, by their keys, so looking the same
+    thing up again (a reconnect, another tasklet wanting the same account) doesn't go back to DynamoDB.
+    Items are kept for up to dynamodb.cache_ttl seconds, and the least recently used go once there are more
+    than dynamodb.cache_size.  If several tasklets want an item that isn't there, only the first reads it
+    and the rest wait for that.
+
+    Saving an object replaces its item here straight away (even before the write goes out), and once it's
+    been written, the other workers are told to drop their copies.  Items that weren't found aren't kept,
+    as a failed read looks the same.
+
+    This is not an identity map: each caller gets its own copy of the item, and builds its own object from
+    it, so two sessions that load the same record still hold separate objects, and the last one saved wins.
+    Handing out one shared object instead would mean sharing the connection and session state kept on
+    Account and Player objects, and the other workers would still have objects of their own, so keeping
+    the copies from diverging needs locking or conditional writes and is left out of this.
+    """
+
+    def __init__(self, table, ttl=60.0, max_size=10000):
+        self.table = table
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expiry, item), least recently used first
+        self.entries = OrderedDict()
+        # key -> channels of the tasklets waiting for the read already going
+        self.loading = {}
+        # Keys invalidated while being read, so what's read isn't kept
+        self.discard = set()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "expired": 0,
+            "evicted": 0,
+        }
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, key, loader):
+        # The item with this key, from loader() if it's not here
+        if not self.enabled:
+            return loader()
+
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            (expiry, item) = entry
+            if expiry > time.monotonic():
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return copy_item(item)
+            del self.entries[key]
+            self.stats["expired"] += 1
+
+        waiters = self.loading.get(key, None)
+        if waiters is not None:
+            self.stats["coalesced"] += 1
+            channel = stackless.channel()
+            channel.preference = 0
+            waiters.append(channel)
+            (item, exception) = channel.receive()
+            if exception is not None:
+                raise exception
+            return copy_item(item)
+
+        self.stats["misses"] += 1
+        waiters = []
+        self.loading[key] = waiters
+        item = None
+        exception = None
+        try:
+            item = loader()
+        except Exception as e:
+            exception = e
+        finally:
+            del self.loading[key]
+
+        if key in self.discard:
+            self.discard.discard(key)
+        elif item and exception is None and key not in self.entries:
+            # (If it was saved while this was reading, that's newer)
+            self.store(key, item)
+
+        for channel in waiters:
+            if channel.balance < 0:
+                channel.send((item, exception))
+        if exception is not None:
+            raise exception
+        return copy_item(item)
+
+    def get_many(self, keys, loader):
+        # As get, for several keys at once, with loader(keys) reading all of those that aren't here in one go
+        # (and giving back their items in the same order)
+        if not self.enabled:
+            return loader(keys)
+
+        results = {}
+        missing = []
+        missing_keys = set()
+        now = time.monotonic()
+        for key in keys:
+            if key in results or key in missing_keys:
+                continue
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                (expiry, item) = entry
+                if expiry > now:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    results[key] = item
+                    continue
+                del self.entries[key]
+                self.stats["expired"] += 1
+            missing.append(key)
+            missing_keys.add(key)
+
+        if missing:
+            self.stats["misses"] += len(missing)
+            for (key, item) in zip(missing, loader(missing)):
+                results[key] = item
+                if item and key not in self.entries and key not in self.loading:
+                    self.store(key, item)
+        return [copy_item(results.get(key, None)) for key in keys]
+
+    def put(self, key, item):
+        # item must not be changed afterwards by the caller
+        if not self.enabled:
+            return
+        self.entries.pop(key, None)
+        self.store(key, item)
+
+    def store(self, key, item):
+        self.entries[key] = (time.monotonic() + self.ttl, item)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        if key in self.loading:
+            self.discard.add(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.discard.update(self.loading.keys())
+
+    def format_stats(self):
+        stats = dict(self.stats, table=self.table, size=len(self.entries))
+        return "%(table)-24s %(size)7d %(hits)9d %(misses)8d %(coalesced)9d %(expired)8d %(evicted)8d" % stats
@@ -1,20 +1,36 @@
 import logging
 from copy import deepcopy, copy
 
+from HavokMud.database.base import _convert_to_dynamodb, _convert_row_from_dynamodb
+from HavokMud.writebehind import write_behind
+
 logger = logging.getLogger(__name__)
 
+# Never written to the database, whatever the class
+INTERNAL_FIELDS = frozenset(["__fixed_fields__", "__database__", "__real_class__", "__saved__", "server"])
+
+fixed_field_sets = {}
+
 
 class DatabaseObject(object):
     __fixed_fields__ = []
     __database__ = None
     __real_class__ = None
+    # The item as it was last loaded or saved (converted for DynamoDB), to see what's changed since
+    __saved__ = None
 
     def __init__(self):
         from HavokMud.startup import server_instance
-        self.__fixed_fields__.extend(["__fixed_fields__", "__database__", "__real_class__"])
         self.__real_class__ = self.__class__
         self.server = server_instance
 
+    def get_fixed_fields(self):
+        fields = fixed_field_sets.get(self.__class__, None)
+        if fields is None:
+            fields = frozenset(self.__fixed_fields__) | INTERNAL_FIELDS
+            fixed_field_sets[self.__class__] = fields
+        return fields
+
     def __setattr__(self, name, value):
         self.__dict__[name] = value
 
@@ -23,11 +39,12 @@ class DatabaseObject(object):
 
     # noinspection PyTypeChecker
     def to_dict(self):
-        return dict(filter(lambda x: x[0] not in self.__fixed_fields__, self.__dict__.items()))
+        fixed_fields = self.get_fixed_fields()
+        return dict(filter(lambda x: x[0] not in fixed_fields, self.__dict__.items()))
 
     def from_dict(self, newdata):
         # logger.debug("new data: %s" % newdata)
-        fixed_fields = set(self.__fixed_fields__)
+        fixed_fields = self.get_fixed_fields()
         newdata = dict(filter(lambda x: x[0] not in fixed_fields, newdata.items()))
         # logger.debug("new data: %s" % newdata)
         oldfields = set(self.__dict__.keys())
@@ -52,20 +69,92 @@ class DatabaseObject(object):
             raise ValueError("Database not defined in class %s" % self.__class__.__name__)
 
         # logger.debug("Dir: %s" % dir(self.__database__))
-        data = self.__database__.handler.send_request(self.__database__.table, "get_item", key)
+        db = self.__database__
+        data = db.cache.get(db.get_key(key), lambda: db.handler.send_request(db.table, "get_item", key))
         self.from_dict(data)
+        self.mark_clean(bool(data))
+
+    def load_many(self, keys):
+        # The objects for each of the keys (dicts, as for load_from_db), in the same order, with None for
+        # any that aren't there.  Whatever isn't cached is read with BatchGetItem.
+        if not self.__database__:
+            raise ValueError("Database not defined in class %s" % self.__class__.__name__)
+
+        db = self.__database__
+        cache_keys = [db.get_key(key) for key in keys]
+        key_map = dict(zip(cache_keys, keys))
+        rows = db.cache.get_many(cache_keys, lambda missing: db.handler.send_request(
+            db.table, "batch_get", [key_map[key] for key in missing]))
+
+        items = []
+        for row in rows:
+            if not row:
+                items.append(None)
+                continue
+            item = self.from_dict(row)
+            item.mark_clean()
+            items.append(item)
+        return items
 
     def save_to_db(self):
         if not self.__database__:
             raise ValueError("Database not defined in class %s" % self.__class__.__name__)
 
-        self.__database__.handler.send_request(self.__database__.table, "put_item", self.to_dict())
+        # Anyone looking it up from now on gets it as saved, even before it's written
+        db = self.__database__
+        item = _convert_row_from_dynamodb(self.snapshot())
+        if self.__saved__ is not None:
+            old_key = db.get_key(_convert_row_from_dynamodb(self.__saved__))
+            if old_key != db.get_key(item):
+                db.cache.invalidate(old_key)
+        db.cache.put(db.get_key(item), item)
+
+        # Written out a little later (see writebehind), along with anything else saved in the meantime
+        write_behind.save(self)
+
+    def flush_to_db(self):
+        # Writes it now if a save is still waiting to go out
+        write_behind.flush([self])
+
+    def snapshot(self):
+        return {key: _convert_to_dynamodb(value) for (key, value) in self.to_dict().items()}
+
+    def mark_clean(self, stored=True):
+        # Nothing's changed since it was read from (or written to) the table.  If it isn't in the table,
+        # the next save puts the whole item.
+        self.__saved__ = self.snapshot() if stored else None
+
+    def prepare_write(self):
+        # What needs writing: None if nothing's changed, otherwise (data, changes, removed), with changes
+        # of None if the whole item needs putting.  It's taken as written from here on.
+        data = self.to_dict()
+        current = {key: _convert_to_dynamodb(value) for (key, value) in data.items()}
+        saved = self.__saved__
+        self.__saved__ = current
+        key_names = self.__database__.get_key_names()
+        if saved is None or any(saved.get(name) != current.get(name) for name in key_names):
+            return (data, None, None)
+
+        changes = {key: data[key] for (key, value) in current.items() if saved.get(key) != value}
+        removed = [key for key in saved.keys() if key not in current]
+        if not changes and not removed:
+            return None
+        return (data, changes, removed)
+
+    def get_all(self, projection=None):
+        return list(self.iter_all(projection))
 
-    def get_all(self):
+    def iter_all(self, projection=None):
+        # Every item in the table, as the scan reads them.  With a projection, only those attributes are
+        # read, so only those fields can be relied on (and saving one only writes what's changed).
         if not self.__database__:
             raise ValueError("Database not defined in class %s" % self.__class__.__name__)
 
-        rows = self.__database__.handler.send_request(self.__database__.table, "get_all")
-        # logger.debug("rows: %s" % rows)
-        # logger.debug("self: %s (%s)" % (self, self.__dict__))
-        return [self.from_dict(row) for row in rows if row]
+        for rows in self.__database__.handler.scan(self.__database__.table, projection):
+            # logger.debug("rows: %s" % rows)
+            for row in rows:
+                if not row:
+                    continue
+                item = self.from_dict(row)
+                item.mark_clean()
+                yield item
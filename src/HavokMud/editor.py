@@ -48,7 +48,7 @@ class Editor(object):
             self.file_.write(initial_contents)
             self.file_.flush()
             self.file_.seek(0)
-        command += self.file_.name
+        command = command + [self.file_.name]
         self.connection.handler = ExternalHandler(self.connection, command, self.channel,
                                                   self.handler_callback, self.editor_callback)
 
@@ -8,6 +8,8 @@ from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
 from botocore.exceptions import ClientError
 
+from HavokMud.offload import offload_executor
+
 logger = logging.getLogger(__name__)
 
 
@@ -30,7 +32,8 @@ class EncryptionEngine(object):
         privatekey = None
         while privatekey is None:
             try:
-                response = self.smclient.get_secret_value(SecretId=mudname + "-core")
+                response = offload_executor.run("secrets", self.smclient.get_secret_value,
+                                                SecretId=mudname + "-core")
             except Exception as e:
                 logger.exception("Ouch.  No bueno!")
                 response = {}
@@ -54,7 +57,7 @@ class EncryptionEngine(object):
                     "SecretString": privatekey.export_key("PEM").decode("utf-8"),
                 }
                 try:
-                    self.smclient.create_secret(**params)
+                    offload_executor.run("secrets", self.smclient.create_secret, **params)
                 except (self.smclient.exceptions.ResourceExistsException, ClientError):
                     # Hmm, seems it told us a lie, it's already set, so try again
                     logger.info("Retrying, seems it already IS there")
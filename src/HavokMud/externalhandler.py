@@ -1,8 +1,9 @@
 import logging
+import os
 import stackless
-import subprocess
 
 from HavokMud.basehandler import BaseHandler
+from HavokMud.childwatcher import child_watcher, ChildWatcherError
 
 logger = logging.getLogger(__name__)
 
@@ -16,12 +17,13 @@ class ExternalHandler(BaseHandler):
         self.command = command
         self.old_handler = connection.handler
         self.sock_fd = connection.client_socket
-        self.proc = None
+        self.child = None
         self.channel = channel
         if callback is None:
             callback = self.default_callback
         self.handler_callback = callback
         self.editor_callback = editor_callback
+        self.time_limit = self.server.config.get("external", {}).get("time_limit", 1800)
 
     def send_prompt(self, prompt):
         pass
@@ -30,23 +32,70 @@ class ExternalHandler(BaseHandler):
         pass
 
     def launch_external_command(self):
+        if not self.connection.supports_external:
+            self.append_line("Sorry, that isn't available from this client.")
+            stackless.tasklet(self.channel.send)(None)
+            return
+
+        if child_watcher.running() >= child_watcher.max_children:
+            self.append_line("Too many external sessions are running, please try again later.")
+            stackless.tasklet(self.channel.send)(None)
+            return
+
+        # The external command writes to the socket directly, so it can't be compressed
+        self.connection.suspend_compression()
         # turn off echo
-        self.sock_fd.send(b'\xff\xfb\x01')
+        self.connection.write_raw(b'\xff\xfb\x01')
         # turn on linemode negotiation
-        self.sock_fd.send(b'\xff\xfd\x22')
+        self.connection.write_raw(b'\xff\xfd\x22')
         # tell the client to go into non-edit mode (character mode)
-        self.sock_fd.send(b'\xff\xfa\x22\x01\x00\xff\xf0')
+        self.connection.write_raw(b'\xff\xfa\x22\x01\x00\xff\xf0')
+        if not self.connection.wait_for_output(self.connection.kick_timeout):
+            # They've stopped reading, so don't tie up an external session (or this tasklet) for them
+            logger.warning("Output didn't drain, not launching %s" % self.command)
+            self.restore_connection()
+            self.append_line("Sorry, that isn't available right now.")
+            stackless.tasklet(self.channel.send)(None)
+            return
+        # Leave the input for the command, and hold back any output until it's done
+        self.connection.suspend_io()
+        # The reactor keeps the socket non-blocking, but the command expects an ordinary one.  Nothing else
+        # touches it until restore_connection.
+        self.set_socket_blocking(True)
+
+        try:
+            self.child = child_watcher.launch(self.command, time_limit=self.time_limit, stdin=self.sock_fd,
+                                              stdout=self.sock_fd)
+        except (ChildWatcherError, OSError) as e:
+            logger.error("Couldn't launch %s: %s" % (self.command, e))
+            self.restore_connection()
+            self.append_line("Sorry, that isn't available right now.")
+            stackless.tasklet(self.channel.send)(None)
+            return
 
-        self.proc = subprocess.Popen(self.command, stdin=self.sock_fd, stdout=self.sock_fd)
         stackless.tasklet(self.communicate)()
 
     def communicate(self):
-        self.proc.communicate()
-        # Turn back on echo
-        self.sock_fd.send(b'\xff\xfc\x01')
-        # Tell the client to go back into edit mode (line mode) and to echo literally
-        self.sock_fd.send(b'\xff\xfa\x22\x01\x11\xff\xf0')
+        # Only this tasklet waits for the command to exit
+        child_watcher.wait(self.child)
+        self.restore_connection()
+        if self.child.timed_out:
+            self.append_line("Your session ran out of time.")
         self.channel.send(None)
 
+    def set_socket_blocking(self, blocking):
+        try:
+            os.set_blocking(self.sock_fd.fileno(), blocking)
+        except OSError as e:
+            # Already closed, the read tasklet will notice
+            logger.debug("Couldn't change blocking mode of %s: %s" % (self.sock_fd, e))
+
+    def restore_connection(self):
+        self.set_socket_blocking(False)
+        # Turn back on echo, tell the client to go back into edit mode (line mode) and to echo literally,
+        # ahead of anything that was held back
+        self.connection.resume_io(b'\xff\xfc\x01', b'\xff\xfa\x22\x01\x11\xff\xf0')
+        self.connection.resume_compression()
+
     def default_callback(self):
         self.channel.receive()
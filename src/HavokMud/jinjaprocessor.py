@@ -1,51 +1,69 @@
-import stackless
+import logging
+import os
 
-from jinja2 import Environment, PackageLoader
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache, TemplateError
 
+from HavokMud.metrics import metrics
 
-class JinjaRequest(object):
-    def __init__(self, data):
-        self.data = data
-        self.channel = stackless.channel()
+logger = logging.getLogger(__name__)
 
 
 class JinjaProcessor(object):
+    """
+    Renders templates inline, in the calling tasklet (rendering doesn't block on anything).  The templates
+    are compiled once at startup, with the bytecode cached on disk so restarts don't have to compile them
+    again, and the compiled templates are kept here rather than looked up for every render.
+    """
+
     def __init__(self):
-        self.in_channel = stackless.channel()
+        self.templates = {}
         self.environment = Environment(
             loader=PackageLoader("HavokMud", "templates"),
             autoescape=False,
             newline_sequence="\r\n",
             keep_trailing_newline=True,
+            auto_reload=False,
         )
 
-        stackless.tasklet(self.process_data)()
-
-    def process_data(self):
-        while True:
-            request = self.in_channel.receive()
-            if not isinstance(request, JinjaRequest):
-                continue
+    def configure(self, config):
+        # Must be called before precompile()
+        cache_dir = config.get("mud", {}).get("template_cache_dir", None)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.environment.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        else:
+            # Uses a directory under the system temp directory
+            self.environment.bytecode_cache = FileSystemBytecodeCache()
 
-            out_channel = request.channel
-            if not out_channel:
-                continue
+    def precompile(self):
+        for template_name in self.environment.list_templates():
+            try:
+                self.get_template(template_name)
+            except TemplateError as e:
+                # It will fail again (with the same error) if anything tries to use it
+                logger.error("Couldn't compile template %s: %s" % (template_name, e))
+        logger.info("Precompiled %s templates" % len(self.templates))
 
-            data = request.data
-            template_name = data.get("template", None)
-            params = data.get("params", {})
-
-            if template_name:
-                template = self.environment.get_template(template_name)
-                out_data = template.render(**params)
-            else:
-                out_data = ""
-            out_channel.send(out_data)
+    def get_template(self, template_name):
+        template = self.templates.get(template_name, None)
+        if template is None:
+            template = self.environment.get_template(template_name)
+            self.templates[template_name] = template
+        return template
 
     def process(self, data):
-        request = JinjaRequest(data)
-        self.in_channel.send(request)
-        return request.channel.receive()
+        template_name = data.get("template", None)
+        if not template_name:
+            return ""
+        with metrics.timer("template.%s" % template_name):
+            return self.get_template(template_name).render(**data.get("params", {}))
+
+    def generate(self, data):
+        # Yields the output a piece at a time, for pages too big to want rendered all at once
+        template_name = data.get("template", None)
+        if not template_name:
+            return iter([])
+        return self.get_template(template_name).generate(**data.get("params", {}))
 
 
 jinja_processor = JinjaProcessor()
@@ -0,0 +1,79 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+LF = 0x0A
+CR = 0x0D
+BS = 0x08
+DEL = 0x7F
+
+
+class LineBuffer(object):
+    """
+    Assembles incoming bytes into lines.  Only the newly received data is scanned for line endings,
+    and any line longer than max_line_length is truncated (the rest of it is discarded as it arrives)
+    so a client that never sends a newline can't grow the buffer without limit.  Complete lines are
+    truncated the same way as they're split out.
+    """
+
+    def __init__(self, max_line_length=2048):
+        self.max_line_length = max_line_length
+        self.buffer = bytearray()
+        self.discarding = False
+
+    def feed(self, data):
+        if self.discarding:
+            end = data.find(b"\n")
+            if end == -1:
+                return []
+            # Keep the newline to terminate the truncated line
+            data = data[end:]
+            self.discarding = False
+
+        buffer = self.buffer
+        # Anything already in the buffer has no newline in it
+        index = len(buffer)
+        buffer += data
+
+        lines = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", index)
+            if end == -1:
+                break
+
+            line_end = end
+            if line_end > start and buffer[line_end - 1] == CR:
+                line_end -= 1
+            if line_end - start > self.max_line_length:
+                # A whole line arriving at once is held to the same limit
+                logger.debug("Truncating overlong line (%s bytes)" % (line_end - start))
+                line_end = start + self.max_line_length
+            lines.append(self.apply_editing(buffer[start:line_end]))
+            start = end + 1
+            index = start
+
+        if start:
+            del buffer[:start]
+
+        if len(buffer) > self.max_line_length:
+            logger.debug("Truncating overlong line (%s bytes)" % len(buffer))
+            del buffer[self.max_line_length:]
+            self.discarding = True
+
+        return lines
+
+    @staticmethod
+    def apply_editing(line):
+        # Deal with any backspaces (or deletes) in one pass
+        if BS not in line and DEL not in line:
+            return bytes(line)
+
+        output = bytearray()
+        for byte in line:
+            if byte == BS or byte == DEL:
+                if output:
+                    output.pop()
+            else:
+                output.append(byte)
+        return bytes(output)
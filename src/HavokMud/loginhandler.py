@@ -1,4 +1,5 @@
 import logging
+import stackless
 import uuid
 
 from HavokMud.basehandler import BaseHandler
@@ -9,16 +10,40 @@ logger = logging.getLogger(__name__)
 
 
 class LoginHandler(BaseHandler):
+    # Input in these states does database lookups, password checks and the like, so it costs more of the
+    # connection's command allowance
+    state_costs = {
+        "get_email": 2,
+        "get_password": 3,
+        "enter_confirm_code": 3,
+        "choose_name": 2,
+        "show_creation_menu": 2,
+    }
+
     def __init__(self, connection):
         BaseHandler.__init__(self, connection)
         self.tokens = None
         self.state = "initial"
         self.fsm = LoginStateMachine(self)
 
+        # Half-open logins tie up a socket and memory, so they only get so long to finish
+        login_timeout = self.server.config.get("connection", {}).get("login_timeout", 120)
+        if login_timeout:
+            connection.set_timer("login", login_timeout, self.on_login_timeout)
+
+    def on_login_timeout(self):
+        stackless.tasklet(self.connection.kick)("Login timed out.  Goodbye.", "login timeout")
+
+    def cancel_login_timeout(self):
+        self.connection.cancel_timer("login")
+
     def send_prompt(self, prompt):
         if self.state == "initial":
             self.fsm.go_to_get_email()
 
+    def command_cost(self, tokens):
+        return self.state_costs.get(self.state, 1)
+
     def handle_input(self, tokens):
         self.tokens = tokens
         try:
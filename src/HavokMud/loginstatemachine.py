@@ -7,6 +7,7 @@ from HavokMud.account import Account
 from HavokMud.commandhandler import CommandHandler
 from HavokMud.data_loader import load_data_file
 from HavokMud.logging_support import AccountLogMessage, PlayerLogMessage
+from HavokMud.metrics import metrics
 from HavokMud.player import Player
 from HavokMud.utils import validate_email, validate_yes_no, validate_password, validate_pc_name, validate_sex
 
@@ -88,7 +89,8 @@ class LoginStateMachine(StateMachine):
         if not func or not hasattr(func, "__call__"):
             raise ValueError("No handler for state %s" % self.current_state_value)
 
-        return func()
+        with metrics.timer("login.%s" % self.current_state_value):
+            return func()
 
     def on_initial(self):
         return self.get_email
@@ -499,7 +501,8 @@ class LoginStateMachine(StateMachine):
 
     def on_enter_show_player_list(self):
         self.append_output({"template": "account_player_list.jinja",
-                            "params": {"server": self.model.server, "account": self.model.account}})
+                            "params": {"server": self.model.server, "account": self.model.account,
+                                       "players": self.model.account.get_players()}})
 
     def on_enter_get_new_password(self):
         self.append_output("Please enter new password: ")
@@ -567,6 +570,7 @@ class LoginStateMachine(StateMachine):
 
     def on_enter_playing(self):
         # TODO: ask which player and launch that one
-        self.model.account.current_player = Player.lookup_by_name(self.model.account.players[0])
+        self.model.account.current_player = Player.lookup_by_name(self.model.account, self.model.account.players[0])
         self.model.player = self.model.account.current_player
+        self.model.cancel_login_timeout()
         self.model.connection.handler = CommandHandler(self.model.connection)
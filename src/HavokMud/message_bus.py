@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import socket
+import stackless
+
+logger = logging.getLogger(__name__)
+
+
+class MessageBus(object):
+    """
+    A local message bus between the worker processes on this host.  Each worker binds a unix datagram
+    socket in bus_dir, and publishing a message sends it to every other worker's socket.  Subscribers
+    are called with (worker_id, message) from the bus tasklet, for messages from other workers only.
+    Each message has to fit in one datagram, so anything that can grow (like the list of users) has to
+    be split up by the publisher.
+    """
+    # Datagrams are read into a buffer this big, so anything longer would arrive cut off
+    max_message_size = 65535
+
+    def __init__(self, config, worker_id, workers):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.bus_dir = config.get("mud", {}).get("bus_dir", "/tmp/havokmud-bus")
+        self.subscribers = {}
+
+        os.makedirs(self.bus_dir, exist_ok=True)
+        path = self.get_path(worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.socket.settimeout(None)
+
+        stackless.tasklet(self.receive_loop)()
+
+    def get_path(self, worker_id):
+        return os.path.join(self.bus_dir, "worker-%s.sock" % worker_id)
+
+    def subscribe(self, topic, callback):
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, message, worker_id=None):
+        # Send to one worker if worker_id is given, otherwise to all the others
+        payload = json.dumps({"topic": topic, "worker": self.worker_id, "message": message}).encode("utf-8")
+        if len(payload) > self.max_message_size:
+            logger.warning("Not publishing %s, it's too big for the bus (%s bytes)" % (topic, len(payload)))
+            return
+
+        if worker_id is None:
+            targets = [item for item in range(self.workers) if item != self.worker_id]
+        else:
+            targets = [worker_id]
+
+        for target in targets:
+            try:
+                self.socket.sendto(payload, 0, self.get_path(target))
+            except OSError as e:
+                # That worker isn't up (yet)
+                logger.debug("Could not publish %s to worker %s: %s" % (topic, target, e))
+
+    def receive_loop(self):
+        while True:
+            try:
+                (data, address) = self.socket.recvfrom(self.max_message_size)
+            except OSError as e:
+                # The socket's been closed (or broken), so there's nothing more coming
+                logger.error("Message bus stopped: %s" % e)
+                break
+
+            try:
+                payload = json.loads(data.decode("utf-8"))
+            except ValueError as e:
+                logger.error("Bad message on bus: %s" % e)
+                continue
+
+            topic = payload.get("topic", None)
+            for callback in self.subscribers.get(topic, []):
+                try:
+                    callback(payload.get("worker", None), payload.get("message", None))
+                except Exception:
+                    logger.exception("Exception handling %s message" % topic)
@@ -0,0 +1,259 @@
+import json
+import logging
+import math
+import socket
+import stackless
+import time
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Each power of two is split into this many buckets, so a recorded value is out by at most about 3%
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+# Values are in microseconds, and anything over this (about 19 hours) is counted as this
+MAX_VALUE = (1 << 36) - 1
+
+
+def bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (value >> shift)
+
+
+def bucket_value(index):
+    # The middle of the range of values that land in the bucket
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = (index >> (SUB_BUCKET_BITS - 1)) - 1
+    mantissa = (index & (SUB_BUCKET_HALF - 1)) + SUB_BUCKET_HALF
+    return (mantissa << shift) + ((1 << shift) >> 1)
+
+
+class Histogram(object):
+    """
+    A log-linear (HDR style) histogram of durations, recorded in microseconds.  Recording is a couple
+    of integer operations and a list increment, with no locks: each process keeps its own, and tasklets
+    don't switch in the middle of one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (bucket_index(MAX_VALUE) + 1)
+        self.reset()
+
+    def reset(self):
+        for index in range(len(self.counts)):
+            self.counts[index] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.started = time.time()
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value > MAX_VALUE:
+            value = MAX_VALUE
+        elif value < 0:
+            value = 0
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentiles(self, *percents):
+        # In microseconds, for each percentage asked for (in increasing order)
+        results = []
+        if not self.count:
+            return [0 for percent in percents]
+
+        targets = [max(1, math.ceil(self.count * percent / 100.0)) for percent in percents]
+        seen = 0
+        target_index = 0
+        for (index, count) in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            while target_index < len(targets) and seen >= targets[target_index]:
+                results.append(min(bucket_value(index), self.max))
+                target_index += 1
+            if target_index == len(targets):
+                break
+        return results
+
+    def snapshot(self):
+        (p50, p90, p99) = self.percentiles(50, 90, 99)
+        return {
+            "name": self.name,
+            "count": self.count,
+            "mean_ms": (self.total / self.count / 1000.0) if self.count else 0.0,
+            "p50_ms": p50 / 1000.0,
+            "p90_ms": p90 / 1000.0,
+            "p99_ms": p99 / 1000.0,
+            "max_ms": self.max / 1000.0,
+            "since": self.started,
+        }
+
+
+class Timer(object):
+    __slots__ = ["histogram", "start"]
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.record(time.perf_counter() - self.start)
+        return False
+
+
+class Metrics(object):
+    """
+    The histograms for this process, by name.  Names are dotted, with the kind of thing first
+    (command.look, login.get_password, db.accounts.get_item, api.wallet.create, template.motd.jinja).
+    """
+
+    def __init__(self):
+        self.histograms = {}
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name, None)
+        if histogram is None:
+            histogram = Histogram(name)
+            self.histograms[name] = histogram
+        return histogram
+
+    def record(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def timer(self, name):
+        # with metrics.timer("db.accounts.get_item"): ...
+        return Timer(self.histogram(name))
+
+    def reset(self, prefix=""):
+        for (name, histogram) in self.histograms.items():
+            if name.startswith(prefix):
+                histogram.reset()
+
+    def report(self, prefix=""):
+        return [histogram.snapshot() for (name, histogram) in sorted(self.histograms.items())
+                if name.startswith(prefix) and histogram.count]
+
+    def format_report(self, prefix=""):
+        lines = ["%-40s %8s %9s %9s %9s %9s" % ("Name", "Count", "p50 (ms)", "p90 (ms)", "p99 (ms)", "Max (ms)"),
+                 "-" * 89]
+        for item in self.report(prefix):
+            lines.append("%-40s %8d %9.2f %9.2f %9.2f %9.2f" % (item["name"][:40], item["count"], item["p50_ms"],
+                                                               item["p90_ms"], item["p99_ms"], item["max_ms"]))
+        return lines
+
+
+metrics = Metrics()
+
+
+def timed(name):
+    # Decorator recording how long each call takes in the named histogram
+    def decorator(func):
+        histogram = metrics.histogram(name)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsEndpoint(object):
+    """
+    Serves the metrics over HTTP on localhost, as text (GET /) or JSON (GET /json), optionally filtered
+    by a name prefix (GET /json?prefix=db.).  It's only there to be scraped or curled from the same host.
+    Other stats can be served alongside: sections maps a name to (report, format_report) functions, for
+    GET /<name> (text) and GET /<name>/json.
+    """
+
+    def __init__(self, port, bind_ip="127.0.0.1", sections=None):
+        self.port = port
+        self.bind_ip = bind_ip
+        self.sections = sections or {}
+
+    def run(self):
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listen_socket.bind((self.bind_ip, self.port))
+        except OSError as e:
+            logger.error("Couldn't start the metrics endpoint on %s:%s: %s" % (self.bind_ip, self.port, e))
+            return
+        listen_socket.listen(5)
+        logger.info("Metrics on http://%s:%s/" % (self.bind_ip, self.port))
+
+        while True:
+            try:
+                (client_socket, client_address) = listen_socket.accept()
+            except OSError as e:
+                logger.error("Metrics endpoint failed: %s" % e)
+                break
+            stackless.tasklet(self.handle_request)(client_socket)
+
+    def handle_request(self, client_socket):
+        try:
+            client_socket.settimeout(5)
+            data = b""
+            while b"\r\n\r\n" not in data and b"\n\n" not in data and len(data) < 8192:
+                chunk = client_socket.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+
+            request_line = data.split(b"\n", 1)[0].decode("latin-1").split()
+            if len(request_line) < 2 or request_line[0] != "GET":
+                self.send_response(client_socket, "405 Method Not Allowed", "text/plain", "GET only\n")
+                return
+
+            (path, _, query) = request_line[1].partition("?")
+            prefix = ""
+            for param in query.split("&"):
+                (key, _, value) = param.partition("=")
+                if key == "prefix":
+                    prefix = value
+            (section, _, kind) = path.strip("/").partition("/")
+
+            if path == "/json":
+                body = json.dumps(metrics.report(prefix), indent=2) + "\n"
+                self.send_response(client_socket, "200 OK", "application/json", body)
+            elif path == "/":
+                body = "\n".join(metrics.format_report(prefix)) + "\n"
+                self.send_response(client_socket, "200 OK", "text/plain", body)
+            elif section in self.sections and kind in ("", "json"):
+                (report, format_report) = self.sections[section]
+                if kind == "json":
+                    body = json.dumps(report(), indent=2) + "\n"
+                    self.send_response(client_socket, "200 OK", "application/json", body)
+                else:
+                    body = "\n".join(format_report()) + "\n"
+                    self.send_response(client_socket, "200 OK", "text/plain", body)
+            else:
+                self.send_response(client_socket, "404 Not Found", "text/plain", "Not found\n")
+        except (OSError, socket.timeout) as e:
+            logger.debug("Metrics request failed: %s" % e)
+        finally:
+            client_socket.close()
+
+    @staticmethod
+    def send_response(client_socket, status, content_type, body):
+        body = body.encode("utf-8")
+        headers = "HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %s\r\nConnection: close\r\n\r\n" % \
+                  (status, content_type, len(body))
+        client_socket.sendall(headers.encode("latin-1") + body)
@@ -0,0 +1,211 @@
+import logging
+import os
+import queue
+import socket
+import stackless
+import threading
+import time
+from collections import deque
+
+from HavokMud.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OffloadError(Exception):
+    pass
+
+
+class OffloadRequest(object):
+    def __init__(self, service, func, args, kwargs):
+        self.service = service
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.channel = stackless.channel()
+        self.channel.preference = 0
+        self.queued = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.exception = None
+
+
+class OffloadService(object):
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.pending = deque()
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.high_water = 0
+        self.wait_histogram = metrics.histogram("offload.%s.wait" % name)
+        self.run_histogram = metrics.histogram("offload.%s.run" % name)
+
+
+class OffloadExecutor(object):
+    """
+    Runs blocking calls (boto3, redis-py, requests, dnspython) on a pool of threads, so they only hold up
+    the tasklet waiting for them instead of the whole process.  The calling tasklet blocks on a channel;
+    the thread puts the finished request on a queue and writes to a socketpair, which wakes the reactor,
+    and the completion tasklet hands each result back to its tasklet.
+
+    Each service (db, redis, api, email, dns, secrets) has a limit on how many of its calls can be running
+    at once, so one slow backend can't take every thread, and a cap on how many can be waiting.  Sockets
+    made from the pool's threads are ordinary blocking sockets (see stacklesssocket).
+    """
+
+    def __init__(self):
+        self.started = False
+        self.thread_count = 16
+        self.max_queue = 1000
+        self.default_limit = 4
+        self.limits = {}
+        self.services = {}
+        self.threads = []
+        self.work_queue = queue.SimpleQueue()
+        self.completions = deque()
+        self.read_socket = None
+        self.write_socket = None
+        self.write_fd = None
+
+    def configure(self, config):
+        offload_config = config.get("offload", {})
+        self.thread_count = offload_config.get("threads", self.thread_count)
+        self.max_queue = offload_config.get("max_queue", self.max_queue)
+        self.default_limit = offload_config.get("default_limit", self.default_limit)
+        self.limits.update(offload_config.get("limits", {}))
+        for service in self.services.values():
+            service.limit = self.limits.get(service.name, self.default_limit)
+        if self.started:
+            self.start_threads()
+
+    def start(self):
+        if self.started:
+            return
+
+        # Both ends are non-blocking.  The threads write straight to the file descriptor.
+        (self.read_socket, write_socket) = socket.socketpair()
+        self.read_socket.settimeout(None)
+        self.write_socket = write_socket
+        self.write_fd = write_socket.fileno()
+        self.started = True
+        self.start_threads()
+        stackless.tasklet(self.completion_loop)()
+
+    def start_threads(self):
+        while len(self.threads) < self.thread_count:
+            thread = threading.Thread(target=self.worker_loop, name="offload-%s" % len(self.threads), daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def get_service(self, name):
+        service = self.services.get(name, None)
+        if service is None:
+            service = OffloadService(name, self.limits.get(name, self.default_limit))
+            self.services[name] = service
+        return service
+
+    def run(self, service_name, func, *args, **kwargs):
+        # Blocks the calling tasklet until func(*args, **kwargs) has run on one of the threads, and
+        # returns what it returned (or raises what it raised)
+        self.start()
+        service = self.get_service(service_name)
+        if len(service.pending) >= self.max_queue:
+            service.rejected += 1
+            raise OffloadError("Too many %s requests waiting (%s)" % (service_name, len(service.pending)))
+
+        request = OffloadRequest(service, func, args, kwargs)
+        service.submitted += 1
+        if service.active < service.limit:
+            self.dispatch(request)
+        else:
+            service.pending.append(request)
+            service.high_water = max(service.high_water, len(service.pending))
+
+        request.channel.receive()
+        if request.exception is not None:
+            raise request.exception
+        return request.result
+
+    def dispatch(self, request):
+        request.service.active += 1
+        self.work_queue.put(request)
+
+    def worker_loop(self):
+        while True:
+            request = self.work_queue.get()
+            request.started = time.monotonic()
+            try:
+                request.result = request.func(*request.args, **request.kwargs)
+            except Exception as e:
+                request.exception = e
+            request.finished = time.monotonic()
+
+            self.completions.append(request)
+            try:
+                os.write(self.write_fd, b"\0")
+            except BlockingIOError:
+                # The reactor has plenty of wakeups waiting already
+                pass
+            except OSError as e:
+                logger.error("Couldn't wake the reactor: %s" % e)
+
+    def completion_loop(self):
+        while True:
+            try:
+                data = self.read_socket.recv(4096)
+            except OSError as e:
+                logger.error("Offload socket failed: %s" % e)
+                break
+            if not data:
+                break
+
+            while self.completions:
+                request = self.completions.popleft()
+                service = request.service
+                service.active -= 1
+                service.completed += 1
+                if request.exception is not None:
+                    service.errors += 1
+                service.wait_histogram.record(request.started - request.queued)
+                service.run_histogram.record(request.finished - request.started)
+
+                while service.pending and service.active < service.limit:
+                    self.dispatch(service.pending.popleft())
+
+                if request.channel.balance < 0:
+                    request.channel.send(None)
+
+    def busy(self):
+        return sum(service.active + len(service.pending) for service in self.services.values())
+
+    def stats(self):
+        return [{
+            "name": service.name,
+            "limit": service.limit,
+            "active": service.active,
+            "pending": len(service.pending),
+            "high_water": service.high_water,
+            "submitted": service.submitted,
+            "completed": service.completed,
+            "errors": service.errors,
+            "rejected": service.rejected,
+        } for (name, service) in sorted(self.services.items())]
+
+    def format_stats(self):
+        lines = ["%-12s %5s %6s %7s %6s %9s %9s %6s %8s" % ("Service", "Limit", "Active", "Pending", "High",
+                                                          "Submitted", "Completed", "Errors", "Rejected"),
+                 "-" * 80]
+        for item in self.stats():
+            lines.append("%-12s %5d %6d %7d %6d %9d %9d %6d %8d" % (item["name"], item["limit"], item["active"],
+                                                                   item["pending"], item["high_water"],
+                                                                   item["submitted"], item["completed"],
+                                                                   item["errors"], item["rejected"]))
+        return lines
+
+
+offload_executor = OffloadExecutor()
@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class OutputPriority(Enum):
+    # Low priority output (chat, ambient messages) is dropped when a client falls behind
+    Low = 1
+    Normal = 2
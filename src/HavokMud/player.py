@@ -1,4 +1,5 @@
 from HavokMud.database_object import DatabaseObject
+from HavokMud.output_priority import OutputPriority
 from HavokMud.utils import roll_dice
 from HavokMud.wallet import WalletType, Wallet
 
@@ -34,6 +35,14 @@ class Player(DatabaseObject):
             self.wallet_active_key = {}
             self.wallet_keys = {}
 
+    def save_to_db(self):
+        # The table's range key is player_name, the lowercase name.  Until it's been named, there's no key
+        # to save it under.
+        if not self.name:
+            return
+        self.player_name = self.name.lower()
+        DatabaseObject.save_to_db(self)
+
     def set_connection(self, connection):
         if self.connection:
             self.connection.disconnect()
@@ -46,7 +55,7 @@ class Player(DatabaseObject):
         player = Player(account.connection, account)
 
         # if not in dynamo: return with empty name field
-        player.load_from_db(email=player.email, name=name)
+        player.load_from_db(email=player.email, player_name=name.lower())
 
         if not player.name:
             return player
@@ -58,6 +67,24 @@ class Player(DatabaseObject):
 
         return player
 
+    @staticmethod
+    def lookup_many(account, names):
+        # Just the records (no wallets), all read at once, for listing.  None for any that don't exist.
+        dummy = Player(account.connection, account)
+        return dummy.load_many([{"email": account.email, "player_name": name.lower()} for name in names])
+
+    @staticmethod
+    def restore(account, name):
+        # As lookup_by_name, but after a copyover, so the wallets don't need to be loaded from keosd
+        player = Player(account.connection, account)
+        player.load_from_db(email=player.email, player_name=name.lower())
+        if not player.name:
+            return None
+
+        player.wallets = {type_: Wallet.restore(player, type_) or Wallet.load(player, type_)
+                          for type_ in [WalletType.Carried, WalletType.Stored]}
+        return player
+
     def create_wallets(self):
         self.wallets = {
             WalletType.Carried: Wallet.load(self, WalletType.Carried),
@@ -65,14 +92,14 @@ class Player(DatabaseObject):
         }
         self.save_to_db()
 
-    def append_line(self, output):
+    def append_line(self, output, priority=OutputPriority.Normal):
         if output is None:
             self.append_output(None)
         else:
-            self.append_output(output + "\r\n")
+            self.append_output(output + "\r\n", priority)
 
-    def append_output(self, output):
-        self.connection.output_channel.send(output)
+    def append_output(self, output, priority=OutputPriority.Normal):
+        self.connection.append_output(output, priority)
 
     def roll_abilities(self):
         if self.rerolls <= 0:
@@ -0,0 +1,288 @@
+import logging
+import random
+import stackless
+import sys
+import time
+from datetime import datetime, timedelta
+from enum import Enum
+
+from HavokMud import stacklesssocket
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class MissedRunPolicy(Enum):
+    # What to do when one or more runs were due while the job was busy (or the server was stalled)
+    Skip = 1  # forget them, and carry on from the next time in the future
+    RunOnce = 2  # run once to catch up, then carry on
+    RunAll = 3  # run every missed occurrence, back to back
+
+
+class Trigger(object):
+    def next_after(self, timestamp):
+        # The next time to run strictly after timestamp, or None if there are no more
+        raise RuntimeError("Function %s not implemented in class %s" %
+                           (sys._getframe().f_code.co_name, self.__class__.__name__))
+
+    def first_after(self, timestamp):
+        return self.next_after(timestamp)
+
+
+class IntervalTrigger(Trigger):
+    def __init__(self, interval, start=None):
+        # The first run is at start (default: one interval from now)
+        if interval <= 0:
+            raise SchedulerError("Interval must be positive")
+        self.interval = interval
+        self.start = time.time() + interval if start is None else start
+
+    def first_after(self, timestamp):
+        if timestamp <= self.start:
+            return self.start
+        return self.next_after(timestamp)
+
+    def next_after(self, timestamp):
+        if timestamp < self.start:
+            return self.start
+        count = int((timestamp - self.start) // self.interval) + 1
+        next_run = self.start + count * self.interval
+        # Floating point rounding can land on (or just before) timestamp itself
+        while next_run <= timestamp:
+            count += 1
+            next_run = self.start + count * self.interval
+        return next_run
+
+    def __str__(self):
+        return "every %ss" % self.interval
+
+
+class OneShotTrigger(Trigger):
+    def __init__(self, when):
+        self.when = when
+
+    def next_after(self, timestamp):
+        if timestamp < self.when:
+            return self.when
+        return None
+
+    def first_after(self, timestamp):
+        # If it's already overdue, run it now
+        return max(self.when, timestamp)
+
+    def __str__(self):
+        return "once at %s" % datetime.fromtimestamp(self.when).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class CronTrigger(Trigger):
+    # Standard five field crontab spec: minute hour day-of-month month day-of-week (0 = Sunday), local time
+    field_ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, spec):
+        self.spec = spec
+        fields = spec.split()
+        if len(fields) != 5:
+            raise SchedulerError("Cron spec needs 5 fields: %s" % spec)
+
+        (self.minutes, self.hours, self.days, self.months, self.weekdays) = \
+            [self.parse_field(field, low, high) for (field, (low, high)) in zip(fields, self.field_ranges)]
+        # Like cron, if both day fields are restricted, either one matching is enough
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for item in field.split(","):
+            (range_, _, step) = item.partition("/")
+            step = int(step) if step else 1
+            if range_ == "*":
+                (start, end) = (low, high)
+            elif "-" in range_:
+                (start, end) = [int(value) for value in range_.split("-", 1)]
+            else:
+                start = int(range_)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise SchedulerError("Bad cron field: %s" % field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def day_matches(self, date):
+        weekday = (date.weekday() + 1) % 7
+        if self.any_day:
+            return weekday in self.weekdays
+        if self.any_weekday:
+            return date.day in self.days
+        return date.day in self.days or weekday in self.weekdays
+
+    def next_after(self, timestamp):
+        date = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Skip whole months, days and hours where possible.  Five years covers any valid spec.
+        limit = date + timedelta(days=366 * 5)
+        while date < limit:
+            if date.month not in self.months:
+                date = (date.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+                continue
+            if not self.day_matches(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+                continue
+            if date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+                continue
+            return date.timestamp()
+        return None
+
+    def __str__(self):
+        return "cron '%s'" % self.spec
+
+
+class Job(object):
+    def __init__(self, scheduler, name, trigger, callback, args, jitter, missed):
+        self.scheduler = scheduler
+        self.name = name
+        self.trigger = trigger
+        self.callback = callback
+        self.args = args
+        self.jitter = jitter
+        self.missed = missed
+        self.next_run = trigger.first_after(time.time())
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+        self.runs = 0
+        self.errors = 0
+        self.missed_runs = 0
+        self.running = False
+        self.cancelled = False
+        self.timer = None
+        # The job's tasklet sleeps on this until the reactor's timer fires
+        self.channel = stackless.channel()
+        self.channel.preference = 0
+        self.tasklet = stackless.tasklet(self.run_loop)()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.channel.balance < 0:
+            self.channel.send(None)
+
+    def wait_until(self, timestamp):
+        # Sleep (without polling) until the wall clock time given, plus jitter
+        delay = max(timestamp - time.time(), 0.0)
+        if self.jitter:
+            delay += random.uniform(0.0, self.jitter)
+        self.timer = stacklesssocket.call_later(delay, self.channel.send, None)
+        self.channel.receive()
+        self.timer = None
+
+    def run_loop(self):
+        while not self.cancelled and self.next_run is not None:
+            self.wait_until(self.next_run)
+            if self.cancelled:
+                break
+
+            scheduled = self.next_run
+            self.run_once()
+
+            # Work out which runs were missed while that one ran
+            now = time.time()
+            next_run = self.trigger.next_after(scheduled)
+            missed = []
+            while next_run is not None and next_run <= now and len(missed) < 1000:
+                missed.append(next_run)
+                next_run = self.trigger.next_after(next_run)
+
+            if missed:
+                self.missed_runs += len(missed)
+                logger.warning("Job %s missed %s runs" % (self.name, len(missed)))
+                if self.missed == MissedRunPolicy.RunOnce:
+                    self.run_once()
+                elif self.missed == MissedRunPolicy.RunAll:
+                    for item in missed:
+                        if self.cancelled:
+                            break
+                        self.run_once()
+                next_run = self.trigger.next_after(time.time())
+
+            self.next_run = next_run
+
+        if self.scheduler.jobs.get(self.name, None) is self:
+            del self.scheduler.jobs[self.name]
+
+    def run_once(self):
+        self.running = True
+        start = time.time()
+        try:
+            self.callback(*self.args)
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)
+            logger.exception("Exception in job %s" % self.name)
+        finally:
+            self.running = False
+            self.runs += 1
+            self.last_run = start
+            self.last_duration = time.time() - start
+
+    def get_info(self):
+        return {
+            "name": self.name,
+            "trigger": str(self.trigger),
+            "next_run": self.next_run,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "runs": self.runs,
+            "errors": self.errors,
+            "missed": self.missed_runs,
+            "running": self.running,
+            "last_error": self.last_error,
+        }
+
+
+class Scheduler(object):
+    """
+    Runs jobs on an interval, a cron spec or once at a given time.  Each job has its own tasklet, which
+    sleeps on a channel until a stacklesssocket timer wakes it, so idle jobs cost nothing.  Job callbacks run
+    in that tasklet, so they may block (database calls etc).
+    """
+
+    def __init__(self):
+        self.jobs = {}
+
+    def add_job(self, name, trigger, callback, *args, jitter=0.0, missed=MissedRunPolicy.RunOnce):
+        if name in self.jobs:
+            raise SchedulerError("Job %s already scheduled" % name)
+        job = Job(self, name, trigger, callback, args, jitter, missed)
+        self.jobs[name] = job
+        logger.info("Scheduled job %s (%s)" % (name, trigger))
+        return job
+
+    def add_interval(self, name, interval, callback, *args, start=None, **kwargs):
+        return self.add_job(name, IntervalTrigger(interval, start), callback, *args, **kwargs)
+
+    def add_cron(self, name, spec, callback, *args, **kwargs):
+        return self.add_job(name, CronTrigger(spec), callback, *args, **kwargs)
+
+    def add_oneshot(self, name, delay, callback, *args, **kwargs):
+        return self.add_job(name, OneShotTrigger(time.time() + delay), callback, *args, **kwargs)
+
+    def remove_job(self, name):
+        job = self.jobs.pop(name, None)
+        if job:
+            job.cancel()
+        return job is not None
+
+    def list_jobs(self):
+        return [job.get_info() for (name, job) in sorted(self.jobs.items())]
+
+
+scheduler = Scheduler()
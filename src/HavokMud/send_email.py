@@ -1,7 +1,6 @@
 import html
 import logging
 import re
-import stackless
 from threading import Lock
 
 import boto3
@@ -11,6 +10,7 @@ from html2text import HTML2Text
 from urlextract import URLExtract
 
 from HavokMud.logging_support import AccountLogMessage
+from HavokMud.offload import offload_executor
 
 logger = logging.getLogger(__name__)
 
@@ -25,7 +25,6 @@ class EmailRequest(object):
         if not accounts:
             accounts = []
         self.accounts = accounts
-        self.channel = stackless.channel()
 
 
 class EmailHandler(object):
@@ -55,10 +54,6 @@ class EmailHandler(object):
         self.html2text.ignore_emphasis = False
         self.html2text_lock = Lock()
 
-        self.in_channel = stackless.channel()
-
-        stackless.tasklet(self._send_email_loop)()
-
     def _update_tlds(self):
         response = requests.get("https://data.iana.org/TLD/tlds-alpha-by-domain.txt")
         data = response.content
@@ -72,14 +67,8 @@ class EmailHandler(object):
 
     def send_email(self, from_, to, subject, body_html=None, body_text=None):
         request = EmailRequest(from_, to, subject, body_html, body_text)
-        self.in_channel.send(request)
-        response = request.channel.receive()
-        return response
-
-    def _send_email_loop(self):
-        while True:
-            request = self.in_channel.receive()
-            stackless.tasklet(self._send_email_tasklet)(request)
+        # Formatting it and the SES call both block, so it's all done on an offload thread
+        return offload_executor.run("email", self._send_email, request)
 
     @staticmethod
     def _log_email(request, message, level="info"):
@@ -92,7 +81,7 @@ class EmailHandler(object):
         for account in request.accounts:
             this_logger(AccountLogMessage(account, message))
 
-    def _send_email_tasklet(self, request):
+    def _send_email(self, request):
         response = {}
         try:
             self._log_email(request, "Sending email from %s to %s" % (request.from_, request.to))
@@ -151,7 +140,7 @@ class EmailHandler(object):
             self._log_email(request, "Error sending email: %s" % str(e), level="exception")
             response = {"Error": {"Message": str(e)}}
 
-        request.channel.send(response)
+        return response
 
     def htmlize_body(self, text):
         # Want to put links on URLs, and make the rest html-safe
@@ -1,4 +1,6 @@
 import logging
+import os
+import signal
 import socket
 import stackless
 import traceback
@@ -6,16 +8,26 @@ import weakref
 from threading import Lock
 
 from HavokMud.account import Account
+from HavokMud.broadcast import Broadcast
+from HavokMud.childwatcher import child_watcher
 from HavokMud.config_loader import load_all_wallet_passwords
-from HavokMud.connection import Connection
+from HavokMud.connection import Connection, summarize_output_stats, format_output_stats
+from HavokMud.copyover import perform_copyover, load_state, recover_sessions, CopyoverError
 from HavokMud.dnslookup import DNSLookup
 from HavokMud.encryption_helper import EncryptionEngine
+from HavokMud.jinjaprocessor import jinja_processor
+from HavokMud.message_bus import MessageBus
+from HavokMud.metrics import MetricsEndpoint
+from HavokMud.offload import offload_executor
+from HavokMud.writebehind import write_behind
+from HavokMud.output_priority import OutputPriority
 from HavokMud.redis_handler import RedisHandler
 from HavokMud.send_email import EmailHandler
 from HavokMud.settings import Settings
 from HavokMud.swaggerapi.eosio_chain import EOSChainAPI
 from HavokMud.swaggerapi.eosio_wallet import EOSWalletAPI
 from HavokMud.system import System
+from HavokMud.websocket import accept_websocket
 
 logger = logging.getLogger(__name__)
 
@@ -24,11 +36,18 @@ class Server(object):
     # These defaults are normally overwritten in the config file
     bindIp = "0.0.0.0"
     port = 3000
+    websocket_port = None
+    # Each worker serves its metrics on localhost, on this port plus its worker id
+    metrics_port = None
     wizlocked = False
     wizlock_reason = None
     profile = None
+    workers = 1
+    # Full lists of users go to the other workers this many at a time, to keep each message well within
+    # what the message bus can carry
+    presence_chunk_size = 200
 
-    def __init__(self, config, dbs, debug_mode=False):
+    def __init__(self, config, dbs, debug_mode=False, worker_id=0):
         import HavokMud.startup
 
         HavokMud.startup.server_instance = self
@@ -37,8 +56,29 @@ class Server(object):
         self.__dict__.update(self.config.get("mud", {}))
 
         self.dbs = dbs
+        self.worker_id = worker_id
+        # Set if this process was started by a copyover, with the sessions to pick back up
+        self.copyover_state = load_state()
+        self.listeners = {}
         self.user_lock = Lock()
         self.user_index = weakref.WeakValueDictionary()
+        # Users connected to the other workers, by worker id
+        self.remote_users = {}
+        self.bus = None
+        if self.workers > 1:
+            self.bus = MessageBus(config, worker_id, self.workers)
+            self.bus.subscribe("presence", self.on_presence)
+            self.bus.subscribe("presence_request", self.on_presence_request)
+            self.bus.subscribe("say", self.on_say)
+            self.bus.subscribe("invalidate", self.on_invalidate)
+            # Any users we had before a restart are gone, so this also clears them out on the other workers
+            self.send_presence("presence_request")
+        child_watcher.configure(config)
+        child_watcher.start()
+        offload_executor.configure(config)
+        write_behind.configure(config)
+        jinja_processor.configure(config)
+        jinja_processor.precompile()
         self.dns_lookup = DNSLookup()
         self.email_handler = EmailHandler(config)
         self.redis = RedisHandler(config)
@@ -50,12 +90,20 @@ class Server(object):
 
         # Need to load up self.system_wallet_passwords with encrypted wallet passwords
         system_wallets = {item.name: item for item in System.get_all_system_wallets()}
+        self.system_wallets = system_wallets
+        self.domain = self.config.get("email", {}).get("domain", None)
+
+        if worker_id != 0:
+            # The first worker seeds the wallets and primes the cache for everyone
+            if not debug_mode:
+                stackless.tasklet(self.run)()
+            return
+
         wallet_passwords = {name: item.get_password() for (name, item) in system_wallets.items()}
         old_wallet_passwords = dict(wallet_passwords)
         wallet_passwords = load_all_wallet_passwords(wallet_passwords)
         logger.debug("Wallet passwords: %s" % wallet_passwords)
 
-        self.system_wallets = system_wallets
         # Update/seed the wallets
         for (name, password) in wallet_passwords.items():
             if password != old_wallet_passwords.get(name, None):
@@ -67,33 +115,67 @@ class Server(object):
                 wallet.save_to_db()
                 wallet.prepare_wallet()
 
-        self.domain = self.config.get("email", {}).get("domain", None)
+        if not self.copyover_state:
+            # Prime up the redis cache (after a copyover, it already is)
+            self.redis.do_command("delete", "userdb/*")
+            self.redis.do_command("delete", "passdb/*")
 
-        # Prime up the redis cache
-        self.redis.do_command("delete", "userdb/*")
-        self.redis.do_command("delete", "passdb/*")
+            # Only what update_redis needs, a page at a time
+            for account in Account.iter_all_accounts(["email", "password", "players"]):
+                account.update_redis()
 
-        accounts = Account().get_all_accounts()
-        for account in accounts:
-            account.update_redis()
+        if self.workers == 1:
+            # Lets a deploy do a copyover without anyone having to log in
+            signal.signal(signal.SIGUSR1, self.on_copyover_signal)
 
         if not debug_mode:
             stackless.tasklet(self.run)()
 
     def run(self):
-        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_socket.bind((self.bindIp, self.port))
+        if self.copyover_state:
+            recover_sessions(self, self.copyover_state)
+
+        if self.metrics_port:
+            sections = {"connections": (self.get_connection_stats, self.format_connection_stats)}
+            stackless.tasklet(MetricsEndpoint(self.metrics_port + self.worker_id, sections=sections).run)()
+
+        if self.websocket_port:
+            # Browser clients, without a separate proxy in front
+            stackless.tasklet(self.run_listener)(self.websocket_port, self.on_websocket_accept)
+        self.run_listener(self.port, Connection)
+
+    @staticmethod
+    def on_websocket_accept(client_socket, client_address):
+        # The handshake is done in its own tasklet so it can't hold up the accept loop
+        stackless.tasklet(accept_websocket)(client_socket, client_address)
+
+    def run_listener(self, port, factory):
+        inherited_fd = None
+        if self.copyover_state:
+            inherited_fd = self.copyover_state.get("listeners", {}).get(str(port), None)
+
+        if inherited_fd is not None:
+            # Still bound and listening from before the copyover
+            listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=inherited_fd)
+            os.set_inheritable(inherited_fd, False)
+        else:
+            listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.workers > 1:
+                # Each worker listens on the port, and the kernel spreads the connections between them
+                listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            listen_socket.bind((self.bindIp, port))
+        self.listeners[port] = listen_socket
         logger.info("Listening on %s" % listen_socket.fileno())
         listen_socket.listen(10)
 
-        logger.info("Accepting connections on %s:%s", self.bindIp, self.port)
+        logger.info("Accepting connections on %s:%s", self.bindIp, port)
         try:
             while True:
                 try:
                     (clientSocket, clientAddress) = listen_socket.accept()
                     logger.info("Accepting on %s" % clientSocket.fileno())
-                    Connection(clientSocket, clientAddress)
+                    factory(clientSocket, clientAddress)
                 except Exception as e:
                     logger.exception("Exception in accept loop")
                     pass
@@ -104,15 +186,110 @@ class Server(object):
     def register_user(self, user):
         with self.user_lock:
             self.user_index[id(user)] = user
+        self.publish("presence", {"add": [self.get_user_info(user)]})
 
     def unregister_user(self, user):
         with self.user_lock:
             self.user_index.pop(id(user), None)
+        self.publish("presence", {"remove": [id(user)]})
 
     def list_users(self):
+        # Only the users connected to this worker
         with self.user_lock:
             return list(self.user_index.values())
 
+    def list_all_users(self):
+        # Info on the users connected to all workers
+        users = [self.get_user_info(user) for user in self.list_users()]
+        for worker_users in list(self.remote_users.values()):
+            users.extend(worker_users.values())
+        return users
+
+    def get_user_info(self, user):
+        connection = user.connection
+        if connection:
+            (host, port) = connection.client_address[:2]
+        else:
+            (host, port) = (None, None)
+        return {
+            "id": id(user),
+            "worker": self.worker_id,
+            "name": None,
+            "host": host,
+            "port": port,
+        }
+
+    def get_connection_stats(self):
+        # Output stats for each of this worker's connections, and across all of them
+        connections = []
+        for user in self.list_users():
+            connection = user.connection
+            if not connection or connection.disconnected:
+                continue
+            stats = connection.get_output_stats()
+            stats["address"] = "%s:%s" % tuple(connection.client_address[:2])
+            connections.append(stats)
+        summary = summarize_output_stats(connections)
+        summary["connections"] = connections
+        return summary
+
+    def format_connection_stats(self, each=True):
+        stats = self.get_connection_stats()
+        return format_output_stats(stats, stats["connections"] if each else None)
+
+    def get_presence(self):
+        # The first message replaces the list the other worker has for us, and the rest add to it
+        users = [self.get_user_info(user) for user in self.list_users()]
+        size = self.presence_chunk_size
+        messages = [{"users": users[:size]}]
+        for start in range(size, len(users), size):
+            messages.append({"add": users[start:start + size]})
+        return messages
+
+    def send_presence(self, topic, worker_id=None):
+        # The bus delivers a worker's messages to each other worker in order, so the adds follow the list
+        messages = self.get_presence()
+        self.bus.publish(topic, messages[0], worker_id=worker_id)
+        for message in messages[1:]:
+            self.bus.publish("presence", message, worker_id=worker_id)
+
+    def publish(self, topic, message):
+        if self.bus:
+            self.bus.publish(topic, message)
+
+    def on_presence_request(self, worker_id, message):
+        self.on_presence(worker_id, message)
+        self.send_presence("presence", worker_id=worker_id)
+
+    def on_presence(self, worker_id, message):
+        if "users" in message:
+            # A full list replaces whatever we had for that worker
+            self.remote_users[worker_id] = {}
+        worker_users = self.remote_users.setdefault(worker_id, {})
+        for info in message.get("users", []) + message.get("add", []):
+            worker_users[info.get("id")] = info
+        for user_id in message.get("remove", []):
+            worker_users.pop(user_id, None)
+
+    def on_say(self, worker_id, message):
+        line = message.get("line", "")
+        message = Broadcast("\"%s$c0007\"\r\n" % line)
+        message.send_to_users(self.list_users(), "Someone says: ", OutputPriority.Low)
+
+    def on_invalidate(self, worker_id, message):
+        self.dbs.handler.invalidate(message.get("table", None), message.get("keys", []))
+
+    def copyover(self):
+        # Only returns if it failed
+        try:
+            perform_copyover(self)
+        except CopyoverError as e:
+            logger.error("Copyover not done: %s" % e)
+            return str(e)
+
+    def on_copyover_signal(self, signum, frame):
+        stackless.tasklet(self.copyover)()
+
     def is_wizlocked(self):
         return self.wizlocked
 
@@ -23,15 +23,20 @@
 # Possible improvements:
 # - More correct error handling.  When there is an error on a socket found by
 #   poll, there is no idea what it actually is.
-# - Launching each bit of incoming data in its own tasklet on the recvChannel
-#   send is a little over the top.  It should be possible to add it to the
-#   rest of the queued data
 
 import asyncore
 import errno
+from collections import deque
+import heapq
+import itertools
 import logging
+import selectors
 import socket as stdsocket  # We need the "socket" name for the function we export.
+# Imported before install(), so SSLSocket is built on the real socket class (TLS is only done from threads)
+import ssl  # noqa: F401
 import stackless
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -42,10 +47,16 @@ _old_socket = stdsocket.socket
 _old_SocketIO = stdsocket.SocketIO
 _old_realsocket = stdsocket._realsocket
 
+# The thread running the tasklets and the reactor.  Sockets created from any other thread (like the
+# offload pool's) are ordinary blocking sockets.
+_reactor_thread = None
+
 
 def install():
+    global _reactor_thread
     if stdsocket.socket is _new_socket:
         raise RuntimeError("Still installed")
+    _reactor_thread = threading.get_ident()
     stdsocket._realsocket = _old_realsocket
     stdsocket.socket = _new_socket
     stdsocket.SocketIO = _new_SocketIO
@@ -88,14 +99,73 @@ stringEncoding = "utf-8"
 
 managerRunning = False
 
+# Timers are shared by both socket managers.  Callbacks are run from within the
+# manager tasklet, so they must not block - launch a tasklet if you need to.
+_timer_heap = []
+_timer_sequence = itertools.count()
+
+
+class Timer(object):
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def call_at(deadline, callback, *args):
+    # deadline is in time.monotonic() seconds
+    timer = Timer(deadline, callback, args)
+    heapq.heappush(_timer_heap, (deadline, next(_timer_sequence), timer))
+    _manage_sockets_func()
+    return timer
+
+
+def call_later(delay, callback, *args):
+    return call_at(time.monotonic() + delay, callback, *args)
+
+
+def sleep(seconds):
+    # Block only the calling tasklet
+    channel = stackless.channel()
+    channel.preference = 0
+    call_later(seconds, channel.send, None)
+    channel.receive()
+
+
+def _run_timers():
+    # Fire all expired timers, and return the number of seconds until the
+    # next one is due (or None if there are none pending)
+    now = time.monotonic()
+    while _timer_heap:
+        (deadline, _, timer) = _timer_heap[0]
+        if timer.cancelled:
+            heapq.heappop(_timer_heap)
+            continue
+
+        if deadline > now:
+            return deadline - now
+
+        heapq.heappop(_timer_heap)
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            logger.exception("Exception in timer callback %s" % timer.callback)
+
+    return None
+
 
 def ManageSockets():
     global managerRunning
 
     t = stackless.getcurrent()
-    while len(asyncore.socket_map):
+    while len(asyncore.socket_map) or _timer_heap:
         # Check the sockets for activity.
         t.block_trap = False
+        _run_timers()
         asyncore.poll(0.01)
         t.block_trap = True
         # Yield to give other tasklets a chance to be scheduled.
@@ -111,6 +181,105 @@ def StartManager():
         stackless.tasklet(ManageSockets)()
 
 
+# The selectors based manager registers each socket once, and only updates its
+# registration when the events it is interested in change (see
+# _update_interest).  It then sleeps in the selector until there is socket
+# activity or a timer is due, rather than waking every 10ms to rescan every
+# socket.  When there are other runnable tasklets, it just polls.
+_selector = None
+_interest_dirty = set()
+
+
+def _update_interest(dispatcher):
+    if _selector is not None:
+        _interest_dirty.add(dispatcher)
+
+
+def _apply_interest():
+    while _interest_dirty:
+        dispatcher = _interest_dirty.pop()
+        fd = dispatcher._fileno
+        if fd is None:
+            continue
+
+        events = 0
+        if dispatcher.readable():
+            events |= selectors.EVENT_READ
+        if dispatcher.writable() and not dispatcher.accepting:
+            events |= selectors.EVENT_WRITE
+
+        old_events = dispatcher._registered_events
+        if events == old_events:
+            continue
+
+        if not old_events:
+            _selector.register(fd, events, dispatcher)
+        elif not events:
+            _selector.unregister(fd)
+        else:
+            _selector.modify(fd, events, dispatcher)
+        dispatcher._registered_events = events
+
+
+def _unregister_interest(dispatcher):
+    _interest_dirty.discard(dispatcher)
+    if _selector is not None and dispatcher._registered_events:
+        try:
+            _selector.unregister(dispatcher._fileno)
+        except (KeyError, ValueError):
+            pass
+    dispatcher._registered_events = 0
+
+
+def ManageSocketsSelectors():
+    global managerRunning, _selector
+
+    _selector = selectors.DefaultSelector()
+    for dispatcher in list(asyncore.socket_map.values()):
+        _update_interest(dispatcher)
+
+    t = stackless.getcurrent()
+    try:
+        while len(asyncore.socket_map) or _timer_heap:
+            t.block_trap = False
+            timeout = _run_timers()
+            _apply_interest()
+
+            # Only park in the selector if there is nothing else to run
+            if stackless.runcount > 1:
+                timeout = 0
+
+            try:
+                events = _selector.select(timeout)
+            except OSError as e:
+                logger.error("Exception in select: %s" % e)
+                events = []
+
+            for (key, mask) in events:
+                dispatcher = key.data
+                if mask & selectors.EVENT_READ:
+                    asyncore.read(dispatcher)
+                if mask & selectors.EVENT_WRITE and dispatcher._fileno is not None:
+                    asyncore.write(dispatcher)
+            t.block_trap = True
+            # Yield to give other tasklets a chance to be scheduled.
+            stackless.schedule()
+    finally:
+        for dispatcher in list(asyncore.socket_map.values()):
+            dispatcher._registered_events = 0
+        _interest_dirty.clear()
+        _selector.close()
+        _selector = None
+        managerRunning = False
+
+
+def StartSelectorsManager():
+    global managerRunning
+    if not managerRunning:
+        managerRunning = True
+        stackless.tasklet(ManageSocketsSelectors)()
+
+
 _manage_sockets_func = StartManager
 
 
@@ -119,6 +288,23 @@ def stacklesssocket_manager(mgr):
     _manage_sockets_func = mgr
 
 
+_reactors = {
+    "asyncore": StartManager,
+    "selectors": StartSelectorsManager,
+    "epoll": StartSelectorsManager,
+}
+
+
+def select_reactor(name):
+    # This needs to be done before any sockets are created, as the manager is
+    # started on the first socket creation.
+    mgr = _reactors.get(name, None)
+    if not mgr:
+        raise ValueError("Unknown socket reactor %s" % name)
+    logger.info("Using %s socket reactor" % name)
+    stacklesssocket_manager(mgr)
+
+
 def socket(*args, **kwargs):
     import sys
     if "socket" in sys.modules and sys.modules["socket"] is not stdsocket:
@@ -128,6 +314,11 @@ def socket(*args, **kwargs):
 class _new_socket(object):
     _old_socket.__doc__
 
+    def __new__(cls, *args, **kwargs):
+        if cls is _new_socket and _reactor_thread is not None and threading.get_ident() != _reactor_thread:
+            return _old_socket(*args, **kwargs)
+        return object.__new__(cls)
+
     def __init__(self, family=AF_INET, type=SOCK_STREAM, proto=0, fileno=None):
         sock = _old_socket(family, type, proto, fileno)
         _manage_sockets_func()
@@ -162,6 +353,11 @@ class _fakesocket(asyncore.dispatcher):
     accept_channel = None
     recv_channel = None
     was_connected = False
+    reading_paused = False
+    _registered_events = 0
+    read_chunk_size = 16384
+    # Stay well under IOV_MAX when doing vectored writes
+    max_send_buffers = 512
 
     def __init__(self, realSocket):
         # This is worth doing.  I was passing in an invalid socket which
@@ -173,13 +369,28 @@ class _fakesocket(asyncore.dispatcher):
         asyncore.dispatcher.__init__(self, realSocket)
         self.socket = realSocket
 
+        # Incoming data is appended to read_bytes (between read_index and
+        # read_end) by handle_read, and drained by recv_into.  The channel is
+        # only used to wake up a tasklet blocked waiting for data.
         self.recv_channel = stackless.channel()
         self.recv_channel.preference = 0
-        self.read_bytes = bytearray()
+        self.read_bytes = bytearray(self.read_chunk_size)
         self.read_index = 0
+        self.read_end = 0
+        self.read_eof = False
+        self.read_error = None
+        self.recv_packets = deque()
 
         self.send_buffer = bytearray()
         self.send_to_buffers = []
+        self.send_syscalls = 0
+        # Called (from the manager tasklet, so it must not block) whenever
+        # the send buffer empties, or is thrown away.
+        self.on_send_drained = None
+
+        # The real socket must stay non-blocking (asyncore set it that way),
+        # so timeouts are only applied to the tasklets using this socket.
+        self._timeout = 0.0
 
     def __del__(self):
         # There are no more users (sockets or files) of this fake socket, we
@@ -202,6 +413,7 @@ class _fakesocket(asyncore.dispatcher):
         # even though it still should be running as this weakref somehow ends up
         # being the only ref (?)
         map[self._fileno] = self
+        _update_interest(self)
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -210,13 +422,31 @@ class _fakesocket(asyncore.dispatcher):
         if fd in map:
             logger.debug("closing channel %s:%s" % (fd, self))
             del map[fd]
+        _unregister_interest(self)
         self._fileno = None
 
+    def readable(self):
+        return not self.reading_paused
+
+    def pause_reading(self):
+        # Leave incoming data in the kernel, for something else (like a child
+        # process sharing the socket) to read
+        self.reading_paused = True
+        _update_interest(self)
+
+    def resume_reading(self):
+        self.reading_paused = False
+        _update_interest(self)
+
     def writable(self):
         if self.socket.type != SOCK_DGRAM and not self.connected:
             return True
         return len(self.send_buffer) or len(self.send_to_buffers)
 
+    def listen(self, num):
+        asyncore.dispatcher.listen(self, num)
+        _update_interest(self)
+
     def accept(self):
         if not self.accept_channel:
             self.accept_channel = stackless.channel()
@@ -224,6 +454,7 @@ class _fakesocket(asyncore.dispatcher):
 
     def connect(self, address):
         asyncore.dispatcher.connect(self, address)
+        _update_interest(self)
 
         # UDP sockets do not connect.
         if self.socket.type != SOCK_DGRAM and not self.connected:
@@ -244,6 +475,7 @@ class _fakesocket(asyncore.dispatcher):
             raise error(stdsocket.EBADF, 'Bad file descriptor')
 
         self.send_buffer.extend(data)
+        _update_interest(self)
         stackless.schedule()
         return len(data)
 
@@ -260,11 +492,58 @@ class _fakesocket(asyncore.dispatcher):
         # It should be possible to do away with the busy wait with
         # the use of a channel.
         self.send_buffer.extend(data)
+        _update_interest(self)
         while self.send_buffer:
             stackless.schedule()
         return len(data)
 
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None):
+        if not self.connected:
+            # The socket was never connected.
+            if not self.was_connected:
+                raise error(10057, "Socket is not connected")
+
+            # The socket has been closed already.
+            raise error(stdsocket.EBADF, 'Bad file descriptor')
+
+        buffers = list(buffers)
+        if len(buffers) > self.max_send_buffers:
+            buffers = [b"".join(buffers)]
+        total_bytes = sum(map(len, buffers))
+
+        # If there's nothing already waiting to go out, try a vectored write
+        # straight away, and only queue up what didn't fit.  This does not
+        # yield, so the caller can keep going.
+        sent_bytes = 0
+        if not self.send_buffer:
+            try:
+                sent_bytes = self.socket.sendmsg(buffers, ancdata, flags)
+                self.send_syscalls += 1
+            except OSError as e:
+                # Let handle_write deal with it
+                logger.debug("sendmsg failed: %s" % e)
+
+        if sent_bytes < total_bytes:
+            for data in buffers:
+                if sent_bytes >= len(data):
+                    sent_bytes -= len(data)
+                    continue
+                self.send_buffer.extend(memoryview(data)[sent_bytes:])
+                sent_bytes = 0
+            _update_interest(self)
+        return total_bytes
+
     def sendto(self, send_data, flags, send_address):
+        # Datagrams can usually go straight out.  Errors (like there being
+        # nobody bound to a unix socket address) go back to the caller.
+        if not self.send_to_buffers:
+            try:
+                sent_bytes = self.socket.sendto(send_data, flags, send_address)
+                self.send_syscalls += 1
+                return sent_bytes
+            except BlockingIOError:
+                pass
+
         wait_channel = None
         for idx, (data, address, channel, sent_bytes) in enumerate(self.send_to_buffers):
             if address == send_address:
@@ -274,8 +553,47 @@ class _fakesocket(asyncore.dispatcher):
         if wait_channel is None:
             wait_channel = stackless.channel()
             self.send_to_buffers.append((send_data, send_address, wait_channel, 0))
+            _update_interest(self)
         return wait_channel.receive()
 
+    def _wake_reader(self):
+        # The channel has no preference, so this only makes the blocked
+        # tasklet runnable, it doesn't switch to it.
+        while self.recv_channel is not None and self.recv_channel.balance < 0:
+            self.recv_channel.send(None)
+
+    def _send_drained(self):
+        if self.on_send_drained is not None:
+            self.on_send_drained()
+
+    def _wait_readable(self):
+        timeout = self.gettimeout()
+        logger.debug("timeout: %s", timeout)
+        if timeout == 0:
+            raise BlockingIOError(errno.EWOULDBLOCK, "Would block")
+
+        timer = None
+        if timeout is not None:
+            timer = call_later(timeout, self._read_timed_out)
+        try:
+            self.recv_channel.receive()
+        finally:
+            if timer:
+                timer.cancel()
+
+    def _read_timed_out(self):
+        if self.recv_channel is not None and self.recv_channel.balance < 0:
+            self.recv_channel.send_exception(stdsocket.timeout, "timed out")
+
+    def settimeout(self, value):
+        self._timeout = value
+
+    def gettimeout(self):
+        return self._timeout
+
+    def setblocking(self, flag):
+        self._timeout = None if flag else 0.0
+
     # Read at most byteCount bytes.
     def recv(self, byte_count, flags=0):
         b = bytearray()
@@ -288,7 +606,15 @@ class _fakesocket(asyncore.dispatcher):
 
         # recvfrom() must not concatenate two or more packets.
         # Each call should return the first 'byteCount' part of the packet.
-        (data, address) = self.recv_channel.receive()
+        while not self.recv_packets:
+            if self.read_error is not None:
+                (err, self.read_error) = (self.read_error, None)
+                raise err
+            if self.read_eof:
+                return b"", None
+            self._wait_readable()
+
+        (data, address) = self.recv_packets.popleft()
         return data[:byte_count], address
 
     def recv_into(self, buffer, nbytes=0, flags=0):
@@ -299,33 +625,27 @@ class _fakesocket(asyncore.dispatcher):
         # call should be split into strings of length less than or equal
         # to 'byteCount', and returned by one or more recv() calls.
 
-        remaining_bytes = max(0, len(self.read_bytes) - self.read_index)
-        logger.debug(
-            "read_index: %s, read_bytes: %s, remaining: %s" % (self.read_index, len(self.read_bytes), remaining_bytes))
-
         # TODO: Verify this connectivity behaviour.
         # Sockets which have never been connected do this.
-        if not self.connected and not self.was_connected:
+        if not self.connected and not self.was_connected and not self.read_eof:
             raise error(10057, 'Socket is not connected')
 
         # Sockets which were connected, but no longer are, use
         # up the remaining input.  Observed this with urllib.urlopen
         # where it closes the socket and then allows the caller to
         # use a file to access the body of the web page.
-        if not remaining_bytes:
-            timeout = self.gettimeout()
-            logger.debug("timeout: %s", timeout)
-            if timeout == 0:
-                if self.recv_channel.balance <= 0:
-                    raise BlockingIOError(errno.EWOULDBLOCK, "Would block")
-
-            self.read_bytes = self.recv_channel.receive()
-            self.read_index = 0
-            remaining_bytes = len(self.read_bytes)
-
-        if remaining_bytes == 0:
-            logger.debug("returning 0")
-            return 0
+        while self.read_end == self.read_index:
+            if self.read_error is not None:
+                (err, self.read_error) = (self.read_error, None)
+                raise err
+            if self.read_eof:
+                logger.debug("returning 0")
+                return 0
+            self._wait_readable()
+
+        remaining_bytes = self.read_end - self.read_index
+        logger.debug(
+            "read_index: %s, read_end: %s, remaining: %s" % (self.read_index, self.read_end, remaining_bytes))
 
         if nbytes == 0:
             nbytes = remaining_bytes
@@ -336,11 +656,34 @@ class _fakesocket(asyncore.dispatcher):
         nbytes = min(remaining_bytes, nbytes)
 
         idx = self.read_index + nbytes
-        buffer[:nbytes] = self.read_bytes[self.read_index:idx]
-        self.read_index = idx
+        with memoryview(self.read_bytes) as view:
+            buffer[:nbytes] = view[self.read_index:idx]
+        if idx == self.read_end:
+            # Drained, so start filling from the front again
+            self.read_index = 0
+            self.read_end = 0
+        else:
+            self.read_index = idx
         logger.debug("returning %s" % nbytes)
         return nbytes
 
+    def _fill_read_bytes(self):
+        # Read directly into the free space at the end of read_bytes, moving
+        # any unread data to the front (or growing the buffer) when short.
+        if len(self.read_bytes) - self.read_end < self.read_chunk_size:
+            remaining_bytes = self.read_end - self.read_index
+            if self.read_index:
+                self.read_bytes[:remaining_bytes] = self.read_bytes[self.read_index:self.read_end]
+                self.read_index = 0
+                self.read_end = remaining_bytes
+            if len(self.read_bytes) - self.read_end < self.read_chunk_size:
+                self.read_bytes.extend(bytes(self.read_chunk_size))
+
+        with memoryview(self.read_bytes) as view:
+            count = self.socket.recv_into(view[self.read_end:])
+        self.read_end += count
+        return count
+
     def close(self):
         logger.debug("Closing %s (%s)" % (self._fileno, self.fileno()))
         if self._fileno is None:
@@ -349,6 +692,7 @@ class _fakesocket(asyncore.dispatcher):
         self.connected = False
         self.accepting = False
         self.send_buffer = None  # breaks the loop in sendall
+        self._send_drained()
 
         # Clear out all the channels with relevant errors.
         while self.accept_channel and self.accept_channel.balance < 0:
@@ -362,21 +706,27 @@ class _fakesocket(asyncore.dispatcher):
         # from the socket before actually closing as requests will close
         # the connection early and continue to pull data from it.  We were
         # seeing nasty race conditions.
-        ret = b"blah"
-        while ret and self.recv_channel:
-            try:
-                self.settimeout(0.1)
-                ret = asyncore.dispatcher.recv(self, 65535)
-            except stdsocket.timeout:
-                # This is expected when no more data available
-                ret = b""
-            except Exception as e:
-                logger.error("Exception while draining: %s" % e)
-                ret = b""
-
-            logger.debug("Drained %s bytes" % len(ret))
-            # Don't block this tasklet, it may be the last one, and we'd deadlock
-            stackless.tasklet(self.recv_channel.send)(ret)
+        if self.recv_channel is not None:
+            count = 1
+            while count:
+                try:
+                    if self.socket.type == SOCK_DGRAM:
+                        self.recv_packets.append(self.socket.recvfrom(65535))
+                    else:
+                        count = self._fill_read_bytes()
+                except (BlockingIOError, stdsocket.timeout):
+                    # This is expected when no more data available
+                    count = 0
+                except Exception as e:
+                    logger.error("Exception while draining: %s" % e)
+                    count = 0
+
+            logger.debug("Drained to %s bytes" % (self.read_end - self.read_index))
+
+        # Wake up anyone waiting for data, they will see the EOF after using
+        # up what is left.
+        self.read_eof = True
+        self._wake_reader()
 
         asyncore.dispatcher.close(self)
 
@@ -391,7 +741,7 @@ class _fakesocket(asyncore.dispatcher):
                 return
             (current_socket, client_address) = t
             current_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            current_socket.wasConnected = True
+            current_socket.was_connected = True
             stackless.tasklet(self.accept_channel.send)((current_socket, client_address))
 
     # Inform the blocked connect call that the connection has been made.
@@ -402,6 +752,7 @@ class _fakesocket(asyncore.dispatcher):
                 self.connect_channel.preference = 1
 
             self.was_connected = True
+            _update_interest(self)
             stackless.tasklet(self.connect_channel.send)(None)
 
     # Asyncore says its done but self.readBuffer may be non-empty
@@ -417,38 +768,45 @@ class _fakesocket(asyncore.dispatcher):
     def handle_read(self):
         try:
             if self.socket.type == SOCK_DGRAM:
-                ret = self.socket.recvfrom(65535)
+                packet = self.socket.recvfrom(65535)
+                self.recv_packets.append(packet)
+                count = len(packet[0])
             else:
-                ret = asyncore.dispatcher.recv(self, 65535)
+                count = self._fill_read_bytes()
                 # Not sure this is correct, but it seems to give the
                 # right behaviour.  Namely removing the socket from
                 # asyncore.
-                if not ret:
-                    ret = b""
+                if not count:
                     logger.debug("not ret, closing")
                     self.close()
 
-            logger.debug('Read %s bytes' % len(ret))
-
-            # Do not block.
-            if self.recv_channel.balance < 0:
-                # The channel prefers the sender.  This means if there are waiting
-                # receivers, the first will be scheduled with the given data.
-                self.recv_channel.send(ret)
-            else:
-                # No waiting receivers.  The send needs to block in a tasklet.
-                stackless.tasklet(self.recv_channel.send)(ret)
+            logger.debug('Read %s bytes' % count)
+        except BlockingIOError:
+            return
         except stdsocket.error as err:
+            if err.errno in asyncore._DISCONNECTED:
+                # Treat it the same as the remote end closing
+                self.close()
+                return
+
             # If there's a read error assume the connection is
             # broken and drop any pending output
             if self.send_buffer:
                 self.send_buffer = bytearray()
-            self.recv_channel.send_exception(stdsocket.error, err)
+                self._send_drained()
+            self.read_error = err
+
+        self._wake_reader()
 
     def handle_write(self):
         if len(self.send_buffer):
-            sent_bytes = asyncore.dispatcher.send(self, self.send_buffer[:512])
-            self.send_buffer = self.send_buffer[sent_bytes:]
+            with memoryview(self.send_buffer) as view:
+                sent_bytes = asyncore.dispatcher.send(self, view)
+            self.send_syscalls += 1
+            if self.send_buffer is not None:
+                del self.send_buffer[:sent_bytes]
+                if not self.send_buffer:
+                    self._send_drained()
         elif len(self.send_to_buffers):
             (data, address, channel, old_sent_bytes) = self.send_to_buffers[0]
             sent_bytes = self.socket.sendto(data, 0, address)
@@ -458,3 +816,4 @@ class _fakesocket(asyncore.dispatcher):
             else:
                 del self.send_to_buffers[0]
                 stackless.tasklet(channel.send)(total_sent_bytes)
+        _update_interest(self)
@@ -0,0 +1,361 @@
+import hashlib
+import logging
+import re
+import secrets
+import time
+from types import SimpleNamespace
+
+import boto3
+
+from HavokMud.database.base import _convert_to_dynamodb
+from HavokMud.offload import offload_executor
+from HavokMud.swaggerapi import SwaggerAPIError
+
+logger = logging.getLogger(__name__)
+
+# In-process stand-ins for the backing services (DynamoDB, SecretsManager, Redis, keosd, nodeos, SES and DNS),
+# so the server can be run under load without any of them.  Each one can be given a simulated latency, which
+# blocks the same way the real (synchronous) client libraries do, on the offload threads.
+
+latency = {}
+
+
+def simulate_latency(service):
+    delay = latency.get(service, 0.0)
+    if delay:
+        time.sleep(delay)
+
+
+update_set_re = re.compile(r"^\s*(?P<name>#?\w+)\s*=\s*(?P<value>:\w+)\s*$")
+update_remove_re = re.compile(r"^\s*(?P<name>#?\w+)\s*$")
+
+
+class StandInResourceNotFoundException(Exception):
+    pass
+
+
+class StandInResourceExistsException(Exception):
+    pass
+
+
+class StandInDynamoDB(object):
+    exceptions = SimpleNamespace(ResourceNotFoundException=StandInResourceNotFoundException)
+
+    # Shared between all the clients, by table name.  Items are bucketed by their hash key
+    tables = {}
+    key_schemas = {}
+
+    def describe_table(self, TableName):
+        simulate_latency("dynamodb")
+        if TableName not in self.key_schemas:
+            raise StandInResourceNotFoundException(TableName)
+        return {"Table": {"TableName": TableName, "TableStatus": "ACTIVE"}}
+
+    def create_table(self, TableName, KeySchema, **kwargs):
+        simulate_latency("dynamodb")
+        self.key_schemas[TableName] = [item.get("AttributeName") for item in KeySchema]
+        self.tables.setdefault(TableName, {})
+
+    def get_waiter(self, name):
+        return SimpleNamespace(wait=lambda **kwargs: None)
+
+    @classmethod
+    def hash_key(cls, table_name, item):
+        attribute = cls.key_schemas.get(table_name, [None])[0]
+        value = item.get(attribute, {})
+        return str(value)
+
+    def get_item(self, TableName, Key, ConsistentRead=False):
+        simulate_latency("dynamodb")
+        item = self.find_item(TableName, Key)
+        if item is None:
+            return {}
+        return {"Item": dict(item)}
+
+    @classmethod
+    def find_item(cls, table_name, key):
+        bucket = cls.tables.get(table_name, {}).get(cls.hash_key(table_name, key), [])
+        for item in bucket:
+            if all(item.get(name) == value for (name, value) in key.items()):
+                return item
+        return None
+
+    def put_item(self, TableName, Item):
+        simulate_latency("dynamodb")
+        self.store_item(TableName, Item)
+        return {}
+
+    def batch_get_item(self, RequestItems):
+        simulate_latency("dynamodb")
+        responses = {}
+        for (table_name, request) in RequestItems.items():
+            keys = request.get("Keys", [])
+            if len(keys) > 100:
+                raise ValueError("Too many keys in a batch get (%s)" % len(keys))
+            items = [self.find_item(table_name, key) for key in keys]
+            responses[table_name] = [dict(item) for item in items if item is not None]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems):
+        simulate_latency("dynamodb")
+        for (table_name, requests) in RequestItems.items():
+            if len(requests) > 25:
+                raise ValueError("Too many items in a batch write (%s)" % len(requests))
+            for request in requests:
+                self.store_item(table_name, request.get("PutRequest", {}).get("Item", {}))
+        return {"UnprocessedItems": {}}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        # Only understands the "SET #a = :a, ... REMOVE #b, ..." that Database.update_item sends
+        simulate_latency("dynamodb")
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        item = dict(self.find_item(TableName, Key) or Key)
+        parts = re.split(r"\b(SET|REMOVE)\b", UpdateExpression)
+        if parts[0].strip():
+            raise ValueError("Invalid UpdateExpression: %s" % UpdateExpression)
+        for (action, clause) in zip(parts[1::2], parts[2::2]):
+            for part in clause.split(","):
+                if action == "SET":
+                    match = update_set_re.match(part)
+                    if not match or match.group("value") not in values:
+                        raise ValueError("Invalid SET clause in UpdateExpression: %s" % part.strip())
+                    item[names.get(match.group("name"), match.group("name"))] = values[match.group("value")]
+                else:
+                    match = update_remove_re.match(part)
+                    if not match:
+                        raise ValueError("Invalid REMOVE clause in UpdateExpression: %s" % part.strip())
+                    item.pop(names.get(match.group("name"), match.group("name")), None)
+        self.store_item(TableName, item)
+        return {}
+
+    @classmethod
+    def store_item(cls, table_name, item):
+        bucket = cls.tables.setdefault(table_name, {}).setdefault(cls.hash_key(table_name, item), [])
+        key_attributes = cls.key_schemas.get(table_name, [])
+        for (index, existing) in enumerate(bucket):
+            if all(existing.get(key) == item.get(key) for key in key_attributes):
+                bucket[index] = dict(item)
+                return
+        bucket.append(dict(item))
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, ProjectionExpression=None, ExpressionAttributeNames=None,
+             ExclusiveStartKey=None, Limit=None, **kwargs):
+        simulate_latency("dynamodb")
+        # Segments are split by hash key, and pages carry on from the position after the start key
+        buckets = sorted(self.tables.get(TableName, {}).items())
+        items = [item for (hash_key, bucket) in buckets
+                 if int(hashlib.md5(hash_key.encode("utf-8")).hexdigest(), 16) % TotalSegments == Segment
+                 for item in bucket]
+        start = int(ExclusiveStartKey.get("position", {}).get("N", 0)) if ExclusiveStartKey else 0
+        end = start + (Limit or 100)
+        page = items[start:end]
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            attributes = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(",")]
+            page = [{key: value for (key, value) in item.items() if key in attributes} for item in page]
+        response = {"Items": [dict(item) for item in page], "Count": len(page)}
+        if end < len(items):
+            response["LastEvaluatedKey"] = {"position": {"N": str(end)}}
+        return response
+
+    def get_paginator(self, operation):
+        if operation != "scan":
+            raise NotImplementedError("Paginator %s not supported by the stand-in" % operation)
+        return SimpleNamespace(paginate=self.paginate_scan)
+
+    def paginate_scan(self, TableName, PaginationConfig=None, **kwargs):
+        items = [item for bucket in self.tables.get(TableName, {}).values() for item in bucket]
+        page_size = 100
+        for start in range(0, max(len(items), 1), page_size):
+            simulate_latency("dynamodb")
+            yield {"Items": [dict(item) for item in items[start:start + page_size]]}
+
+
+class StandInSecretsManager(object):
+    exceptions = SimpleNamespace(ResourceExistsException=StandInResourceExistsException)
+    secrets = {}
+
+    def get_secret_value(self, SecretId):
+        simulate_latency("secretsmanager")
+        if SecretId not in self.secrets:
+            raise StandInResourceNotFoundException(SecretId)
+        return {"SecretString": self.secrets[SecretId]}
+
+    def create_secret(self, Name, SecretString=None, **kwargs):
+        simulate_latency("secretsmanager")
+        if Name in self.secrets:
+            raise StandInResourceExistsException(Name)
+        self.secrets[Name] = SecretString
+
+
+class StandInSession(object):
+    clients = {
+        "dynamodb": StandInDynamoDB,
+        "secretsmanager": StandInSecretsManager,
+    }
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def client(self, service_name, **kwargs):
+        klass = self.clients.get(service_name, None)
+        if not klass:
+            raise NotImplementedError("No stand-in for %s" % service_name)
+        return klass()
+
+
+class StandInRedis(object):
+    def __init__(self, **kwargs):
+        self.data = {}
+
+    def get(self, key):
+        simulate_latency("redis")
+        return self.data.get(key, None)
+
+    def set(self, key, value):
+        simulate_latency("redis")
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        simulate_latency("redis")
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+
+class StandInAPI(object):
+    name = None
+
+    def __init__(self, config):
+        pass
+
+    def call(self, method, *args, **kwargs):
+        kwargs.pop("timeout", None)
+        kwargs.pop("openapi_validate", None)
+        offload_executor.run("api", simulate_latency, self.name)
+
+        func = getattr(self, "api_%s" % method, None)
+        if not func:
+            raise SwaggerAPIError(501, "%s not supported by the %s stand-in" % (method, self.name))
+        return func(*args, **kwargs)
+
+
+class StandInWalletAPI(StandInAPI):
+    # Stands in for keosd
+    name = "keosd"
+
+    def __init__(self, config):
+        StandInAPI.__init__(self, config)
+        self.wallets = {}
+
+    def get_wallet(self, wallet_name):
+        # Wallets the stand-in hasn't seen yet (like the seeded ones) spring into existence
+        return self.wallets.setdefault(wallet_name, {"password": "PW" + secrets.token_hex(16), "keys": {}})
+
+    def api_create(self, wallet_name):
+        return self.get_wallet(wallet_name).get("password")
+
+    def api_create_key(self, wallet_name, key_type):
+        public = "EOS" + secrets.token_hex(25)
+        self.get_wallet(wallet_name)["keys"][public] = "5" + secrets.token_hex(25)
+        return public
+
+    def api_open(self, wallet_name):
+        wallet = self.get_wallet(wallet_name)
+        if not wallet["keys"]:
+            self.api_create_key(wallet_name, "")
+            self.api_create_key(wallet_name, "")
+        return {}
+
+    def api_unlock(self, wallet_name, password):
+        return {}
+
+    def api_lock(self, wallet_name):
+        return {}
+
+    def api_list_keys(self, wallet_name, password):
+        return [[public, private] for (public, private) in self.get_wallet(wallet_name)["keys"].items()]
+
+
+class StandInChainAPI(StandInAPI):
+    # Stands in for nodeos
+    name = "nodeos"
+
+    def api_get_currency_balance(self, code, account, symbol):
+        return []
+
+    def api_get_table_rows(self, **kwargs):
+        return {"rows": [], "more": False}
+
+
+class StandInEmailHandler(object):
+    def __init__(self, config):
+        self.sent = 0
+
+    def send_email(self, from_, to, subject, body_html=None, body_text=None):
+        offload_executor.run("email", simulate_latency, "ses")
+        self.sent += 1
+        logger.debug("Not sending email to %s: %s" % (to, subject))
+
+
+class StandInDNSLookup(object):
+    def do_reverse_dns(self, ipaddr):
+        offload_executor.run("dns", simulate_latency, "dns")
+        return "loadtest.invalid"
+
+
+def install(service_latency=None):
+    # Must be called before the Server is created
+    import HavokMud.redis_handler
+    import HavokMud.server
+
+    latency.update(service_latency or {})
+
+    boto3.session.Session = StandInSession
+    HavokMud.redis_handler.Redis = StandInRedis
+    HavokMud.server.EOSWalletAPI = StandInWalletAPI
+    HavokMud.server.EOSChainAPI = StandInChainAPI
+    HavokMud.server.EmailHandler = StandInEmailHandler
+    HavokMud.server.DNSLookup = StandInDNSLookup
+    logger.info("Stand-in backends installed (latency: %s)" % latency)
+
+
+def seed_accounts(count, email_format="loadtest%d@example.com", password="loadtest-password",
+                  player_format="Loadtest%d"):
+    # Confirmed accounts with a player each, ready to log in and play
+    from HavokMud.database.account_db import AccountDB
+    from HavokMud.database.user_db import UserDB
+
+    digest = hashlib.sha512(password.encode("utf-8")).hexdigest()
+    for (table, key_schema) in [(AccountDB.table, AccountDB.db_key_schema), (UserDB.table, UserDB.db_key_schema)]:
+        StandInDynamoDB.key_schemas[table] = [item.get("AttributeName") for item in key_schema]
+
+    for index in range(count):
+        email = email_format % index
+        display_name = player_format % index
+        player_name = display_name.lower()
+        account = {
+            "email": email,
+            "password": digest,
+            "ansi_mode": True,
+            "confirmed": True,
+            "confcode": None,
+            "players": [player_name],
+            "wallet_password": {},
+            "wallet_owner_key": {},
+            "wallet_active_key": {},
+            "wallet_keys": {},
+        }
+        player = {
+            "email": email,
+            "player_name": player_name,
+            "name": player_name,
+            "display_name": display_name,
+            "complete": True,
+        }
+        StandInDynamoDB.store_item(AccountDB.table, {key: _convert_to_dynamodb(value)
+                                                     for (key, value) in account.items()})
+        StandInDynamoDB.store_item(UserDB.table, {key: _convert_to_dynamodb(value)
+                                                  for (key, value) in player.items()})
+    logger.info("Seeded %s accounts" % count)
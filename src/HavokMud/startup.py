@@ -7,6 +7,7 @@ HavokMud.stacklesssocket.install()
 import gc
 import logging
 import os
+import signal
 import stackless
 
 from HavokMud.config_loader import load_config_file
@@ -14,6 +15,7 @@ from HavokMud.database import Databases
 from HavokMud.logging_support import logging_setup, logging_additional_setup
 from HavokMud.server import Server
 from HavokMud.settings import Settings
+from HavokMud.writebehind import write_behind
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +34,17 @@ def start_mud(loglevel=None, looping=False):
 
     logging_additional_setup(config.get("loggingLevels", {}))
 
+    # This must be chosen before any sockets get created
+    HavokMud.stacklesssocket.select_reactor(config.get("mud", {}).get("reactor", "selectors"))
+
+    # As must forking off the workers
+    worker_id = 0
+    workers = config.get("mud", {}).get("workers", 1)
+    if looping and workers > 1:
+        worker_id = launch_workers(workers)
+        if worker_id is None:
+            return 0
+
     if config.get("mud", {}).get("debug_gc", False):
         gc.set_debug(gc.DEBUG_STATS)
 
@@ -52,14 +65,63 @@ def start_mud(loglevel=None, looping=False):
 
     global server_instance
     if looping:
+        # Stopping the server (SIGTERM too) writes out anything still waiting to be saved
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
         try:
-            server_instance = Server(config, dbs)
+            server_instance = Server(config, dbs, worker_id=worker_id)
             while True:
                 stackless.run()
         except KeyboardInterrupt:
             logger.info("Server manually stopped")
             # traceback.print_exc()
+        finally:
+            write_behind.flush_on_exit()
     else:
         server_instance = Server(config, dbs)
 
     return 0
+
+
+def launch_workers(count):
+    # Returns the worker id in each of the worker processes.  The launcher process stays in here
+    # restarting any workers that die, and returns None once it's been stopped.
+    children = {}
+
+    def spawn(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            return True
+        logger.info("Started worker %s as PID %s" % (worker_id, pid))
+        children[pid] = worker_id
+        return False
+
+    # SIGTERM stops the launcher the same way Ctrl-C does, taking the workers down with it
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    for worker_id in range(count):
+        if spawn(worker_id):
+            return worker_id
+
+    stopping = False
+    while children:
+        try:
+            (pid, status) = os.wait()
+        except KeyboardInterrupt:
+            logger.info("Stopping workers")
+            stopping = True
+            for pid in children.keys():
+                os.kill(pid, signal.SIGTERM)
+            continue
+        except ChildProcessError:
+            break
+
+        worker_id = children.pop(pid, None)
+        if worker_id is None or stopping:
+            continue
+
+        logger.error("Worker %s (PID %s) exited with status %s, restarting" % (worker_id, pid, status))
+        if spawn(worker_id):
+            return worker_id
+
+    return None
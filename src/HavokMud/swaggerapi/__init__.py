@@ -37,6 +37,7 @@ from openapi_core.validation.request.validators import RequestValidator
 from openapi_core.validation.response.validators import ResponseValidator
 
 from HavokMud.api_handler import api_handler
+from HavokMud.metrics import metrics
 from HavokMud.utils import log_call
 
 logger = logging.getLogger(__name__)
@@ -140,6 +141,10 @@ class SwaggerAPI(object):
 
     @log_call
     def call(self, method, *args, **kwargs):
+        with metrics.timer("api.%s.%s" % (self.name, method)):
+            return self.make_call(method, *args, **kwargs)
+
+    def make_call(self, method, *args, **kwargs):
         timeout = kwargs.pop("timeout", 10)
         openapi_validate = kwargs.pop("openapi_validate", True)
 
@@ -0,0 +1,152 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Commands defined in RFC854
+SE = 240  # end of subnegotiation
+NOP = 241
+DATA_MARK = 242  # should have TCP urgent
+BRK = 243  # break
+IP = 244  # interrupt process
+AO = 245  # abort output
+AYT = 246  # are you there
+EC = 247  # erase character
+EL = 248  # erase line
+GA = 249  # go ahead
+SB = 250  # start subnegotiation
+WILL = 251
+WONT = 252
+DO = 253
+DONT = 254
+IAC = 255
+
+# Options
+ECHO = 1
+TTYPE = 24  # RFC1091
+NAWS = 31  # RFC1073
+LINEMODE = 34  # RFC1184
+COMPRESS2 = 86  # MCCP2
+
+TTYPE_IS = 0
+TTYPE_SEND = 1
+
+LINEMODE_MODE = 1
+
+IAC_BYTE = bytes([IAC])
+
+
+def negotiation(command, option):
+    return bytes([IAC, command, option])
+
+
+def subnegotiation(option, data=b""):
+    data = bytes(data).replace(IAC_BYTE, IAC_BYTE + IAC_BYTE)
+    return bytes([IAC, SB, option]) + data + bytes([IAC, SE])
+
+
+class TelnetParser(object):
+    """
+    Incremental telnet protocol parser.  feed() strips the telnet commands out of each chunk of data
+    received in a single pass, and returns the remaining data.  The state is kept between calls, so
+    commands split across reads are handled correctly.  Commands are handed to the callbacks:
+
+    on_command(command) for the two byte commands (NOP, AYT, etc)
+    on_negotiation(command, option) for WILL/WONT/DO/DONT
+    on_subnegotiation(option, data) for IAC SB option ... IAC SE
+    """
+    STATE_DATA = 0
+    STATE_IAC = 1
+    STATE_OPTION = 2
+    STATE_SB_OPTION = 3
+    STATE_SB = 4
+    STATE_SB_IAC = 5
+
+    # Anything longer than this is junk, and is truncated
+    max_subnegotiation = 1024
+
+    def __init__(self, on_command=None, on_negotiation=None, on_subnegotiation=None):
+        self.on_command = on_command
+        self.on_negotiation = on_negotiation
+        self.on_subnegotiation = on_subnegotiation
+        self.state = self.STATE_DATA
+        self.command = None
+        self.sb_option = None
+        self.sb_data = bytearray()
+
+    def feed(self, data):
+        output = bytearray()
+        index = 0
+        length = len(data)
+        state = self.state
+
+        while index < length:
+            if state == self.STATE_DATA:
+                end = data.find(IAC_BYTE, index)
+                if end == -1:
+                    output += data[index:]
+                    break
+                output += data[index:end]
+                index = end + 1
+                state = self.STATE_IAC
+                continue
+
+            if state == self.STATE_SB:
+                end = data.find(IAC_BYTE, index)
+                if end == -1:
+                    end = length
+                else:
+                    state = self.STATE_SB_IAC
+                room = self.max_subnegotiation - len(self.sb_data)
+                if room > 0:
+                    self.sb_data += data[index:min(end, index + room)]
+                index = end + 1
+                continue
+
+            byte = data[index]
+            index += 1
+
+            if state == self.STATE_IAC:
+                if byte == IAC:
+                    # IAC IAC is a literal 0xFF
+                    output.append(IAC)
+                    state = self.STATE_DATA
+                elif WILL <= byte <= DONT:
+                    self.command = byte
+                    state = self.STATE_OPTION
+                elif byte == SB:
+                    state = self.STATE_SB_OPTION
+                else:
+                    self._dispatch(self.on_command, byte)
+                    state = self.STATE_DATA
+            elif state == self.STATE_OPTION:
+                self._dispatch(self.on_negotiation, self.command, byte)
+                state = self.STATE_DATA
+            elif state == self.STATE_SB_OPTION:
+                self.sb_option = byte
+                self.sb_data = bytearray()
+                state = self.STATE_SB
+            elif state == self.STATE_SB_IAC:
+                if byte == IAC:
+                    if len(self.sb_data) < self.max_subnegotiation:
+                        self.sb_data.append(IAC)
+                    state = self.STATE_SB
+                else:
+                    self._dispatch(self.on_subnegotiation, self.sb_option, bytes(self.sb_data))
+                    self.sb_data = bytearray()
+                    state = self.STATE_DATA
+                    if byte != SE:
+                        # Unterminated subnegotiation, treat this as the command following IAC
+                        index -= 1
+                        state = self.STATE_IAC
+
+        self.state = state
+        return bytes(output)
+
+    @staticmethod
+    def _dispatch(callback, *args):
+        if not callback:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Exception handling telnet command %s" % (args,))
@@ -0,0 +1,128 @@
+import logging
+import math
+import time
+
+from HavokMud import stacklesssocket
+
+logger = logging.getLogger(__name__)
+
+
+class WheelTimer(object):
+    def __init__(self, wheel, expiry, callback, args):
+        self.wheel = wheel
+        self.expiry = expiry
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        # O(1): just take it out of whichever slot it is in
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel for coarse timeouts (idle, login, keepalive).  Adding and cancelling
+    a timer is O(1), and however many timers are pending, there is only ever one reactor timer
+    (stacklesssocket.call_later) driving the wheel.  Level 0 has one slot per tick, and each level
+    above covers the whole of the level below in each slot.  When level 0 wraps around, the next
+    slot up is cascaded down.
+
+    Callbacks are run from the socket reactor, so they must not block.  Anything that needs to wait
+    (for output to drain, a database call, etc) should start a tasklet.
+    """
+    level_bits = (8, 6, 6, 6)
+
+    def __init__(self, tick=0.5):
+        self.tick = tick
+        self.levels = [[set() for i in range(1 << bits)] for bits in self.level_bits]
+        self.shifts = []
+        shift = 0
+        for bits in self.level_bits:
+            self.shifts.append(shift)
+            shift += bits
+        self.max_ticks = (1 << shift) - 1
+        self.start_time = time.monotonic()
+        self.current_tick = 0
+        self.count = 0
+        self.reactor_timer = None
+
+    def now_tick(self):
+        return int((time.monotonic() - self.start_time) / self.tick)
+
+    def call_later(self, delay, callback, *args):
+        if not self.count:
+            # Nothing was pending, so the wheel wasn't turning.  Catch up to now.
+            self.current_tick = max(self.current_tick, self.now_tick())
+
+        ticks = min(max(int(math.ceil(delay / self.tick)), 1), self.max_ticks)
+        timer = WheelTimer(self, self.current_tick + ticks, callback, args)
+        self.insert(timer)
+        self.count += 1
+
+        if not self.reactor_timer:
+            self.schedule()
+        return timer
+
+    def insert(self, timer):
+        ticks = max(timer.expiry - self.current_tick, 0)
+        for (level, bits) in enumerate(self.level_bits):
+            shift = self.shifts[level]
+            if ticks < (1 << (shift + bits)) or level == len(self.level_bits) - 1:
+                slots = self.levels[level]
+                slot = slots[(timer.expiry >> shift) & (len(slots) - 1)]
+                slot.add(timer)
+                timer.slot = slot
+                return
+
+    def schedule(self):
+        deadline = self.start_time + (self.current_tick + 1) * self.tick
+        self.reactor_timer = stacklesssocket.call_at(deadline, self.on_tick)
+
+    def on_tick(self):
+        self.reactor_timer = None
+        target = self.now_tick()
+        while self.current_tick < target and self.count:
+            self.advance()
+        if self.count:
+            self.schedule()
+
+    def advance(self):
+        self.current_tick += 1
+        tick = self.current_tick
+
+        # Cascade the higher levels down as each one below wraps around
+        for level in range(1, len(self.level_bits)):
+            if tick & ((1 << self.shifts[level]) - 1):
+                break
+            slots = self.levels[level]
+            slot = slots[(tick >> self.shifts[level]) & (len(slots) - 1)]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self.insert(timer)
+
+        slots = self.levels[0]
+        slot = slots[tick & (len(slots) - 1)]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            if timer.slot is not slot:
+                # Cancelled by one of the callbacks before it
+                continue
+            timer.slot = None
+            self.count -= 1
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Exception in timer callback %s" % timer.callback)
+
+
+timing_wheel = TimingWheel()
@@ -0,0 +1,31 @@
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows bursts of up to "burst" tokens, refilling at "rate" tokens a second.  Taking more than is
+    there is allowed as long as the bucket is full enough (or full, for costs bigger than the bucket),
+    leaving it in debt, so expensive things delay whatever comes after them.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1):
+        # Returns 0 if the tokens were taken, otherwise how long (in seconds) to wait before trying again
+        if not self.rate:
+            return 0
+        self.refill()
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0
+        return (needed - self.tokens) / self.rate
@@ -1,10 +1,11 @@
 import logging
 import stackless
-import time
 import traceback
 
+from HavokMud import stacklesssocket
 from HavokMud.account import Account
 from HavokMud.logging_support import AccountLogHandler, PlayerLogHandler, AccountLogMessage
+from HavokMud.writebehind import write_behind
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +44,9 @@ class User(object):
         except Exception:
             traceback.print_exc()
         finally:
+            # Anything saved but not yet written goes out now they're gone
+            if self.account.email:
+                write_behind.flush([self.account, self.account.player, self.account.current_player])
             if self.connection:
                 if self.account.email:
                     AccountLogHandler().closeEmail(self.account.email)
@@ -54,7 +58,7 @@ class User(object):
     def handle_command(self):
         handler = self.connection.handler
         if handler is None:
-            time.sleep(0.5)
+            stacklesssocket.sleep(0.5)
             return
 
         if handler.external:
@@ -66,13 +70,21 @@ class User(object):
         else:
             handler.send_prompt("> ")
 
-            line = self.connection.input_channel.receive()
+            line = self.connection.get_input()
             if line is None:
                 raise RemoteDisconnectionError()
 
             tokens = handler.tokenize_input(line)
+            # Expensive commands use up more of the allowance
+            delay = self.connection.command_bucket.take(handler.command_cost(tokens))
+            while delay:
+                stacklesssocket.sleep(delay)
+                delay = self.connection.command_bucket.take(handler.command_cost(tokens))
             handler.handle_input(tokens)
 
+            # One command at a time, so everyone else gets a turn before the next one
+            stackless.schedule()
+
     def on_remote_disconnection(self):
         logger.info(AccountLogMessage(self.account, "Disconnected %s (remote)" % self.account.ip_address, _global=True))
 
@@ -305,6 +305,21 @@ class Wallet(object):
         wallet.lock()
         return wallet
 
+    @staticmethod
+    def restore(owner, wallet_type):
+        # Rebuilds a wallet that was already loaded before a copyover from what the owner has stored,
+        # without going back to keosd.  Returns None if the owner doesn't have this wallet yet.
+        password = owner.wallet_password.get(str(wallet_type), None)
+        if not password:
+            return None
+
+        wallet_info = Wallet._hash_wallet_name(owner, wallet_type)
+        wallet = Wallet(owner, wallet_type)
+        wallet.wallet_name = wallet_info.get("wallet_name", None)
+        wallet.password = password
+        wallet.keys = dict(owner.wallet_keys.get(str(wallet_type), {}))
+        return wallet
+
     def unlock(self):
         password = self.server.encryption.decrypt_string(self.password)
         try:
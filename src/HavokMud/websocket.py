@@ -0,0 +1,398 @@
+import base64
+import hashlib
+import logging
+import socket
+import struct
+import zlib
+
+from HavokMud.connection import Connection
+
+logger = logging.getLogger(__name__)
+
+# RFC 6455
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+FIN = 0x80
+RSV1 = 0x40
+MASK = 0x80
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED = 1003
+CLOSE_POLICY = 1008
+CLOSE_TOO_BIG = 1009
+CLOSE_SERVICE_RESTART = 1012
+
+# RFC 7692: each compressed message has this sync flush trailer removed
+DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+MAX_HANDSHAKE_SIZE = 8192
+
+
+class WebSocketError(Exception):
+    def __init__(self, code, reason):
+        Exception.__init__(self, reason)
+        self.code = code
+        self.reason = reason
+
+
+class HandshakeError(Exception):
+    def __init__(self, status, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.reason = reason
+
+
+def encode_frame(opcode, payload, rsv1=False):
+    # Server frames are never masked
+    first = FIN | opcode
+    if rsv1:
+        first |= RSV1
+    length = len(payload)
+    if length < 126:
+        return struct.pack("!BB", first, length)
+    if length < 65536:
+        return struct.pack("!BBH", first, 126, length)
+    return struct.pack("!BBQ", first, 127, length)
+
+
+def unmask(payload, mask):
+    # XOR the whole payload in one go as big integers rather than a byte at a time
+    length = len(payload)
+    if not length:
+        return b""
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+
+def parse_extensions(header):
+    # "a; x=1, b" -> [("a", {"x": "1"}), ("b", {})]
+    extensions = []
+    for offer in header.split(","):
+        items = [item.strip() for item in offer.split(";")]
+        if not items[0]:
+            continue
+        params = {}
+        for item in items[1:]:
+            (name, _, value) = item.partition("=")
+            params[name.strip().lower()] = value.strip().strip('"') or None
+        extensions.append((items[0].lower(), params))
+    return extensions
+
+
+class PerMessageDeflate(object):
+    """
+    permessage-deflate (RFC 7692).  Unless the client asked for no context takeover, the compressor
+    keeps its window between messages, which is where most of the gain comes from on MUD output.
+    """
+
+    def __init__(self, params, level=6):
+        self.level = level
+        self.server_no_context_takeover = "server_no_context_takeover" in params
+        self.client_no_context_takeover = "client_no_context_takeover" in params
+        self.server_max_window_bits = 15
+        if "server_max_window_bits" in params:
+            bits = int(params.get("server_max_window_bits") or 15)
+            if not 8 <= bits <= 15:
+                raise ValueError("Bad server_max_window_bits %s" % bits)
+            # zlib can't do raw deflate with an 8 bit window
+            self.server_max_window_bits = max(bits, 9)
+        self.response_params = [name for name in ("server_no_context_takeover", "client_no_context_takeover")
+                                if name in params]
+        if "server_max_window_bits" in params:
+            self.response_params.append("server_max_window_bits=%s" % self.server_max_window_bits)
+        self.compressor = None
+        self.decompressor = None
+
+    @classmethod
+    def negotiate(cls, header, level=6):
+        # Returns the first offer we can accept (or None)
+        for (name, params) in parse_extensions(header):
+            if name != "permessage-deflate":
+                continue
+            try:
+                return cls(params, level)
+            except ValueError:
+                continue
+        return None
+
+    def get_response(self):
+        return "; ".join(["permessage-deflate"] + self.response_params)
+
+    def compress(self, data):
+        if self.compressor is None or self.server_no_context_takeover:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, -self.server_max_window_bits)
+        data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(DEFLATE_TAIL):
+            data = data[:-len(DEFLATE_TAIL)]
+        return data
+
+    def decompress(self, data, max_size):
+        if self.decompressor is None or self.client_no_context_takeover:
+            self.decompressor = zlib.decompressobj(-15)
+        try:
+            data = self.decompressor.decompress(data + DEFLATE_TAIL, max_size)
+        except zlib.error as e:
+            raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Bad compressed data: %s" % e)
+        if self.decompressor.unconsumed_tail:
+            raise WebSocketError(CLOSE_TOO_BIG, "Message too big")
+        return data
+
+
+def read_handshake(client_socket):
+    data = bytearray()
+    while b"\r\n\r\n" not in data:
+        if len(data) > MAX_HANDSHAKE_SIZE:
+            raise HandshakeError(431, "Request Header Fields Too Large")
+        chunk = client_socket.recv(4096)
+        if not chunk:
+            raise HandshakeError(None, "Connection closed during handshake")
+        data += chunk
+
+    (head, _, leftover) = bytes(data).partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    request = lines[0].split()
+    if len(request) != 3 or request[0] != "GET" or not request[2].startswith("HTTP/1."):
+        raise HandshakeError(400, "Bad Request")
+
+    headers = {}
+    for line in lines[1:]:
+        (name, _, value) = line.partition(":")
+        name = name.strip().lower()
+        value = value.strip()
+        if name in headers:
+            headers[name] += ", " + value
+        else:
+            headers[name] = value
+    return (request[1], headers, leftover)
+
+
+def check_handshake(headers, allowed_origins):
+    upgrade = [item.strip().lower() for item in headers.get("upgrade", "").split(",")]
+    connection = [item.strip().lower() for item in headers.get("connection", "").split(",")]
+    if "websocket" not in upgrade or "upgrade" not in connection:
+        raise HandshakeError(426, "Upgrade Required")
+    if headers.get("sec-websocket-version", "") != "13":
+        raise HandshakeError(426, "Upgrade Required")
+    key = headers.get("sec-websocket-key", "")
+    try:
+        if len(base64.b64decode(key, validate=True)) != 16:
+            raise ValueError(key)
+    except ValueError:
+        raise HandshakeError(400, "Bad Request")
+    if allowed_origins and headers.get("origin", None) not in allowed_origins:
+        raise HandshakeError(403, "Forbidden")
+    return base64.b64encode(hashlib.sha1(key.encode("ascii") + WEBSOCKET_GUID).digest()).decode("ascii")
+
+
+def accept_websocket(client_socket, client_address):
+    # Runs in its own tasklet, so a slow client only holds up itself
+    from HavokMud.startup import server_instance
+    connection_config = server_instance.config.get("connection", {})
+    client_socket.settimeout(connection_config.get("websocket_handshake_timeout", 10))
+
+    try:
+        (path, headers, leftover) = read_handshake(client_socket)
+        accept_key = check_handshake(headers, connection_config.get("websocket_origins", []))
+    except (HandshakeError, socket.timeout, OSError) as e:
+        status = getattr(e, "status", None)
+        logger.info("WebSocket handshake from %s:%s failed: %s" % (client_address[0], client_address[1], e))
+        try:
+            if status:
+                client_socket.sendall(("HTTP/1.1 %s %s\r\nSec-WebSocket-Version: 13\r\nConnection: close\r\n"
+                                       "Content-Length: 0\r\n\r\n" % (status, e.reason)).encode("ascii"))
+        except OSError:
+            pass
+        client_socket.close()
+        return
+
+    deflate = None
+    if connection_config.get("websocket_compression", True):
+        deflate = PerMessageDeflate.negotiate(headers.get("sec-websocket-extensions", ""),
+                                              connection_config.get("compression_level", 6))
+
+    response = ["HTTP/1.1 101 Switching Protocols",
+                "Upgrade: websocket",
+                "Connection: Upgrade",
+                "Sec-WebSocket-Accept: %s" % accept_key]
+    if deflate:
+        response.append("Sec-WebSocket-Extensions: %s" % deflate.get_response())
+    client_socket.sendmsg([("\r\n".join(response) + "\r\n\r\n").encode("ascii")])
+
+    logger.info("WebSocket upgrade for %s:%s on %s (compression: %s)" %
+                (client_address[0], client_address[1], path, bool(deflate)))
+    WebSocketConnection(client_socket, client_address, deflate, leftover)
+
+
+class WebSocketConnection(Connection):
+    """
+    A Connection for browser clients.  Each text message from the client is a line (or several) of
+    input, and everything flushed from the output queue in one go is sent as a single text frame, so
+    the handlers behind it see exactly the same interface as with telnet.  There's no telnet
+    negotiation, and external commands (which need a raw terminal) aren't available.
+    """
+    supports_external = False
+    # Smaller messages are sent uncompressed, as deflate would only make them bigger
+    compress_min_size = 64
+
+    def __init__(self, client_socket, client_address, deflate=None, leftover=b""):
+        self.deflate = deflate
+        self.frame_buffer = bytearray(leftover)
+        self.message = None
+        self.message_compressed = False
+        self.close_sent = False
+        Connection.__init__(self, client_socket, client_address)
+        self.max_message_size = self.server.config.get("connection", {}).get("websocket_max_message", 65536)
+
+    def start_negotiation(self):
+        pass
+
+    def set_echo(self, value):
+        # The browser client looks after its own input
+        pass
+
+    def send_keepalive(self):
+        self.send_control(OP_PING)
+
+    def send_control(self, opcode, payload=b""):
+        # Control frames go straight out (sendmsg doesn't yield, so they can't split a data frame), and
+        # aren't compressed
+        if self.client_socket.send_buffer is None:
+            return
+        try:
+            self.client_socket.sendmsg([encode_frame(opcode, payload), payload])
+        except OSError as e:
+            logger.debug("Control frame to %s:%s failed: %s" % (self.client_address[0], self.client_address[1], e))
+
+    def send_close(self, code, reason=""):
+        if self.close_sent:
+            return
+        self.close_sent = True
+        self.send_control(OP_CLOSE, struct.pack("!H", code) + reason.encode("utf-8")[:120])
+
+    def disconnect(self):
+        self.send_close(CLOSE_NORMAL)
+        Connection.disconnect(self)
+
+    def evict(self, reason):
+        if not self.evicted:
+            self.send_close(CLOSE_POLICY, reason)
+        Connection.evict(self, reason)
+
+    def prepare_copyover(self, message):
+        self.write_line(message)
+
+    def get_copyover_state(self):
+        # The permessage-deflate state can't be carried over, so browser clients are asked to reconnect
+        self.send_close(CLOSE_SERVICE_RESTART, "Server restarting")
+        return None
+
+    def send_buffers(self, buffers, mode=zlib.Z_SYNC_FLUSH):
+        # One text frame per flush
+        if not buffers:
+            return
+
+        payload = b"".join(buffers)
+        raw_bytes = len(payload)
+        compressed = bool(self.deflate) and raw_bytes >= self.compress_min_size
+        if compressed:
+            payload = self.deflate.compress(payload)
+
+        header = encode_frame(OP_TEXT, payload, compressed)
+        self.output_stats["flushes"] += 1
+        self.output_stats["raw_bytes"] += raw_bytes
+        self.output_stats["bytes"] += self.client_socket.sendmsg([header, payload])
+
+    def read_frame(self):
+        # Returns (fin, rsv1, opcode, payload), or None if the connection closed
+        buffer = self.frame_buffer
+        while True:
+            if len(buffer) >= 2:
+                length = buffer[1] & 0x7F
+                offset = 2
+                if length == 126:
+                    offset = 4
+                elif length == 127:
+                    offset = 10
+                if len(buffer) >= offset:
+                    if offset == 4:
+                        length = struct.unpack_from("!H", buffer, 2)[0]
+                    elif offset == 10:
+                        length = struct.unpack_from("!Q", buffer, 2)[0]
+                    if not buffer[1] & MASK:
+                        raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Client frames must be masked")
+                    if length > self.max_message_size:
+                        raise WebSocketError(CLOSE_TOO_BIG, "Frame too big")
+                    end = offset + 4 + length
+                    if len(buffer) >= end:
+                        first = buffer[0]
+                        payload = unmask(bytes(buffer[offset + 4:end]), bytes(buffer[offset:offset + 4]))
+                        del buffer[:end]
+                        return (bool(first & FIN), bool(first & RSV1), first & 0x0F, payload)
+
+            try:
+                data = self.client_socket.recv(4096)
+            except Exception:
+                data = b""
+            if not data:
+                return None
+            buffer += data
+
+    def read_input(self):
+        # Waits for a complete data message, answering control frames along the way
+        try:
+            while True:
+                frame = self.read_frame()
+                if frame is None:
+                    return None
+
+                (fin, rsv1, opcode, payload) = frame
+                if opcode >= OP_CLOSE:
+                    if not fin or len(payload) > 125:
+                        raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Bad control frame")
+                    if opcode == OP_CLOSE:
+                        # Echo the status code back, and that's the end of it
+                        self.send_close(struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else CLOSE_NORMAL)
+                        return None
+                    if opcode == OP_PING:
+                        self.send_control(OP_PONG, payload)
+                    continue
+
+                if opcode == OP_CONTINUATION:
+                    if self.message is None or rsv1:
+                        raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Unexpected continuation frame")
+                elif opcode in (OP_TEXT, OP_BINARY):
+                    if self.message is not None:
+                        raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Expected a continuation frame")
+                    if rsv1 and not self.deflate:
+                        raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Compression wasn't negotiated")
+                    self.message = bytearray()
+                    self.message_compressed = rsv1
+                else:
+                    raise WebSocketError(CLOSE_PROTOCOL_ERROR, "Unknown opcode %s" % opcode)
+
+                self.message += payload
+                if len(self.message) > self.max_message_size:
+                    raise WebSocketError(CLOSE_TOO_BIG, "Message too big")
+                if not fin:
+                    continue
+
+                (data, self.message) = (bytes(self.message), None)
+                if self.message_compressed:
+                    data = self.deflate.decompress(data, self.max_message_size)
+                # Each message is at least one line
+                if not data.endswith(b"\n"):
+                    data += b"\n"
+                return data
+        except WebSocketError as e:
+            logger.info("WebSocket error from %s:%s: %s" % (self.client_address[0], self.client_address[1], e))
+            self.send_close(e.code, e.reason)
+            return None
@@ -0,0 +1,224 @@
+import logging
+import stackless
+import threading
+
+from HavokMud import stacklesssocket
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindCache(object):
+    """
+    Holds on to DatabaseObject saves for a short while (dynamodb.write_delay), so an object saved several
+    times in a row (every step of a login, every wallet load) is only written once.  When the delay is up,
+    each object is compared against what was last loaded or saved: unchanged ones aren't written at all,
+    ones already in the table get an UpdateItem with just the changed fields, and new ones are put with
+    BatchWriteItem, 25 at a time.  Writes that fail are tried again, backing off each time, until they've
+    failed dynamodb.write_attempts times, when they're given up on.
+
+    Until it's been configured (while the server is starting up), or with a delay of 0, saves are written
+    straight away.  Logging out, a copyover and shutting down all flush whatever is waiting.
+    """
+
+    def __init__(self):
+        self.delay = 0.5
+        self.max_attempts = 5
+        self.configured = False
+        # By id(), in the order they were saved
+        self.pending = {}
+        self.inflight = {}
+        # How many times in a row each object's write has failed, and those waiting to be tried again, by id()
+        self.attempts = {}
+        self.retrying = {}
+        self.scheduled = False
+        self.stats = {
+            "saves": 0,
+            "coalesced": 0,
+            "unchanged": 0,
+            "puts": 0,
+            "updates": 0,
+            "batches": 0,
+            "failures": 0,
+            "abandoned": 0,
+        }
+
+    def configure(self, config):
+        self.delay = config.get("dynamodb", {}).get("write_delay", self.delay)
+        self.max_attempts = config.get("dynamodb", {}).get("write_attempts", self.max_attempts)
+        self.configured = True
+
+    def save(self, obj):
+        self.stats["saves"] += 1
+        if not self.configured or self.delay <= 0:
+            self.write([obj])
+            return
+        self.queue(obj)
+
+    def queue(self, obj):
+        if self.pending.pop(id(obj), None) is not None:
+            self.stats["coalesced"] += 1
+        self.pending[id(obj)] = obj
+        if not self.scheduled:
+            self.scheduled = True
+            stackless.tasklet(self.flush_later)()
+
+    def retry(self, obj):
+        if self.retrying.pop(id(obj), None) is not None:
+            self.queue(obj)
+
+    def flush_later(self):
+        stacklesssocket.sleep(self.delay)
+        self.scheduled = False
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Flushing writes failed")
+
+    def flush(self, objects=None):
+        # Writes out everything waiting (or just the given objects, if they are), blocking the calling
+        # tasklet until it's done.  Anything waiting to be tried again is tried now.
+        if objects is None:
+            batch = list(self.pending.values()) + list(self.retrying.values())
+            self.pending.clear()
+            self.retrying.clear()
+        else:
+            batch = []
+            for obj in objects:
+                if obj is None:
+                    continue
+                obj = self.pending.pop(id(obj), None) or self.retrying.pop(id(obj), None)
+                if obj is not None:
+                    batch.append(obj)
+        if batch:
+            self.write(batch)
+
+    def flush_on_exit(self):
+        # The reactor has stopped, so this writes straight to DynamoDB from a thread of its own.  Anything
+        # that was part way through being written is written again in full.
+        objects = list(self.pending.values()) + list(self.retrying.values())
+        self.pending.clear()
+        self.retrying.clear()
+        for obj in self.inflight.values():
+            obj.__saved__ = None
+            objects.append(obj)
+        self.inflight.clear()
+        if not objects:
+            return
+
+        logger.info("Writing %s objects before exiting" % len(objects))
+        self.configured = False
+        thread = threading.Thread(target=self.write, args=(objects, True), name="write-behind")
+        thread.start()
+        thread.join()
+
+    def write(self, objects, direct=False):
+        puts = {}
+        updates = []
+        written = {}
+        for obj in objects:
+            db = obj.__database__
+            if not db:
+                logger.error("Database not defined in class %s" % obj.__class__.__name__)
+                continue
+
+            saved = obj.__saved__
+            write = obj.prepare_write()
+            if write is None:
+                self.stats["unchanged"] += 1
+                continue
+
+            (data, changes, removed) = write
+            self.inflight[id(obj)] = obj
+            if changes is None:
+                # The last one saved wins if there are several copies of the same item
+                key = db.get_key(data)
+                items = puts.setdefault(db.table, (db, {}))[1]
+                if key in items and items[key][0] is not obj:
+                    self.inflight.pop(id(items[key][0]), None)
+                items[key] = (obj, data, saved)
+            else:
+                updates.append((db, obj, data, changes, removed, saved))
+
+        for (table, (db, items)) in puts.items():
+            self.stats["puts"] += len(items)
+            self.stats["batches"] += (len(items) + 24) // 25
+            try:
+                failed = self.call(db, "batch_write", [data for (obj, data, saved) in items.values()],
+                                   direct=direct)
+            except Exception as e:
+                # (Like the offload queue being full.)  None of them were written.
+                logger.error("Batch write to %s failed: %s" % (table, e))
+                failed = None
+            if failed is None:
+                failed = [data for (obj, data, saved) in items.values()]
+            failed_keys = set(db.get_key(data) for data in failed)
+            for (key, (obj, data, saved)) in items.items():
+                if self.finished(obj, saved, key not in failed_keys):
+                    written.setdefault(db.table, []).append(key)
+
+        for (db, obj, data, changes, removed, saved) in updates:
+            self.stats["updates"] += 1
+            try:
+                success = self.call(db, "update_item", db.get_key_dict(data), changes, removed, direct=direct)
+            except Exception as e:
+                logger.error("Update of %s failed: %s" % (db.table, e))
+                success = False
+            if self.finished(obj, saved, success):
+                written.setdefault(db.table, []).append(db.get_key(data))
+
+        if not direct:
+            self.announce(written)
+
+    @staticmethod
+    def call(db, command, *args, direct=False):
+        if direct:
+            return getattr(db, command)(*args)
+        return db.handler.send_request(db.table, command, *args)
+
+    def finished(self, obj, saved, success):
+        self.inflight.pop(id(obj), None)
+        if success:
+            self.attempts.pop(id(obj), None)
+            return True
+
+        self.stats["failures"] += 1
+        # Put back what was there before, so it's all written next time
+        obj.__saved__ = saved
+        if not self.configured or self.delay <= 0:
+            logger.error("Couldn't write %s to %s" % (obj.__class__.__name__, obj.__database__.table))
+            return False
+
+        attempts = self.attempts.get(id(obj), 0) + 1
+        if attempts >= self.max_attempts:
+            # Something DynamoDB will never take (too big, not valid), or it's been down all this time
+            self.attempts.pop(id(obj), None)
+            self.stats["abandoned"] += 1
+            logger.error("Giving up on writing %s to %s after %s attempts" % (obj.__class__.__name__,
+                                                                             obj.__database__.table, attempts))
+            return False
+
+        self.attempts[id(obj)] = attempts
+        delay = self.delay * (1 << attempts)
+        logger.warning("Couldn't write %s to %s, trying again in %.1fs" % (obj.__class__.__name__,
+                                                                          obj.__database__.table, delay))
+        self.retrying[id(obj)] = obj
+        stacklesssocket.call_later(delay, self.retry, obj)
+        return False
+
+    @staticmethod
+    def announce(written):
+        # The other workers drop their cached copies of what's been written
+        from HavokMud.startup import server_instance
+        if not server_instance or not getattr(server_instance, "bus", None):
+            return
+        for (table, keys) in written.items():
+            server_instance.publish("invalidate", {"table": table, "keys": keys})
+
+    def format_stats(self):
+        stats = dict(self.stats, pending=len(self.pending), inflight=len(self.inflight))
+        return ["Writes: %(saves)d saves, %(coalesced)d coalesced, %(unchanged)d unchanged, %(puts)d puts in "
+                "%(batches)d batches, %(updates)d updates, %(failures)d failures, %(abandoned)d abandoned, "
+                "%(pending)d pending, %(inflight)d in progress" % stats]
+
+
+write_behind = WriteBehindCache()
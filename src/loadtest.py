@@ -0,0 +1,374 @@
+#! /usr/bin/env python3
+# Synthetic load generator.  Opens lots of simulated telnet clients against a running MUD (normally one
+# started with loadtest_server.py), logs each one in with a seeded account, then has them issue scripted
+# commands, and reports the per-command latency percentiles, throughput and the server's RSS over time.
+
+import argparse
+import errno
+import heapq
+import json
+import logging
+import math
+import random
+import re
+import resource
+import selectors
+import socket
+import time
+
+from HavokMud import telnet
+from HavokMud.telnet import TelnetParser
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+
+ansiRe = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+PROMPT = "> "
+
+
+class Client(object):
+    STATE_CONNECTING = 0
+    STATE_LOGIN = 1
+    STATE_PLAYING = 2
+    STATE_CLOSED = 3
+
+    def __init__(self, loadtest, index):
+        self.loadtest = loadtest
+        self.index = index
+        self.args = loadtest.args
+        self.state = self.STATE_CONNECTING
+        self.socket = None
+        self.out_buffer = bytearray()
+        self.text = ""
+        self.parser = TelnetParser(on_negotiation=self.on_negotiation, on_subnegotiation=self.on_subnegotiation)
+        self.login_script = [
+            ("(email address)? ", self.args.email_format % (self.args.first_account + index)),
+            ("Password: ", self.args.password),
+            ("Please pick an option: ", "7"),
+        ]
+        self.connect_time = None
+        self.command = None
+        self.command_time = None
+        self.events = 0
+
+    def connect(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.connect_time = time.perf_counter()
+        result = self.socket.connect_ex((self.args.host, self.args.port))
+        if result not in (0, errno.EINPROGRESS):
+            self.fail("connect", OSError(result, errno.errorcode.get(result, "")))
+            return
+        self.events = selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.loadtest.selector.register(self.socket, self.events, self)
+
+    def fail(self, stage, e):
+        self.loadtest.errors[stage] = self.loadtest.errors.get(stage, 0) + 1
+        logger.debug("Client %s failed (%s): %s" % (self.index, stage, e))
+        self.close()
+
+    def close(self):
+        if self.state == self.STATE_CLOSED:
+            return
+        self.state = self.STATE_CLOSED
+        if self.socket:
+            if self.events:
+                self.loadtest.selector.unregister(self.socket)
+            self.socket.close()
+
+    def update_events(self):
+        events = selectors.EVENT_READ
+        if self.out_buffer or self.state == self.STATE_CONNECTING:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.loadtest.selector.modify(self.socket, events, self)
+
+    def on_event(self, mask):
+        if self.state == self.STATE_CONNECTING and mask & selectors.EVENT_WRITE:
+            error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.fail("connect", OSError(error, errno.errorcode.get(error, "")))
+                return
+            self.state = self.STATE_LOGIN
+
+        if mask & selectors.EVENT_READ:
+            self.on_readable()
+        if self.state != self.STATE_CLOSED and mask & selectors.EVENT_WRITE:
+            self.flush()
+        if self.state != self.STATE_CLOSED:
+            self.update_events()
+
+    def on_readable(self):
+        try:
+            data = self.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail("recv", e)
+            return
+
+        if not data:
+            self.fail("disconnected", "closed by the server")
+            return
+
+        self.loadtest.bytes_received += len(data)
+        data = self.parser.feed(data)
+        if data:
+            self.text += ansiRe.sub("", data.decode("latin-1"))
+            # Only the tail matters for spotting prompts
+            if len(self.text) > 4096:
+                self.text = self.text[-4096:]
+            self.check_prompts()
+
+    def check_prompts(self):
+        if self.state == self.STATE_LOGIN:
+            if self.login_script:
+                (prompt, response) = self.login_script[0]
+                if self.text.endswith(prompt):
+                    self.login_script.pop(0)
+                    self.text = ""
+                    self.send_line(response)
+            elif self.text.endswith(PROMPT):
+                self.text = ""
+                self.state = self.STATE_PLAYING
+                self.loadtest.record("login", time.perf_counter() - self.connect_time)
+                self.loadtest.schedule(self.think_time(), self.send_command)
+        elif self.state == self.STATE_PLAYING and self.command and self.text.endswith(PROMPT):
+            self.text = ""
+            self.loadtest.record(self.command, time.perf_counter() - self.command_time)
+            self.command = None
+            self.loadtest.schedule(self.think_time(), self.send_command)
+
+    def think_time(self):
+        if not self.args.think_time:
+            return 0.0
+        return random.expovariate(1.0 / self.args.think_time)
+
+    def send_command(self):
+        if self.state != self.STATE_PLAYING or not self.loadtest.running:
+            return
+        line = random.choice(self.loadtest.commands)
+        self.command = line.split(" ")[0]
+        self.command_time = time.perf_counter()
+        self.send_line(line)
+        self.update_events()
+
+    def send_line(self, line):
+        self.out_buffer += line.encode("utf-8") + b"\r\n"
+        self.flush()
+
+    def send_raw(self, data):
+        self.out_buffer += data
+        self.flush()
+
+    def flush(self):
+        if not self.out_buffer or self.state in (self.STATE_CONNECTING, self.STATE_CLOSED):
+            return
+        try:
+            sent = self.socket.send(self.out_buffer)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail("send", e)
+            return
+        del self.out_buffer[:sent]
+
+    def on_negotiation(self, command, option):
+        # Act like a fairly ordinary MUD client, but without MCCP
+        if command == telnet.DO:
+            if option == telnet.NAWS:
+                self.send_raw(telnet.negotiation(telnet.WILL, telnet.NAWS) +
+                              telnet.subnegotiation(telnet.NAWS, bytes([0, 80, 0, 24])))
+            elif option == telnet.TTYPE:
+                self.send_raw(telnet.negotiation(telnet.WILL, telnet.TTYPE))
+            else:
+                self.send_raw(telnet.negotiation(telnet.WONT, option))
+        elif command == telnet.WILL:
+            if option == telnet.ECHO:
+                self.send_raw(telnet.negotiation(telnet.DO, telnet.ECHO))
+            else:
+                self.send_raw(telnet.negotiation(telnet.DONT, option))
+        elif command == telnet.WONT and option == telnet.ECHO:
+            self.send_raw(telnet.negotiation(telnet.DONT, telnet.ECHO))
+
+    def on_subnegotiation(self, option, data):
+        if option == telnet.TTYPE and data[:1] == bytes([telnet.TTYPE_SEND]):
+            self.send_raw(telnet.subnegotiation(telnet.TTYPE, bytes([telnet.TTYPE_IS]) + b"HAVOKLOAD"))
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.timers = []
+        self.timer_sequence = 0
+        self.latencies = {}
+        self.errors = {}
+        self.bytes_received = 0
+        self.rss_samples = []
+        self.running = True
+        self.commands = [command.strip() for command in args.commands.split(",") if command.strip()]
+        self.start_time = None
+        self.measure_start = None
+
+    def schedule(self, delay, callback, *args):
+        self.timer_sequence += 1
+        heapq.heappush(self.timers, (time.perf_counter() + delay, self.timer_sequence, callback, args))
+
+    def record(self, name, duration):
+        if self.measure_start is None or time.perf_counter() < self.measure_start:
+            if name != "login":
+                return
+        self.latencies.setdefault(name, []).append(duration)
+
+    def connect_next(self):
+        if len(self.clients) >= self.args.clients or not self.running:
+            return
+        client = Client(self, len(self.clients))
+        self.clients.append(client)
+        client.connect()
+        self.schedule(1.0 / self.args.connect_rate, self.connect_next)
+
+    def sample_rss(self):
+        if not self.running:
+            return
+        rss = get_rss(self.args.server_pid)
+        now = time.perf_counter() - self.start_time
+        playing = sum(1 for client in self.clients if client.state == Client.STATE_PLAYING)
+        completed = sum(len(items) for (name, items) in self.latencies.items() if name != "login")
+        self.rss_samples.append({"time": now, "rss_kb": rss, "clients": len(self.clients), "playing": playing,
+                                 "commands": completed})
+        logger.info("%6.1fs: %s clients, %s playing, %s commands, server RSS %s kB" %
+                    (now, len(self.clients), playing, completed, rss))
+        self.schedule(self.args.sample_interval, self.sample_rss)
+
+    def run(self):
+        self.start_time = time.perf_counter()
+        self.measure_start = self.start_time + self.args.warmup
+        end_time = self.start_time + self.args.duration
+        self.schedule(0, self.connect_next)
+        self.schedule(0, self.sample_rss)
+
+        while True:
+            now = time.perf_counter()
+            if now >= end_time:
+                break
+
+            while self.timers and self.timers[0][0] <= now:
+                (_, _, callback, args) = heapq.heappop(self.timers)
+                callback(*args)
+
+            timeout = end_time - now
+            if self.timers:
+                timeout = min(timeout, max(self.timers[0][0] - now, 0))
+            for (key, mask) in self.selector.select(timeout):
+                key.data.on_event(mask)
+
+        self.running = False
+        for client in self.clients:
+            client.close()
+
+        return self.report(time.perf_counter() - self.measure_start)
+
+    def report(self, elapsed):
+        results = {
+            "clients": len(self.clients),
+            "elapsed": elapsed,
+            "errors": self.errors,
+            "bytes_received": self.bytes_received,
+            "commands": {},
+            "rss": self.rss_samples,
+        }
+
+        total = 0
+        logger.info("%-10s %8s %10s %10s %10s %10s" % ("Command", "Count", "p50 (ms)", "p99 (ms)", "p999 (ms)",
+                                                      "max (ms)"))
+        for (name, items) in sorted(self.latencies.items()):
+            items.sort()
+            stats = {
+                "count": len(items),
+                "p50": percentile(items, 0.50),
+                "p99": percentile(items, 0.99),
+                "p999": percentile(items, 0.999),
+                "max": items[-1],
+            }
+            results["commands"][name] = stats
+            if name != "login":
+                total += len(items)
+            logger.info("%-10s %8d %10.2f %10.2f %10.2f %10.2f" % (name, stats["count"], stats["p50"] * 1000,
+                                                                  stats["p99"] * 1000, stats["p999"] * 1000,
+                                                                  stats["max"] * 1000))
+
+        results["throughput"] = total / max(elapsed, 1e-9)
+        logger.info("Throughput: %.1f commands/s over %.1fs" % (results["throughput"], elapsed))
+        if self.errors:
+            logger.info("Errors: %s" % self.errors)
+        rss_values = [sample["rss_kb"] for sample in self.rss_samples if sample["rss_kb"] is not None]
+        if rss_values:
+            logger.info("Server RSS: start %s kB, peak %s kB, end %s kB" % (rss_values[0], max(rss_values),
+                                                                          rss_values[-1]))
+        return results
+
+
+def percentile(items, fraction):
+    # items must be sorted
+    if not items:
+        return 0.0
+    index = min(len(items) - 1, max(int(math.ceil(fraction * len(items))) - 1, 0))
+    return items[index]
+
+
+def get_rss(pid):
+    if not pid:
+        return None
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Telnet load generator and latency benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--clients", type=int, default=100, help="Number of simulated clients")
+    parser.add_argument("--connect-rate", type=float, default=200.0, help="New connections per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="Length of the run in seconds")
+    parser.add_argument("--warmup", type=float, default=5.0,
+                        help="Seconds before command latencies are recorded")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Mean seconds between commands per client")
+    parser.add_argument("--commands", default="say hello there,look,help",
+                        help="Comma separated commands to pick from at random")
+    parser.add_argument("--email-format", default="loadtest%d@example.com")
+    parser.add_argument("--first-account", type=int, default=0)
+    parser.add_argument("--password", default="loadtest-password")
+    parser.add_argument("--server-pid", type=int, default=None, help="PID of the server, to sample its RSS")
+    parser.add_argument("--sample-interval", type=float, default=5.0)
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format=format)
+
+    # Thousands of clients need thousands of file descriptors
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = LoadTest(args).run()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
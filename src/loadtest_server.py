@@ -0,0 +1,29 @@
+#! /usr/bin/env python
+# Runs the MUD with in-process stand-ins for DynamoDB, Redis, keosd, nodeos, SES and DNS, and a set of
+# seeded accounts for loadtest.py to log in with.
+
+import argparse
+import logging
+
+from HavokMud.startup import start_mud
+from HavokMud import standins
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description="Run the MUD against stand-in backends for load testing")
+parser.add_argument("--accounts", type=int, default=1000, help="Number of accounts to seed")
+parser.add_argument("--password", default="loadtest-password", help="Password for the seeded accounts")
+parser.add_argument("--latency", action="append", default=[], metavar="SERVICE=SECONDS",
+                    help="Simulated latency for a service (dynamodb, secretsmanager, redis, keosd, nodeos, "
+                         "ses, dns).  Can be repeated.")
+args = parser.parse_args()
+
+service_latency = {}
+for item in args.latency:
+    (service, _, seconds) = item.partition("=")
+    service_latency[service] = float(seconds)
+
+standins.install(service_latency)
+standins.seed_accounts(args.accounts, password=args.password)
+
+exit(start_mud(looping=True))
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+import logging
+import random
+import re
+import time
+
+from colors import color
+
+from HavokMud.ansicolors import AnsiColors, render_string
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+logging.basicConfig(level=logging.INFO, format=format)
+
+
+class LegacyAnsiColors(AnsiColors):
+    # The regex and colors.color() version this replaced, to check against and benchmark
+    colorCodeRe = re.compile(r'(?P<preamble>.*?)\$C(?P<code>\d\d\d\S)(?P<text>.*?)(?=(?P<eol>[\r\n]+)|$|\$C\d\d\d\S)',
+                             re.I)
+
+    def convert_string(self, input, ansi=True):
+        parts = [item.groupdict() for item in self.colorCodeRe.finditer(input)]
+        if not parts:
+            parts = [{"text": input, "code": self.default}]
+
+        count = 0
+        parts_in = list(parts)
+        for (index, part) in enumerate(parts_in):
+            preamble = parts[index + count].pop("preamble", None)
+            if preamble:
+                parts.insert(index + count, {"text": preamble, "code": self.default})
+                count += 1
+
+        output = ""
+        color_params = {}
+        old_color_params = {}
+
+        for part in parts:
+            if ansi:
+                color_params = self.convert_code(part.get("code", self.default))
+            text = part.get("text", "")
+            eol = part.get("eol", "")
+            if not eol:
+                eol = ""
+            if not ansi or color_params == old_color_params:
+                output += text
+            else:
+                output += color(text, **color_params)
+            output += eol
+
+        return output
+
+
+sgrRe = re.compile(r'\x1b\[([0-9;]*)m')
+
+
+def screen(output):
+    # What a terminal would show: each printable character with the attributes in effect
+    cells = []
+    attributes = {}
+    index = 0
+    for match in sgrRe.finditer(output):
+        cells.extend((char, tuple(sorted(attributes.items()))) for char in output[index:match.start()]
+                     if char not in "\r\n")
+        index = match.end()
+        for param in (match.group(1) or "0").split(";"):
+            param = int(param)
+            if param == 0:
+                attributes = {}
+            elif 30 <= param <= 37:
+                attributes["fg"] = param
+            elif 40 <= param <= 47:
+                attributes["bg"] = param
+            else:
+                attributes["sgr%d" % param] = True
+    cells.extend((char, tuple(sorted(attributes.items()))) for char in output[index:] if char not in "\r\n")
+    return cells
+
+
+def random_line(rnd):
+    # Single lines, with bold or plain styles: the old version dropped text on lines after the first,
+    # and emitted a stray reset for style combinations like "underline+none"
+    fg_codes = list(AnsiColors.fg_map.keys())
+    parts = []
+    for i in range(rnd.randrange(1, 8)):
+        if rnd.randrange(4):
+            parts.append("$%s%d%d%s" % (rnd.choice("cC"), rnd.randrange(2), rnd.randrange(8), rnd.choice(fg_codes)))
+        parts.append("".join(rnd.choice("abc xyz$-=[]") for j in range(rnd.randrange(12))))
+    if rnd.randrange(2):
+        parts.append("\r\n")
+    return "".join(parts)
+
+
+new = AnsiColors()
+legacy = LegacyAnsiColors()
+
+# Known output
+assert new.convert_string("$c0009You said$c0007: hi\r\n") == \
+       "\x1b[0;31;40;1mYou said\x1b[0;37;40m: hi\r\n\x1b[0m"
+assert new.convert_string("plain") == "\x1b[0;37;40mplain\x1b[0m"
+assert new.convert_string("") == ""
+# Codes with nothing after them, and codes the same as the current one, are skipped
+assert new.convert_string("$c0009$c0007a$c000wb") == "\x1b[0;37;40mab\x1b[0m"
+# Nothing is lost on later lines
+assert new.convert_string("$c0009a\r\nplain\r\n$c0007b", False) == "a\r\nplain\r\nb"
+assert new.convert_string("$c4007u") == "\x1b[0;37;40;4mu\x1b[0m"
+
+# The same thing on screen as the old version
+rnd = random.Random(1234)
+for iteration in range(2000):
+    line = random_line(rnd)
+    for ansi in [True, False]:
+        expected = legacy.convert_string(line, ansi)
+        output = AnsiColors.render(line, ansi)
+        if ansi:
+            assert screen(output) == screen(expected), "%r: %r != %r" % (line, output, expected)
+        else:
+            assert output == expected, "%r: %r != %r" % (line, output, expected)
+
+logger.info("Comparison passed")
+
+# Benchmark, on the sort of thing that gets sent over and over
+workload = [
+    "> ",
+    "$c0009-=$c0015HavokMud Account Menu [someone@example.com]$c0009=-\r\n",
+    "$c00151) $c0012ANSI Colors.\r\n",
+    "$c00152) $c0012Change your password.\r\n",
+    "$c00157) $c0012Play an existing character.\r\n",
+    "$c0011Please pick an option: ",
+    "Use HELP COMMAND_NAME to get help on a specific command\r\nUse HELP to get a list of commands\r\n",
+    "Someone says: \"hello there$c0007\"\r\n",
+    "Unknown command.  Type 'help' to see a list of available commands.\r\n",
+] * 100
+unique = ["Someone says: \"message %d$c0007\"\r\n" % index for index in range(len(workload))]
+
+
+def benchmark(name, func, strings, repeat=20):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for string in strings:
+            func(string, True)
+    duration = (time.perf_counter() - start) / (repeat * len(strings))
+    logger.info("%-24s %8.2f us per string" % (name, duration * 1e6))
+    return duration
+
+
+legacy_time = benchmark("legacy", legacy.convert_string, workload)
+scanner_time = benchmark("scanner (no cache)", AnsiColors.render, workload)
+cached_time = benchmark("scanner (cached)", new.convert_string, workload)
+render_string.cache_clear()
+unique_time = benchmark("scanner (cache misses)", new.convert_string, unique, repeat=1)
+legacy_unique_time = benchmark("legacy (unique strings)", legacy.convert_string, unique, repeat=1)
+
+logger.info("Scanner is %.1fx faster, %.1fx with the cache, %.1fx on cache misses" %
+            (legacy_time / scanner_time, legacy_time / cached_time, legacy_unique_time / unique_time))
+assert legacy_time / scanner_time >= 5, "Uncached rendering should be at least 5x faster"
+assert legacy_unique_time / unique_time >= 5, "Rendering should be at least 5x faster on cache misses"
+assert legacy_time / cached_time >= 10, "Cached rendering should be at least 10x faster"
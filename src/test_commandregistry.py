@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+import logging
+import re
+import time
+
+from HavokMud.commandhandler import CommandHandler
+from HavokMud.commandregistry import get_registry, CommandRegistry, CommandRegistryError
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+logging.basicConfig(level=logging.INFO, format=format)
+
+
+class BaseTestHandler(object):
+    commands = {
+        "look": {"handler": "BaseTestHandler.handler_standard", "priority": 1},
+        "list": "BaseTestHandler.handler_standard",
+        "north": "BaseTestHandler.handler_standard",
+        "n": {"root": "north"},
+        "nw": {"root": "northwest"},
+        "northwest": "BaseTestHandler.handler_standard",
+        "shutdown": {"handler": "BaseTestHandler.handler_standard", "admin": True},
+        "shout": "BaseTestHandler.handler_standard",
+        "missing": "BaseTestHandler.handler_standard",
+    }
+
+    def __init__(self):
+        self.calls = []
+
+    def command_look(self, tokens):
+        self.calls.append("look")
+
+    def command_list(self, tokens):
+        self.calls.append("list")
+
+    def command_north(self, tokens):
+        self.calls.append("north")
+
+    def command_northwest(self, tokens):
+        self.calls.append("northwest")
+
+    def command_shutdown(self, tokens):
+        self.calls.append("shutdown")
+
+    def command_shout(self, tokens):
+        self.calls.append("shout")
+
+
+class SubTestHandler(BaseTestHandler):
+    commands = {
+        "list": "SubTestHandler.other_list",
+        "ls": {"root": "list"},
+    }
+
+    def other_list(self, tokens):
+        self.calls.append("other_list")
+
+
+registry = get_registry(BaseTestHandler)
+assert get_registry(BaseTestHandler) is registry
+assert registry.lookup("l").verb == "look"
+assert registry.lookup("li").verb == "list"
+assert registry.lookup("LOOK").verb == "look"
+# Exact aliases win over longer commands
+assert registry.lookup("n").verb == "north"
+assert registry.lookup("nw").verb == "northwest"
+assert registry.lookup("nor") == ["north", "northwest"]
+assert registry.lookup("northw").verb == "northwest"
+# Admin commands are only there for admins
+assert registry.lookup("sh").verb == "shout"
+assert registry.lookup("shu") is None
+assert registry.lookup("sh", admin=True) == ["shout", "shutdown"]
+assert registry.lookup("shu", admin=True).verb == "shutdown"
+# Handlers that don't exist are dropped
+assert registry.lookup("missing") is None
+assert registry.lookup("x") is None
+assert [entry.verb for entry in registry.list_commands()] == ["list", "look", "north", "northwest", "shout"]
+assert registry.lookup("north").aliases == ["n"]
+
+handler = BaseTestHandler()
+registry.lookup("nw").bind(handler)(["nw"])
+assert handler.calls == ["northwest"]
+
+# Subclasses add to and override the commands
+sub_registry = get_registry(SubTestHandler)
+assert sub_registry is not registry
+assert sub_registry.lookup("ls").verb == "list"
+handler = SubTestHandler()
+sub_registry.lookup("ls").bind(handler)(["ls"])
+sub_registry.lookup("n").bind(handler)(["n"])
+assert handler.calls == ["other_list", "north"]
+
+
+class LoopHandler(object):
+    commands = {"a": {"root": "b"}, "b": {"root": "a"}}
+
+
+try:
+    CommandRegistry(LoopHandler)
+    raise AssertionError("Alias loop not detected")
+except CommandRegistryError:
+    pass
+
+# The real thing
+registry = get_registry(CommandHandler)
+assert registry.lookup("l").verb == "look"
+assert registry.lookup("n").verb == "north"
+assert registry.lookup("jobs") is None
+assert registry.lookup("jobs", admin=True).verb == "jobs"
+
+logger.info("Registry checks passed")
+
+# Benchmark against the old regex scan, with a few hundred commands
+words = ["".join(chr(ord("a") + (index * 7 + offset * 3) % 26) for offset in range(4 + index % 6))
+         for index in range(400)]
+big_commands = {word: "BigHandler.handler_standard" for word in words}
+big_commands.update({word[:2] + "x": {"root": word} for word in words[::10]})
+BigHandler = type("BigHandler", (object,), dict({"commands": big_commands},
+                                                **{"command_%s" % word: lambda self, tokens: None
+                                                   for word in words}))
+
+
+def legacy_defangle_verb(commands, verb):
+    while True:
+        verb = verb.lower()
+        handler_info = commands.get(verb, None)
+        if not isinstance(handler_info, dict):
+            handler_info = {"handler": handler_info}
+
+        root = handler_info.get("root", None)
+        if root:
+            verb = root
+            continue
+
+        handler = handler_info.get("handler", None)
+        if handler:
+            return (verb, handler_info)
+
+        pattern = re.compile(r'^%s.*' % verb, re.I)
+        roots = list(filter(None, map(lambda x: pattern.findall(x), commands.keys())))
+        roots = [item for item_list in roots for item in item_list]
+        if not roots:
+            return
+
+        if len(roots) > 1:
+            return
+
+        verb = roots[0]
+
+
+big_registry = get_registry(BigHandler)
+inputs = [word[:3 + index % 3] for (index, word) in enumerate(words)] + words + ["zzzzzz"] * 20
+
+
+def benchmark(name, func, repeat=20):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for verb in inputs:
+            func(verb)
+    duration = (time.perf_counter() - start) / (repeat * len(inputs))
+    logger.info("%-12s %8.2f us per lookup" % (name, duration * 1e6))
+    return duration
+
+
+for verb in inputs:
+    legacy = legacy_defangle_verb(big_commands, verb)
+    entry = big_registry.lookup(verb)
+    if legacy:
+        assert entry.verb == legacy[0], "%s: %s != %s" % (verb, entry.verb, legacy[0])
+
+legacy_time = benchmark("legacy", lambda verb: legacy_defangle_verb(big_commands, verb), repeat=2)
+registry_time = benchmark("registry", big_registry.lookup)
+logger.info("Registry lookups are %.0fx faster" % (legacy_time / registry_time))
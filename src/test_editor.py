@@ -10,7 +10,8 @@ import logging
 import socket
 import stackless
 import traceback
-import subprocess
+
+from HavokMud.childwatcher import child_watcher
 
 logger = logging.getLogger(__name__)
 
@@ -30,11 +31,14 @@ class DoEditor(object):
 
         #command = ["nano", "-R", "/tmp/shitface"]
         command = ["vim", "-Z", "/tmp/shitface"]
-        self.proc = subprocess.Popen(command, stdin=self.sock_fd, stdout=self.sock_fd)
+        self.sock_fd.pause_reading()
+        self.child = child_watcher.launch(command, time_limit=300, stdin=self.sock_fd, stdout=self.sock_fd)
         stackless.tasklet(self.communicate)()
 
     def communicate(self):
-        self.proc.communicate()
+        # Only this tasklet waits, everyone else carries on
+        child_watcher.wait(self.child)
+        self.sock_fd.resume_reading()
         # Turn back on echo
         self.sock_fd.send(b'\xff\xfc\x01')
         # Tell the client to go back into edit mode (line mode) and to echo literally
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+import logging
+import math
+import random
+import time
+
+from HavokMud.metrics import Histogram, Metrics, bucket_index, bucket_value, MAX_VALUE, timed, metrics
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+logging.basicConfig(level=logging.INFO, format=format)
+
+# The buckets are in order, and each value's bucket is within ~3% of it
+last_index = -1
+for value in list(range(5000)) + [random.randrange(MAX_VALUE) for i in range(20000)] + [MAX_VALUE]:
+    index = bucket_index(value)
+    assert abs(bucket_value(index) - value) <= max(1, value / 32.0), "%s -> %s -> %s" % (value, index,
+                                                                                     bucket_value(index))
+    if value < 5000:
+        assert index >= last_index
+        last_index = index
+
+# Percentiles against the exact ones
+rnd = random.Random(1234)
+for distribution in ["uniform", "lognormal", "bimodal"]:
+    histogram = Histogram(distribution)
+    values = []
+    for i in range(50000):
+        if distribution == "uniform":
+            value = rnd.uniform(0, 0.1)
+        elif distribution == "lognormal":
+            value = rnd.lognormvariate(-7, 1.5)
+        else:
+            value = rnd.choice([rnd.uniform(0.0001, 0.0002), rnd.uniform(0.2, 0.3)])
+        values.append(int(value * 1000000))
+        histogram.record(value)
+
+    values.sort()
+    for (percent, result) in zip([50, 90, 99, 100], histogram.percentiles(50, 90, 99, 100)):
+        exact = values[max(1, math.ceil(len(values) * percent / 100.0)) - 1]
+        assert abs(result - exact) <= max(1, exact / 32.0), "%s p%s: %s != %s" % (distribution, percent, result,
+                                                                                 exact)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == len(values)
+    assert snapshot["max_ms"] == values[-1] / 1000.0
+    logger.info("%-10s p50 %.3fms p90 %.3fms p99 %.3fms max %.3fms" % (distribution, snapshot["p50_ms"],
+                                                                       snapshot["p90_ms"], snapshot["p99_ms"],
+                                                                       snapshot["max_ms"]))
+
+# The registry, reports and reset
+registry = Metrics()
+registry.record("db.accounts.get_item", 0.002)
+registry.record("db.accounts.get_item", 0.004)
+registry.record("command.look", 0.0005)
+with registry.timer("command.say"):
+    pass
+assert [item["name"] for item in registry.report()] == ["command.look", "command.say", "db.accounts.get_item"]
+assert [item["name"] for item in registry.report("db.")] == ["db.accounts.get_item"]
+assert registry.report("db.")[0]["count"] == 2
+assert len(registry.format_report()) == 5
+registry.reset("command.")
+assert [item["name"] for item in registry.report()] == ["db.accounts.get_item"]
+
+
+@timed("test.sleep")
+def sleeper():
+    time.sleep(0.01)
+
+
+sleeper()
+assert 9.5 <= metrics.report("test.sleep")[0]["p50_ms"] < 50
+
+# The cost of recording
+histogram = Histogram("overhead")
+count = 200000
+start = time.perf_counter()
+for i in range(count):
+    histogram.record(0.000123 * (i % 100))
+record_time = (time.perf_counter() - start) / count
+start = time.perf_counter()
+for i in range(count):
+    with metrics.timer("command.look"):
+        pass
+timer_time = (time.perf_counter() - start) / count
+logger.info("record() %.2f us, timer() %.2f us" % (record_time * 1e6, timer_time * 1e6))
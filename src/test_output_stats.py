@@ -0,0 +1,114 @@
+#! /usr/bin/env python3
+import logging
+
+from HavokMud.connection import Connection, summarize_output_stats, format_output_stats
+from HavokMud.output_priority import OutputPriority
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+logging.basicConfig(level=logging.INFO, format=format)
+
+
+class StandInSocket(object):
+    # Takes whatever it's given, up to send_limit bytes per call, and leaves the rest in send_buffer
+    def __init__(self, send_limit=None):
+        self.send_limit = send_limit
+        self.send_buffer = bytearray()
+        self.send_syscalls = 0
+        self.sent = bytearray()
+        self.on_send_drained = None
+        self.closed = False
+
+    def sendmsg(self, buffers):
+        data = b"".join(buffers)
+        self.send_syscalls += 1
+        sent = len(data) if self.send_limit is None else min(len(data), self.send_limit)
+        self.sent += data[:sent]
+        self.send_buffer += data[sent:]
+        return len(data)
+
+    def close(self):
+        self.closed = True
+        self.send_buffer = None
+
+
+class OutputConnection(Connection):
+    # Just the output side, without a server, user or tasklets
+    def __init__(self, client_socket, connection_config=None):
+        self.client_socket = client_socket
+        self.client_address = ("127.0.0.1", 4000)
+        self.user = None
+        self.timers = {}
+        self.setup_output(connection_config or {})
+
+
+# The high-water marks are the most ever queued (counting what's still in the socket's buffer), not what's
+# queued now
+connection = OutputConnection(StandInSocket())
+for i in range(10):
+    connection.append_output(b"x" * 100)
+stats = connection.get_output_stats()
+assert stats["high_water_messages"] == 10, stats
+assert stats["high_water_bytes"] == 1000, stats
+assert stats["queued_messages"] == 10 and stats["queued_bytes"] == 1000, stats
+
+connection.flush_output()
+for i in range(3):
+    connection.append_output(b"y" * 10)
+stats = connection.get_output_stats()
+assert stats["high_water_messages"] == 10 and stats["high_water_bytes"] == 1000, stats
+assert stats["queued_messages"] == 3 and stats["queued_bytes"] == 30, stats
+assert stats["flushes"] == 1 and stats["syscalls"] == 1 and stats["bytes"] == 1000, stats
+assert stats["bytes_per_flush"] == 1000.0 and stats["syscalls_per_flush"] == 1.0, stats
+assert stats["compression_ratio"] == 1.0, stats
+logger.info("High-water marks passed")
+
+# Bytes the socket hasn't taken yet count towards the backlog
+slow = OutputConnection(StandInSocket(send_limit=400))
+slow.append_output(b"z" * 1000)
+slow.flush_output()
+slow.append_output(b"z" * 100)
+stats = slow.get_output_stats()
+assert stats["buffered_bytes"] == 600, stats
+assert stats["high_water_bytes"] == 1000 and stats["high_water_messages"] == 1, stats
+slow.append_output(b"z" * 500)
+stats = slow.get_output_stats()
+assert stats["high_water_bytes"] == 600 + 100 + 500, stats
+assert stats["high_water_messages"] == 2, stats
+logger.info("Buffered bytes passed")
+
+# Low priority output past the soft limit is dropped, and doesn't raise the high-water mark
+limited = OutputConnection(StandInSocket(), {"output_soft_messages": 2})
+for i in range(5):
+    limited.append_output(b"chat", OutputPriority.Low)
+stats = limited.get_output_stats()
+assert stats["dropped"] == 3 and stats["high_water_messages"] == 2, stats
+logger.info("Dropped output passed")
+
+# Totals across connections, and the largest on any one
+all_stats = []
+for (item, address) in [(connection, "10.0.0.1:1"), (slow, "10.0.0.2:2"), (limited, "10.0.0.3:3")]:
+    stats = item.get_output_stats()
+    stats["address"] = address
+    all_stats.append(stats)
+summary = summarize_output_stats(all_stats)
+assert summary["count"] == 3
+assert summary["totals"]["flushes"] == 2 and summary["totals"]["syscalls"] == 2, summary
+assert summary["totals"]["bytes"] == 2000 and summary["totals"]["dropped"] == 3, summary
+assert summary["totals"]["queued_messages"] == 3 + 2 + 2, summary
+assert summary["totals"]["bytes_per_flush"] == 1000.0, summary
+assert summary["max"]["high_water_bytes"] == 1200 and summary["max"]["high_water_messages"] == 10, summary
+assert summary["max"]["buffered_bytes"] == 600, summary
+
+lines = format_output_stats(summary, all_stats)
+assert lines[0] == "Connections: 3"
+# Those that queued up the most come first
+assert lines[-3].startswith("10.0.0.2:2") and lines[-1].startswith("10.0.0.3:3"), lines
+for line in lines:
+    logger.info(line)
+
+empty = summarize_output_stats([])
+assert empty["count"] == 0 and empty["max"]["high_water_bytes"] == 0
+assert len(format_output_stats(empty)) == 4
+logger.info("Summary passed")
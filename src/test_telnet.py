@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+import logging
+import random
+import time
+
+from HavokMud import telnet
+from HavokMud.telnet import TelnetParser
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+logging.basicConfig(level=logging.INFO, format=format)
+
+
+class Recorder(object):
+    def __init__(self):
+        self.events = []
+        self.parser = TelnetParser(on_command=self.on_command, on_negotiation=self.on_negotiation,
+                                   on_subnegotiation=self.on_subnegotiation)
+
+    def on_command(self, command):
+        self.events.append(("command", command))
+
+    def on_negotiation(self, command, option):
+        self.events.append(("negotiation", command, option))
+
+    def on_subnegotiation(self, option, data):
+        self.events.append(("subnegotiation", option, data))
+
+
+def random_chunk(rnd):
+    choice = rnd.randrange(6)
+    if choice == 0:
+        return bytes([telnet.IAC, telnet.IAC]), b"\xff", []
+    if choice == 1:
+        command = rnd.choice([telnet.NOP, telnet.AYT, telnet.GA, telnet.EC])
+        return bytes([telnet.IAC, command]), b"", [("command", command)]
+    if choice == 2:
+        command = rnd.randrange(telnet.WILL, telnet.DONT + 1)
+        option = rnd.randrange(256)
+        return telnet.negotiation(command, option), b"", [("negotiation", command, option)]
+    if choice == 3:
+        option = rnd.choice([telnet.NAWS, telnet.TTYPE, telnet.LINEMODE])
+        data = bytes(rnd.randrange(256) for i in range(rnd.randrange(8)))
+        return telnet.subnegotiation(option, data), b"", [("subnegotiation", option, data)]
+    text = bytes(rnd.randrange(255) for i in range(rnd.randrange(1, 40)))
+    return text, text, []
+
+
+# Known sequences, including the ones the old parser got wrong
+recorder = Recorder()
+assert recorder.parser.feed(b"ab\xff\xffcd") == b"ab\xffcd"
+assert recorder.parser.feed(b"look\xff\xfb") == b"look"
+assert recorder.parser.feed(b"\x1f\r\n") == b"\r\n"
+assert recorder.events == [("negotiation", telnet.WILL, telnet.NAWS)]
+assert recorder.parser.feed(b"\xff\xfa\x1f\x00\x50\x00\x18\xff\xf0x") == b"x"
+assert recorder.events[-1] == ("subnegotiation", telnet.NAWS, b"\x00\x50\x00\x18")
+
+# Fuzz: the output and events must be the same however the input is split up
+rnd = random.Random(1234)
+for iteration in range(500):
+    chunks = [random_chunk(rnd) for i in range(rnd.randrange(1, 50))]
+    stream = b"".join(chunk[0] for chunk in chunks)
+    expected = b"".join(chunk[1] for chunk in chunks)
+    expected_events = [event for chunk in chunks for event in chunk[2]]
+
+    recorder = Recorder()
+    output = b""
+    index = 0
+    while index < len(stream):
+        size = rnd.randrange(1, 10)
+        output += recorder.parser.feed(stream[index:index + size])
+        index += size
+
+    assert output == expected, "Iteration %s: %r != %r" % (iteration, output, expected)
+    assert recorder.events == expected_events, "Iteration %s: %r != %r" % (iteration, recorder.events,
+                                                                          expected_events)
+
+# Pure garbage must not blow up
+for iteration in range(200):
+    parser = TelnetParser()
+    parser.feed(bytes(rnd.randrange(256) for i in range(1000)))
+
+logger.info("Fuzzing passed")
+
+# Benchmark: the cost should be linear in the size of the input, even when it is full of commands
+timings = []
+for size in [1000, 10000, 100000]:
+    data = (b"x" * 10 + telnet.negotiation(telnet.WILL, telnet.ECHO)) * size
+    parser = TelnetParser()
+    start = time.perf_counter()
+    parser.feed(data)
+    duration = time.perf_counter() - start
+    timings.append(duration)
+    logger.info("%s bytes: %.6fs (%.1f MB/s)" % (len(data), duration, len(data) / duration / 1e6))
+
+ratio = timings[2] / timings[1]
+logger.info("10x the input took %.1fx the time" % ratio)
+assert ratio < 30, "Parsing does not look linear"
@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+import logging
+import random
+
+from HavokMud.timingwheel import TimingWheel
+
+logger = logging.getLogger(__name__)
+
+format = '%(asctime)s %(levelname)s [PID %(process)d] (%(name)s:%(lineno)d) %(message)s'
+logging.basicConfig(level=logging.INFO, format=format)
+
+
+class ManualWheel(TimingWheel):
+    # Turned by hand, rather than by the socket reactor
+    def __init__(self):
+        TimingWheel.__init__(self, tick=1.0)
+        self.now = 0
+
+    def now_tick(self):
+        return self.now
+
+    def schedule(self):
+        pass
+
+    def run_until(self, tick):
+        while self.current_tick < tick:
+            self.advance()
+        self.now = self.current_tick
+
+
+# Timers fire on the tick they're due, however many levels they cascade down through
+wheel = ManualWheel()
+fired = []
+delays = [1, 2, 255, 256, 257, 300, 4095, 16383, 16384, 16385, 20000, (1 << 20) - 1, (1 << 20) + 7]
+rnd = random.Random(1234)
+delays += [rnd.randrange(1, 1 << 21) for i in range(200)]
+for delay in delays:
+    wheel.call_later(delay, lambda due: fired.append((due, wheel.current_tick)), delay)
+assert wheel.count == len(delays)
+
+wheel.run_until(max(delays))
+assert len(fired) == len(delays), "%s of %s timers fired" % (len(fired), len(delays))
+for (due, tick) in fired:
+    assert due == tick, "Timer due at %s fired at %s" % (due, tick)
+assert [due for (due, tick) in fired] == sorted(delays)
+assert wheel.count == 0
+logger.info("Cascade passed")
+
+# Cancelled timers don't fire, and only count once
+wheel = ManualWheel()
+fired = []
+timers = [wheel.call_later(10, fired.append, i) for i in range(5)]
+timers[1].cancel()
+timers[1].cancel()
+assert wheel.count == 4
+assert not timers[1].active
+wheel.run_until(10)
+assert sorted(fired) == [0, 2, 3, 4]
+assert wheel.count == 0
+logger.info("Cancel passed")
+
+# A callback can cancel other timers due on the same tick (like an eviction cancelling the idle timer)
+wheel = ManualWheel()
+fired = []
+pair = []
+
+
+def cancel_others(name):
+    fired.append(name)
+    for timer in pair:
+        timer.cancel()
+
+
+pair.append(wheel.call_later(5, cancel_others, "keepalive"))
+pair.append(wheel.call_later(5, cancel_others, "idle"))
+later = wheel.call_later(50, fired.append, "later")
+wheel.run_until(5)
+assert len(fired) == 1, "Cancelled timer fired: %s" % fired
+assert wheel.count == 1, "Count is %s" % wheel.count
+wheel.run_until(50)
+assert fired[1:] == ["later"]
+assert wheel.count == 0
+logger.info("Cancel from a callback passed")
+
+# A callback can add timers, including one due on the next tick, and an exception doesn't stop the rest
+wheel = ManualWheel()
+fired = []
+
+
+def fail():
+    raise RuntimeError("Expected")
+
+
+wheel.call_later(3, fail)
+wheel.call_later(3, lambda: wheel.call_later(1, fired.append, wheel.current_tick + 1))
+wheel.call_later(3, fired.append, 3)
+wheel.run_until(4)
+assert sorted(fired) == [3, 4], fired
+assert wheel.count == 0
+logger.info("Callbacks passed")